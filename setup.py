@@ -64,9 +64,13 @@ setup(name='stackslurp',
       package_data={'': ['LICENSE']},
       include_package_data=False,
       install_requires=requires,
+      extras_require={
+          # Faster JSON encoding for enqueued messages
+          'fast': ['ujson>=1.34'],
+      },
       entry_points={
           'console_scripts': [
-              'slurp = stackslurp.main:main',
+              'slurp = stackslurp.main:cli',
           ]
       },
       license=open('LICENSE').read(),
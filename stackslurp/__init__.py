@@ -42,5 +42,23 @@ __copyright__ = 'Copyright 2013 Rackspace'
 from . import stackexchange
 from . import rackspace
 from . import utils
+from . import sessions
+from . import retry
+from . import metrics
+from . import checkpoint
+from . import dedup
+from . import activity
+from . import bodies
+from . import users
+from . import outbox
+from . import sinks
+from . import cassette
+from . import backfill
+from . import engine
+from . import logs
+from . import workers
 
-__all__ = ["stackexchange", "rackspace", "utils"]
+__all__ = ["stackexchange", "rackspace", "utils", "sessions", "retry",
+           "metrics", "checkpoint", "dedup", "activity", "bodies", "users",
+           "outbox", "sinks", "cassette", "backfill", "engine", "logs",
+           "workers"]
@@ -0,0 +1,104 @@
+'''
+Remembers just enough about each question sent to tell when it has changed.
+
+Activity polling turns up every question with anything new on it, most of
+which is noise for Peril (edits, comments, votes). A question is only worth
+an update event when its answers or accepted answer have moved on, so for
+each one we keep its last activity date, answer count and accepted answer.
+
+>>> states = QuestionStates(max_size=2)
+>>> question = {"question_id": 20912948, "last_activity_date": 1388784322,
+...             "answer_count": 0}
+>>> states.changed("stackoverflow", question)
+>>> states.add([("stackoverflow", question)])
+>>> states.changed("stackoverflow", dict(question, answer_count=1))
+['answer_count']
+'''
+
+import json
+import logging
+import os
+import threading
+from collections import OrderedDict
+
+from . import utils
+
+logger = logging.getLogger(__name__)
+
+
+def question_state(question):
+    '''The (last_activity_date, answer_count, accepted_answer_id) of a
+    question, which is all QuestionStates keeps.
+    '''
+    return (question.get('last_activity_date'),
+            question.get('answer_count', 0),
+            question.get('accepted_answer_id'))
+
+
+class QuestionStates(object):
+    '''The state of the last `max_size` questions sent, by (site,
+    question_id). The least recently updated go first.
+
+    With a `path`, states are saved there by `save` and read back on
+    startup.
+    '''
+
+    # What changes make a question worth an update event, in state order
+    tracked = (None, "answer_count", "accepted_answer_id")
+
+    def __init__(self, max_size=10000, path=None):
+        self.max_size = max_size
+        self.path = path
+
+        self._states = OrderedDict()
+        self._lock = threading.Lock()
+
+        if path is not None and os.path.exists(path):
+            with open(path) as fh:
+                with self._lock:
+                    for site, question_id, state in json.load(fh):
+                        self._states[(site, question_id)] = tuple(state)
+            logger.info("Loaded {} question states from {}".format(len(self),
+                                                                    path))
+
+    def __len__(self):
+        return len(self._states)
+
+    def __contains__(self, key):
+        return key in self._states
+
+    def changed(self, site, question):
+        '''What has changed about `question` since it was added, as a list of
+        field names. None if it was never added, and an empty list if nothing
+        Peril cares about has changed (a new comment, say).
+        '''
+        with self._lock:
+            before = self._states.get((site, question['question_id']))
+
+        if before is None:
+            return None
+
+        return [field for field, old, new in zip(self.tracked, before,
+                                                 question_state(question))
+                if field is not None and old != new]
+
+    def add(self, questions):
+        '''Record the current state of (site, question) pairs.'''
+        with self._lock:
+            for site, question in questions:
+                key = (site, question['question_id'])
+                self._states.pop(key, None)
+                self._states[key] = question_state(question)
+
+            while len(self._states) > self.max_size:
+                self._states.popitem(last=False)
+
+    def save(self):
+        if self.path is None:
+            return
+
+        with self._lock:
+            states = [[site, question_id, state] for (site, question_id), state
+                      in self._states.items()]
+
+        utils.atomic_write(self.path, json.dumps(states))
@@ -0,0 +1,182 @@
+'''
+Backfills questions from a stretch of the past.
+
+Rather than one search crawling forward from a far off `starting_since`, the
+range is cut into windows of `window` seconds, searched with fromdate and
+todate, several at a time. Each window's questions go through the usual
+dedup and enqueue path, and once they're sent the window is recorded as
+done, so an interrupted backfill picks up where it stopped. Fetching stops
+before the day's quota drops below `quota_reserve`, leaving the rest for
+live slurping; run it again after the reset to carry on.
+
+>>> Backfill(StackSlurp(config), parse_time("2013-06-01"),
+...          parse_time("2014-01-01"), state_file="backfill.json").run()
+'''
+
+import calendar
+import json
+import logging
+import os
+import time
+from collections import namedtuple
+from datetime import datetime
+from multiprocessing.pool import ThreadPool
+
+from . import utils
+from .stackexchange import StackExchange
+
+logger = logging.getLogger(__name__)
+
+# One site's questions created from `start` up to, not including, `end`
+Window = namedtuple("Window", ["site", "start", "end"])
+
+
+def parse_time(value):
+    '''Seconds since the epoch, from seconds, a date (2014-01-05) or an ISO
+    8601 timestamp.
+
+    >>> parse_time("2014-01-05")
+    1388880000
+    '''
+    value = str(value)
+
+    if value.isdigit():
+        return int(value)
+
+    try:
+        return calendar.timegm(datetime.strptime(value, "%Y-%m-%d")
+                               .timetuple())
+    except ValueError:
+        return utils.parse_iso8601(value)
+
+
+def split_windows(start, end, window):
+    '''Cut [start, end) into (start, end) windows. Boundaries fall on
+    multiples of `window`, so backfills over overlapping ranges share them.
+
+    >>> split_windows(100, 350, 100)
+    [(100, 200), (200, 300), (300, 350)]
+    '''
+    windows = []
+
+    edge = start - start % window
+    while edge < end:
+        windows.append((max(edge, start), min(edge + window, end)))
+        edge += window
+
+    return windows
+
+
+class BackfillState(object):
+    '''The windows done so far, per site and tag query, in a JSON file.'''
+
+    def __init__(self, path=None):
+        self.path = path
+
+        # site -> tag query -> [[start, end], ...]
+        self.done = {}
+
+        if path is not None and os.path.exists(path):
+            with open(path) as fh:
+                self.done = json.load(fh)
+
+    def is_done(self, site, query, start, end):
+        return any(done_start <= start and end <= done_end for
+                   done_start, done_end in
+                   self.done.get(site, {}).get(query, []))
+
+    def complete(self, site, query, start, end):
+        self.done.setdefault(site, {}).setdefault(query, []).append(
+            [start, end])
+
+        if self.path is not None:
+            utils.atomic_write(self.path, json.dumps(self.done))
+
+
+class Backfill(object):
+    '''Backfills `slurper`'s sites from `start` up to `end`.'''
+
+    def __init__(self, slurper, start, end, window=86400, parallel=4,
+                 state_file=None, quota_reserve=1000):
+        self.slurper = slurper
+        self.start = start
+        self.end = end
+        self.window = window
+        self.parallel = parallel
+        self.quota_reserve = quota_reserve
+
+        self.state = BackfillState(state_file)
+
+    def windows(self):
+        '''The windows still to do.'''
+        return [Window(site, start, end)
+                for site in self.slurper.config['sites']
+                for start, end in split_windows(self.start, self.end,
+                                                self.window)
+                if not self.state.is_done(site, self.slurper.query, start,
+                                          end)]
+
+    def quota_low(self):
+        remaining = StackExchange.scheduler.remaining()
+        return remaining is not None and remaining <= self.quota_reserve
+
+    def fetch(self, window):
+        '''All of a window's questions, or None if it was skipped or failed.
+        '''
+        if self.quota_low():
+            return window, None
+
+        try:
+            # todate is inclusive
+            questions = list(self.slurper.search(window.site, window.start,
+                                                 todate=window.end - 1))
+        except Exception:
+            logger.exception("Backfilling {} from {} to {} failed".format(
+                             *window))
+            return window, None
+
+        return window, questions
+
+    def run(self):
+        '''Fetch and send every window not yet done. Returns how many are
+        left, for next time.
+        '''
+        windows = self.windows()
+        left = len(windows)
+
+        logger.info("Backfilling {} windows over {} sites, {} at a "
+                    "time".format(left, len(self.slurper.config['sites']),
+                                  self.parallel))
+
+        started = time.time()
+        sent = self.slurper.sent
+
+        pool = ThreadPool(self.parallel)
+        try:
+            # A few windows at a time, so fetching doesn't race ahead of
+            # sending and pile questions up in memory
+            for batch in utils.chunks(windows, self.parallel):
+                for window, questions in pool.imap_unordered(self.fetch,
+                                                             batch):
+                    if questions is None:
+                        continue
+
+                    self.slurper.send_questions((window.site, question)
+                                                for question in questions)
+                    self.state.complete(window.site, self.slurper.query,
+                                        window.start, window.end)
+                    left -= 1
+
+                if self.quota_low():
+                    logger.warning("Quota down to {}, stopping the "
+                                   "backfill".format(
+                                   StackExchange.scheduler.remaining()))
+                    break
+        finally:
+            pool.close()
+            pool.join()
+
+        logger.info("Backfill sent {} events in {:.0f}s, {} windows "
+                    "left".format(self.slurper.sent - sent,
+                                  time.time() - started, left))
+        return left
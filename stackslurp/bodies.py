@@ -0,0 +1,122 @@
+'''
+Adds question bodies to questions found by searching.
+
+Searches leave bodies out, and asking for each question's body on its own
+would eat the quota. Instead new questions are held back per site until 100
+of them, or until that site's search is done, and their bodies fetched in
+one call to /questions/{ids}. Bodies are cached by (site, question_id,
+last_edit_date), so a question that turns up again isn't fetched again
+unless it's been edited.
+
+>>> enricher = BodyEnricher(lambda site, ids: StackExchange.get_questions(
+...     ids, site))
+>>> for site, question in enricher.enrich(site_questions):
+...     print question.get("body")
+'''
+
+import logging
+import threading
+from collections import OrderedDict
+
+from . import utils
+
+logger = logging.getLogger(__name__)
+
+
+def body_key(site, question):
+    return (site, question['question_id'], question.get('last_edit_date'))
+
+
+class BodyCache(object):
+    '''A least recently used map of question keys to bodies, capped at
+    `max_size`.
+    '''
+
+    def __init__(self, max_size=1000):
+        self.max_size = max_size
+
+        self.hits = 0
+        self.misses = 0
+
+        self._bodies = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._bodies)
+
+    def get(self, key):
+        with self._lock:
+            body = self._bodies.pop(key, None)
+            if body is None:
+                self.misses += 1
+                return None
+
+            self.hits += 1
+            self._bodies[key] = body
+            return body
+
+    def add(self, key, body):
+        with self._lock:
+            self._bodies.pop(key, None)
+            self._bodies[key] = body
+
+            while len(self._bodies) > self.max_size:
+                self._bodies.popitem(last=False)
+
+
+class BodyEnricher(object):
+    '''Fills in the `body` of (site, question) pairs, using `fetch(site,
+    ids)` to get questions with bodies `batch_size` at a time.
+    '''
+
+    def __init__(self, fetch, max_size=1000, batch_size=100):
+        self.fetch = fetch
+        self.batch_size = batch_size
+        self.cache = BodyCache(max_size)
+
+        # Calls to `fetch`, and bodies they brought back
+        self.calls = 0
+        self.fetched = 0
+
+    def enrich(self, site_questions):
+        '''Generate the (site, question) pairs with bodies added. Questions
+        keep their order within each site.
+        '''
+        for site, batch in utils.site_batches(site_questions, self.batch_size):
+            if batch is utils.SITE_DONE:
+                yield site, batch
+                continue
+
+            for item in self._fill(site, batch):
+                yield item
+
+    def _fill(self, site, questions):
+        bodies = {}
+        missing = []
+
+        for question in questions:
+            body = self.cache.get(body_key(site, question))
+            if body is None:
+                missing.append(question['question_id'])
+            else:
+                bodies[question['question_id']] = body
+
+        if missing:
+            try:
+                self.calls += 1
+                for fetched in self.fetch(site, missing):
+                    if fetched.get('body') is not None:
+                        bodies[fetched['question_id']] = fetched['body']
+                        self.fetched += 1
+            except Exception:
+                # Better the questions without their bodies than not at all
+                logger.exception("Fetching {} bodies from {} failed".format(
+                                 len(missing), site))
+
+        for question in questions:
+            body = bodies.get(question['question_id'])
+            if body is not None:
+                # Keyed as searched, so the next sighting matches
+                self.cache.add(body_key(site, question), body)
+                question = dict(question, body=body)
+            yield site, question
@@ -0,0 +1,232 @@
+'''
+Records StackExchange and CloudQueues traffic to a cassette, and plays it
+back.
+
+A RecordingSession stands in for the slurper's HTTP session, passing every
+call through and writing StackExchange responses and the messages posted to
+CloudQueues to a gzipped file of JSON lines, each stamped with when it
+happened. Neither API keys nor tokens are written, so identity calls are
+left out altogether.
+
+A ReplaySession serves those responses back, offline and without spending
+any quota, either at their original pace or as fast as they can be asked
+for. Messages posted during a replay are kept in `enqueued` rather than
+sent anywhere.
+
+>>> session = RecordingSession(sessions.make_session(), "traffic.jsonl.gz")
+>>> replay = ReplaySession("traffic.jsonl.gz", speed=0)
+'''
+
+import collections
+import gzip
+import json
+import logging
+import threading
+import time
+from urlparse import urlparse
+
+import requests
+
+logger = logging.getLogger(__name__)
+
+CASSETTE_VERSION = 1
+
+# Params that change from run to run, or that mustn't be written down
+IGNORED_PARAMS = frozenset(["key", "fromdate", "todate", "min", "max"])
+
+
+class CassetteMiss(Exception):
+    '''A request came in that the cassette has no (more) responses for.'''
+
+
+def request_key(method, url, params=None):
+    '''What a request is matched on when replaying.'''
+    params = dict((k, unicode(v)) for k, v in (params or {}).items()
+                  if k not in IGNORED_PARAMS)
+    return json.dumps([method, url, sorted(params.items())])
+
+
+def _kind(url):
+    path = urlparse(url).path
+    if path.endswith("/tokens"):
+        return "identity"
+    if path.endswith("/messages"):
+        return "enqueue"
+    return "api"
+
+
+class RecordingSession(object):
+    '''Wraps `session`, writing what it sees to the cassette at `path`.
+
+    Entries are flushed every `flush_every` calls, and by `close`.
+    '''
+
+    def __init__(self, session, path, flush_every=100):
+        self.session = session
+        self.path = path
+        self.flush_every = flush_every
+
+        self.started = time.time()
+        self.recorded = 0
+
+        self._lock = threading.Lock()
+        self._fh = gzip.open(path, "wb")
+        self._write({"version": CASSETTE_VERSION, "started": self.started})
+
+        logger.info("Recording traffic to {}".format(path))
+
+    def __getattr__(self, name):
+        # Anything else (mount, headers, ...) goes to the real session
+        return getattr(self.session, name)
+
+    def _write(self, entry):
+        with self._lock:
+            self._fh.write(json.dumps(entry) + "\n")
+            self.recorded += 1
+            if self.recorded % self.flush_every == 0:
+                self._fh.flush()
+
+    def get(self, url, params=None, **kwargs):
+        started = time.time()
+        resp = self.session.get(url, params=params, **kwargs)
+
+        if _kind(url) == "api":
+            self._write({"t": round(started - self.started, 3),
+                         "method": "GET", "url": url,
+                         "params": dict((k, unicode(v)) for k, v in
+                                        (params or {}).items()
+                                        if k != "key"),
+                         "status": resp.status_code,
+                         "body": resp.text})
+        return resp
+
+    def post(self, url, data=None, **kwargs):
+        started = time.time()
+        resp = self.session.post(url, data=data, **kwargs)
+
+        if _kind(url) == "enqueue":
+            self._write({"t": round(started - self.started, 3),
+                         "method": "POST", "url": url,
+                         "status": resp.status_code,
+                         "data": data})
+        return resp
+
+    def close(self):
+        with self._lock:
+            self._fh.close()
+
+
+def _response(url, status, body):
+    resp = requests.Response()
+    resp.url = url
+    resp.status_code = status
+    resp.reason = "Replayed"
+    resp.encoding = "utf-8"
+    resp._content = body.encode("utf-8")
+    return resp
+
+
+class ReplaySession(object):
+    '''Answers requests from the cassette at `path`.
+
+    With a `speed` of 1, each response waits until as long after the first
+    request as it originally came after the recording started; 2 is twice
+    as fast, and 0 doesn't wait at all. Responses to the same request come
+    back in the order they were recorded.
+    '''
+
+    def __init__(self, path, speed=1.0):
+        self.path = path
+        self.speed = speed
+
+        self._responses = collections.defaultdict(collections.deque)
+        self.recorded_enqueues = []
+
+        with gzip.open(path, "rb") as fh:
+            header = json.loads(fh.readline())
+            if header.get("version") != CASSETTE_VERSION:
+                raise ValueError("{} is a version {} cassette, expected "
+                                 "{}".format(path, header.get("version"),
+                                             CASSETTE_VERSION))
+
+            try:
+                for line in fh:
+                    if not line.endswith("\n"):
+                        break
+                    entry = json.loads(line)
+                    if entry["method"] == "GET":
+                        key = request_key("GET", entry["url"], entry["params"])
+                        self._responses[key].append(entry)
+                    else:
+                        self.recorded_enqueues.append(entry)
+            except (IOError, EOFError) as e:
+                # The recording was cut off, play what there is of it
+                logger.warning("{} is truncated ({}), replaying what it "
+                               "has".format(path, e))
+
+        self.remaining = sum(len(queue) for queue in self._responses.values())
+        self.served = 0
+
+        # Messages posted while replaying
+        self.enqueued = []
+
+        self.started = None
+        self._lock = threading.Lock()
+
+        logger.info("Replaying {} responses from {}".format(self.remaining,
+                                                            path))
+
+    @property
+    def exhausted(self):
+        return self.remaining == 0
+
+    def _wait(self, offset):
+        with self._lock:
+            if self.started is None:
+                self.started = time.time()
+
+        if self.speed:
+            delay = self.started + offset / self.speed - time.time()
+            if delay > 0:
+                time.sleep(delay)
+
+    def get(self, url, params=None, **kwargs):
+        key = request_key("GET", url, params)
+
+        with self._lock:
+            queue = self._responses.get(key)
+            if not queue:
+                raise CassetteMiss("Nothing recorded for GET {} {}".format(
+                                   url, params))
+            entry = queue.popleft()
+            self.remaining -= 1
+
+        self._wait(entry["t"])
+
+        with self._lock:
+            self.served += 1
+
+        return _response(url, entry["status"], entry["body"])
+
+    def post(self, url, data=None, **kwargs):
+        kind = _kind(url)
+
+        if kind == "identity":
+            # Good for as long as any replay could take
+            body = {"access": {"token": {"id": "replayed",
+                                         "expires": "2100-01-01T00:00:00Z"}}}
+            return _response(url, 200, json.dumps(body))
+
+        if kind != "enqueue":
+            raise CassetteMiss("Nothing recorded for POST {}".format(url))
+
+        messages = json.loads(data)
+        with self._lock:
+            self.enqueued.extend(messages)
+
+        body = {"partial": False,
+                "resources": [urlparse(url).path + "/replayed"] * len(messages)}
+        return _response(url, 201, json.dumps(body))
+
+    def close(self):
+        pass
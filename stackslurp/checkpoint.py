@@ -0,0 +1,83 @@
+'''
+Crash-safe high-water marks, so a restarted slurper picks up where the last
+one left off instead of going back to `starting_since`.
+
+Marks are kept per (site, tag query) and only ever move forward.
+
+>>> store = CheckpointStore("checkpoints.json")
+>>> store.get("stackoverflow", "python", default=1388594252)
+1388594252
+>>> store.update({("stackoverflow", "python"): 1388784323})
+>>> store.get("stackoverflow", "python")
+1388784323
+'''
+
+import fcntl
+import json
+import logging
+import os
+
+from . import utils
+
+logger = logging.getLogger(__name__)
+
+
+class CheckpointStore(object):
+    '''High-water marks per (site, tag query), saved to a JSON file.
+
+    Several processes can share the file, each looking after its own sites:
+    saving merges with what's on disk under a lock rather than overwriting
+    it. Without a `path` the marks only live as long as the process.
+    '''
+
+    def __init__(self, path=None):
+        self.path = path
+
+        # site -> tag query -> mark
+        self.marks = {}
+
+        if path is not None and os.path.exists(path):
+            with open(path) as fh:
+                self.marks = json.load(fh)
+            logger.info("Resuming from checkpoints in {}".format(path))
+
+    def get(self, site, query, default=None):
+        return self.marks.get(site, {}).get(query, default)
+
+    def update(self, marks):
+        '''Advance the marks in `marks`, a dict of (site, query) to mark, and
+        save. Marks never move backwards.
+        '''
+        changed = False
+
+        for (site, query), mark in marks.items():
+            current = self.get(site, query)
+            if current is None or mark > current:
+                self.marks.setdefault(site, {})[query] = mark
+                changed = True
+
+        if changed:
+            self.save()
+
+    def save(self):
+        if self.path is None:
+            return
+
+        with open(self.path + ".lock", "a") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+
+            try:
+                # Keep whatever other processes have moved on since we loaded
+                if os.path.exists(self.path):
+                    with open(self.path) as fh:
+                        on_disk = json.load(fh)
+
+                    for site, queries in on_disk.items():
+                        for query, mark in queries.items():
+                            if mark > self.get(site, query, mark - 1):
+                                self.marks.setdefault(site, {})[query] = mark
+
+                utils.atomic_write(self.path, json.dumps(self.marks, indent=2,
+                                                         sort_keys=True))
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
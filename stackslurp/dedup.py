@@ -0,0 +1,81 @@
+'''
+Remembers which questions have already been sent, so overlapping search
+windows and retries don't enqueue the same question twice.
+
+Entries are keyed by (site, question_id, last_activity_date), so a question
+that has changed since we last sent it gets through again.
+
+>>> index = SeenIndex(max_size=2)
+>>> index.seen(("stackoverflow", 20912948, 1388784322))
+False
+>>> index.add([("stackoverflow", 20912948, 1388784322)])
+>>> index.seen(("stackoverflow", 20912948, 1388784322))
+True
+'''
+
+import json
+import logging
+import os
+import threading
+from collections import OrderedDict
+
+from . import utils
+
+logger = logging.getLogger(__name__)
+
+
+class SeenIndex(object):
+    '''A least recently used set of question keys, capped at `max_size`.
+
+    With a `path`, the index is saved there by `save` and read back on
+    startup.
+    '''
+
+    def __init__(self, max_size=10000, path=None):
+        self.max_size = max_size
+        self.path = path
+
+        self.hits = 0
+        self.misses = 0
+
+        self._seen = OrderedDict()
+        self._lock = threading.Lock()
+
+        if path is not None and os.path.exists(path):
+            with open(path) as fh:
+                self.add(tuple(key) for key in json.load(fh))
+            logger.info("Loaded {} seen questions from {}".format(len(self),
+                                                                   path))
+
+    def __len__(self):
+        return len(self._seen)
+
+    def seen(self, key):
+        '''Whether `key` has been added, counting it as a hit or miss.'''
+        with self._lock:
+            if key in self._seen:
+                # Bump it back to most recently used
+                self._seen[key] = self._seen.pop(key)
+                self.hits += 1
+                return True
+
+            self.misses += 1
+            return False
+
+    def add(self, keys):
+        with self._lock:
+            for key in keys:
+                self._seen.pop(key, None)
+                self._seen[key] = True
+
+            while len(self._seen) > self.max_size:
+                self._seen.popitem(last=False)
+
+    def save(self):
+        if self.path is None:
+            return
+
+        with self._lock:
+            keys = list(self._seen)
+
+        utils.atomic_write(self.path, json.dumps(keys))
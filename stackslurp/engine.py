@@ -0,0 +1,128 @@
+'''
+Runs slurpers side by side in one process.
+
+`Slurper.go` blocks on one cycle at a time and then on `time.sleep`, so a
+process can only ever serve one slurper. AsyncSlurper gives each slurper its
+own cycle, keeps Rackspace tokens fresh from a background timer, and sleeps
+on an event that `stop` can interrupt, so shutting down doesn't mean waiting
+out `wait_time`.
+
+This is built on threads rather than an asyncio event loop, since stackslurp
+runs on Python 2 and the HTTP calls block either way.
+
+>>> engine = AsyncSlurper([StackSlurp(config), StackSlurp(other_config)])
+>>> engine.run()
+'''
+
+import logging
+import signal
+import threading
+
+logger = logging.getLogger(__name__)
+
+
+class AsyncSlurper(object):
+    '''Drives any number of slurpers concurrently.
+
+    Slurpers need `run_cycle` and `cycle_wait`, as on `main.Slurper`; they
+    keep their own `generate_events`/`send_events`.
+    '''
+
+    def __init__(self, slurpers, token_refresh_interval=60):
+        self.slurpers = list(slurpers)
+
+        # How often to check in on Rackspace tokens. Checks are cheap; the
+        # token is only fetched again when close to expiring.
+        self.token_refresh_interval = token_refresh_interval
+
+        self._stopping = threading.Event()
+        self._threads = []
+
+    def start(self):
+        for n, slurper in enumerate(self.slurpers):
+            self._spawn(self._cycle, "slurper-{}".format(n), slurper)
+
+        if any(getattr(slurper, "rack", None) is not None
+               for slurper in self.slurpers):
+            self._spawn(self._refresh_tokens, "token-refresh")
+
+    def _spawn(self, target, name, *args):
+        thread = threading.Thread(target=target, name=name, args=args)
+        thread.daemon = True
+        thread.start()
+        self._threads.append(thread)
+
+    def _cycle(self, slurper):
+        while not self._stopping.is_set():
+            slurper.run_cycle()
+
+            wait_time = slurper.cycle_wait()
+            logger.info("Sleeping for {}s".format(wait_time))
+            self._stopping.wait(wait_time)
+
+    def _refresh_tokens(self):
+        while not self._stopping.wait(self.token_refresh_interval):
+            for slurper in self.slurpers:
+                rack = getattr(slurper, "rack", None)
+                if rack is None:
+                    continue
+
+                try:
+                    rack.auth()
+                except Exception:
+                    logger.exception("Token refresh failed")
+
+    @property
+    def running(self):
+        return any(thread.is_alive() for thread in self._threads)
+
+    def stop(self, graceful=True, timeout=None):
+        '''Stop starting new cycles and wait up to `timeout` seconds for the
+        ones underway.
+
+        A graceful stop lets cycles finish sending, so their checkpoints are
+        kept. Otherwise they're cancelled at the next batch and picked up
+        again from the last checkpoint on restart.
+
+        Returns True once everything has stopped.
+        '''
+        self._stopping.set()
+
+        if not graceful:
+            for slurper in self.slurpers:
+                cancelled = getattr(slurper, "cancelled", None)
+                if cancelled is not None:
+                    cancelled.set()
+
+        for thread in self._threads:
+            thread.join(timeout)
+
+        return not self.running
+
+    def run(self):
+        '''Start, then block until SIGTERM or SIGINT and shut down gracefully.
+        A second signal cancels whatever is still being sent.
+        '''
+        def handle(signum, frame):
+            graceful = not self._stopping.is_set()
+            logger.info("Got signal {}, {}".format(signum,
+                        "stopping" if graceful else "cancelling"))
+
+            self._stopping.set()
+            if not graceful:
+                self.stop(graceful=False, timeout=0)
+
+        signal.signal(signal.SIGTERM, handle)
+        signal.signal(signal.SIGINT, handle)
+
+        self.start()
+
+        # Wait with a timeout, as an untimed wait holds off signals
+        while not self._stopping.wait(1):
+            pass
+
+        # Likewise for the joins, so a second signal can still cancel
+        while not self.stop(timeout=1):
+            pass
+
+        logger.info("Stopped")
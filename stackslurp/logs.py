@@ -0,0 +1,204 @@
+'''
+Logging helpers.
+
+Python 2's logging has no QueueHandler, which we need to get log records out
+of worker processes and back to the parent, nor a QueueListener to write
+them from a thread of their own.
+
+`configure` sets the slurper's logging up that way: records are put on a
+queue, and formatted (as text or as JSON lines) and written by a background
+thread, so slow disks and big payloads stay off the fetch and send path.
+Records logged with `extra={"sampled": True}`, such as one per event, only
+get through `sample_rate` of the time. Anything bulky goes in
+`extra={"payload": ...}`, which is only rendered by the background thread,
+and only if the record makes it that far.
+
+>>> listener = configure(level="INFO", format="json", sample_rate=0.01)
+>>> logger.debug("Event %s", event["origin_id"],
+...              extra={"payload": event, "sampled": True})
+>>> listener.stop()
+'''
+
+import json
+import logging
+import Queue
+import random
+import threading
+
+from . import metrics
+
+logger = logging.getLogger(__name__)
+
+records_dropped = metrics.counter("stackslurp_log_records_dropped_total",
+                                  "Log records dropped with the log queue "
+                                  "full")
+
+
+class QueueHandler(logging.Handler):
+    '''Puts log records on a queue, e.g. a multiprocessing.Queue, for another
+    process or thread to handle with `handle_record`.
+    '''
+
+    def __init__(self, queue):
+        logging.Handler.__init__(self)
+        self.queue = queue
+
+    def prepare(self, record):
+        # Bake the message and any traceback in, leaving the record picklable
+        record.msg = self.format(record)
+        record.args = None
+        record.exc_info = None
+        record.exc_text = None
+        return record
+
+    def emit(self, record):
+        try:
+            self.queue.put_nowait(self.prepare(record))
+        except Exception:
+            self.handleError(record)
+
+
+class ThreadQueueHandler(QueueHandler):
+    '''A QueueHandler for a QueueListener in the same process. Records go on
+    the queue as they are, to be formatted by the listener's thread, and are
+    dropped rather than waited on if the queue is full.
+    '''
+
+    def prepare(self, record):
+        return record
+
+    def emit(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except Queue.Full:
+            records_dropped.inc()
+
+
+class QueueListener(object):
+    '''Hands records from a queue to `handlers`, from a background thread.'''
+
+    _stop = None
+
+    def __init__(self, queue, *handlers):
+        self.queue = queue
+        self.handlers = handlers
+        self.thread = None
+
+        # (logger, handler) feeding the queue, taken off when stopping
+        self.attached = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self._run, name="log-listener")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _run(self):
+        while True:
+            record = self.queue.get()
+            if record is self._stop:
+                return
+
+            for handler in self.handlers:
+                if record.levelno >= handler.level:
+                    handler.handle(record)
+
+    def stop(self):
+        '''Write out whatever is still queued, then stop.'''
+        if self.attached is not None:
+            source, handler = self.attached
+            source.removeHandler(handler)
+
+        self.queue.put(self._stop)
+        self.thread.join()
+
+        for handler in self.handlers:
+            handler.flush()
+
+
+class SampleFilter(logging.Filter):
+    '''Lets through `rate` of the records marked `sampled`, and all the
+    rest. A record is only sampled once, however many handlers it passes.
+    '''
+
+    def __init__(self, rate=1.0):
+        logging.Filter.__init__(self)
+        self.rate = rate
+
+    def filter(self, record):
+        if not getattr(record, "sampled", False):
+            return True
+
+        record.sampled = False
+        return self.rate >= 1 or random.random() < self.rate
+
+
+class TextFormatter(logging.Formatter):
+    '''The usual text, with any payload after the message.'''
+
+    def format(self, record):
+        text = logging.Formatter.format(self, record)
+
+        payload = getattr(record, "payload", None)
+        if payload is not None:
+            text += " " + repr(payload)
+
+        return text
+
+
+class JsonFormatter(logging.Formatter):
+    '''One JSON object per record.'''
+
+    def format(self, record):
+        entry = {
+            "time": round(record.created, 3),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+            "process": record.process,
+            "thread": record.threadName,
+        }
+
+        payload = getattr(record, "payload", None)
+        if payload is not None:
+            entry["payload"] = payload
+
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+
+        return json.dumps(entry, default=repr)
+
+
+def configure(level="DEBUG", format="text", file=None, sample_rate=1.0,
+              queue_size=10000):
+    '''Send this process's logging through a queue to a background thread
+    writing `format` ("text" or "json") to `file`, or stderr. Returns the
+    QueueListener; stop it to flush what's left before exiting.
+    '''
+    if file is None:
+        handler = logging.StreamHandler()
+    else:
+        handler = logging.FileHandler(file)
+
+    if format == "json":
+        handler.setFormatter(JsonFormatter())
+    else:
+        handler.setFormatter(TextFormatter(logging.BASIC_FORMAT))
+
+    records = Queue.Queue(queue_size)
+    listener = QueueListener(records, handler)
+    listener.start()
+
+    queue_handler = ThreadQueueHandler(records)
+    queue_handler.addFilter(SampleFilter(sample_rate))
+
+    root = logging.getLogger()
+    root.setLevel(getattr(logging, str(level).upper()))
+    root.addHandler(queue_handler)
+
+    listener.attached = (root, queue_handler)
+    return listener
+
+
+def handle_record(record):
+    '''Hand a record from a QueueHandler to this process's own handlers.'''
+    logging.getLogger(record.name).handle(record)
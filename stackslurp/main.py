@@ -8,21 +8,62 @@ CloudQueues.
 
 
 import abc
+import argparse
+import copy
+import sys
 import time
 from datetime import datetime, timedelta
 import calendar
 import logging
+import threading
+import Queue
+from multiprocessing.pool import ThreadPool
 
 import yaml
 
-from .stackexchange import StackExchange
+from .stackexchange import StackExchange, QueryPlanner
+from .checkpoint import CheckpointStore
+from .dedup import SeenIndex
+from .activity import QuestionStates
+from .bodies import BodyEnricher
+from .users import UserAnnotator, UserCache
 from . import utils
-from .rackspace import Rackspace
+from . import sessions
+from . import retry
+from . import metrics
+from . import logs
+from .rackspace import Rackspace, EnqueueError, MAX_POST_BYTES
+from .outbox import Outbox
+from .sinks import CloudQueuesSink, make_sink
+from .cassette import RecordingSession, ReplaySession
+from .backfill import Backfill, parse_time
+from .engine import AsyncSlurper
+from .workers import WorkerPool
 
 from . import __version__
 
 logger = logging.getLogger(__name__)
 
+cycle_seconds = metrics.histogram("stackslurp_cycle_seconds",
+                                  "Time taken by each cycle",
+                                  buckets=(1, 5, 15, 30, 60, 120, 300, 600))
+enqueue_lag = metrics.histogram("stackslurp_enqueue_lag_seconds",
+                                "Seconds from a question being asked to its "
+                                "event being enqueued",
+                                buckets=(10, 30, 60, 120, 300, 600, 1800,
+                                         3600, 7200, 21600, 86400))
+questions_fetched = metrics.counter("stackslurp_questions_fetched_total",
+                                    "Questions fetched from StackExchange",
+                                    ["site"])
+events_built = metrics.counter("stackslurp_events_built_total",
+                               "Events built, new questions or updates",
+                               ["kind"])
+
+
+class Cancelled(Exception):
+    '''The cycle underway was cancelled before it finished sending.'''
+
+
 def read_config(config_file):
         '''Reads in a configuration file for stackslurp, intended for
         stackslurp's console entrypoint/main
@@ -50,15 +91,186 @@ def read_config(config_file):
 
         config.setdefault('ttl', 86400)
 
+        # Connection pooling, passed straight on to sessions.make_session
+        config.setdefault('http', {})
+
+        # How many sites to query at once
+        config.setdefault('max_concurrency', 1)
+
+        # Questions fetched ahead of sending
+        config.setdefault('pipeline_buffer', 500)
+
+        # Question fields to keep in each event's `extra`, all if not set
+        config.setdefault('extra_fields', None)
+
+        # StackExchange filter id, or a dict of include/exclude/base to
+        # create one from
+        config.setdefault('stackexchange_filter', None)
+
+        # "all" wants every tag on a question, "any" just one of them
+        config.setdefault('tag_mode', 'all')
+
+        # "sync" runs Slurper.go, "async" runs engine.AsyncSlurper
+        config.setdefault('engine', 'sync')
+
+        # Worker processes to spread the sites over
+        config.setdefault('workers', 1)
+
+        # Messages per post to CloudQueues, and posts going at once
+        config.setdefault('batch_size', 10)
+        config.setdefault('max_in_flight', 1)
+
+        # Bytes per post to CloudQueues, messages and all
+        config.setdefault('batch_bytes', MAX_POST_BYTES)
+
+        # Where to keep high-water marks between restarts, if anywhere
+        config.setdefault('checkpoint_file', None)
+
+        # Questions already sent, to skip duplicates (see dedup.SeenIndex)
+        dedup = config.setdefault('dedup', {})
+        dedup.setdefault('max_size', 10000)
+        dedup.setdefault('file', None)
+
+        # Also poll for answers to questions already sent (see
+        # activity.QuestionStates)
+        activity = config.setdefault('activity', {})
+        activity.setdefault('enabled', False)
+        activity.setdefault('max_size', 10000)
+        activity.setdefault('file', None)
+
+        # Where to keep events until CloudQueues has them (see outbox.Outbox)
+        outbox = config.setdefault('outbox', {})
+        outbox.setdefault('directory', None)
+        outbox.setdefault('segment_size', 1000)
+
+        # Retries for failed HTTP calls (see retry.DEFAULTS)
+        config.setdefault('retry', {})
+
+        # Where to expose metrics, if anywhere (see metrics.start)
+        metrics_config = config.setdefault('metrics', {})
+        metrics_config.setdefault('port', None)
+        metrics_config.setdefault('host', '127.0.0.1')
+        metrics_config.setdefault('statsd', None)
+        metrics_config.setdefault('prefix', 'stackslurp')
+
+        # Where and how to log (see logs.configure). Per event debug
+        # records are kept `sample_rate` of the time.
+        logging_config = config.setdefault('logging', {})
+        logging_config.setdefault('level', 'DEBUG')
+        logging_config.setdefault('format', 'text')
+        logging_config.setdefault('file', None)
+        logging_config.setdefault('sample_rate', 1.0)
+        logging_config.setdefault('queue_size', 10000)
+
+        # Fetch question bodies for new questions (see bodies.py)
+        bodies = config.setdefault('bodies', {})
+        bodies.setdefault('enabled', False)
+        bodies.setdefault('max_size', 1000)
+        bodies.setdefault('filter', 'withbody')
+
+        # Look up askers' reputation and whether they're one of us (see
+        # users.py)
+        users = config.setdefault('users', {})
+        users.setdefault('enabled', False)
+        users.setdefault('ttl', 86400)
+        users.setdefault('max_size', 10000)
+        users.setdefault('file', None)
+        users.setdefault('internal_accounts', [])
+
+        # Where events go: "cloudqueues", or "file" or "stdout" (see
+        # sinks.py)
+        sink = config.setdefault('sink', {})
+        sink.setdefault('type', 'cloudqueues')
+        sink.setdefault('directory', None)
+        sink.setdefault('max_batch', None)
+
+        # Record traffic to a cassette, or replay one (see cassette.py)
+        cassette = config.setdefault('cassette', {})
+        cassette.setdefault('record', None)
+        cassette.setdefault('replay', None)
+        cassette.setdefault('speed', 1.0)
+
+        # `slurp backfill` (see backfill.Backfill)
+        backfill = config.setdefault('backfill', {})
+        backfill.setdefault('window', 86400)
+        backfill.setdefault('parallel', 4)
+        backfill.setdefault('state_file', None)
+        backfill.setdefault('quota_reserve', 1000)
+
         return config
 
+def replay_config(config):
+    '''The config for replaying a cassette. Checkpoints, seen questions,
+    question states, the outbox and users are kept in memory, so a replay
+    starts from nothing and leaves the live slurper's files alone.
+    '''
+    config = copy.deepcopy(config)
+    config['checkpoint_file'] = None
+
+    for section, key in (('dedup', 'file'), ('activity', 'file'),
+                         ('outbox', 'directory'), ('users', 'file'),
+                         ('cassette', 'record')):
+        settings = config.get(section)
+        if settings:
+            settings[key] = None
+
+    return config
+
 class Slurper(object):
     __metaclass__ = abc.ABCMeta
 
     def __init__(self, slurpconfig):
+        if slurpconfig.get('cassette', {}).get('replay'):
+            slurpconfig = replay_config(slurpconfig)
         self.config = slurpconfig
-        self.rack = Rackspace(self.config['rackspace']['username'],
-                self.config['rackspace']['api_key'])
+
+        # One pooled session for every HTTP call this slurper makes
+        self.session = sessions.make_session(**self.config.get('http', {}))
+
+        cassette = self.config.get('cassette', {})
+        if cassette.get('replay'):
+            self.session = ReplaySession(cassette['replay'],
+                                         cassette.get('speed', 1.0))
+        elif cassette.get('record'):
+            self.session = RecordingSession(self.session, cassette['record'])
+
+        # Where events go, CloudQueues unless configured otherwise
+        sink = self.config.get('sink', {})
+        if sink.get('type', 'cloudqueues') == 'cloudqueues':
+            rack = Rackspace(self.config['rackspace']['username'],
+                    self.config['rackspace']['api_key'],
+                    session=self.session)
+            self.sink = CloudQueuesSink(rack, self.config['queue'],
+                    self.config['rackspace']['queue_endpoint'],
+                    self.config['ttl'],
+                    batch_size=self.config.get('batch_size', 10),
+                    max_in_flight=self.config.get('max_in_flight', 1),
+                    max_bytes=self.config.get('batch_bytes', MAX_POST_BYTES))
+        else:
+            self.sink = make_sink(sink)
+
+        # Set to abandon the cycle underway at the next batch
+        self.cancelled = threading.Event()
+
+        # Events not yet taken by CloudQueues, if kept on disk
+        self.outbox = None
+        outbox = self.config.get('outbox', {})
+        if outbox.get('directory'):
+            self.outbox = Outbox(outbox['directory'],
+                                 outbox.get('segment_size', 1000))
+
+        # Events sent, ever, and how the last cycle went
+        self.sent = 0
+        self.cycle_stats = {}
+
+    @property
+    def rack(self):
+        '''The Rackspace posting to CloudQueues, if that's the sink.'''
+        return getattr(self.sink, "rack", None)
+
+    @rack.setter
+    def rack(self, rack):
+        self.sink.rack = rack
 
     @abc.abstractmethod
     def generate_events(self):
@@ -109,48 +321,209 @@ class Slurper(object):
           "extra": {}
         }
 
-        generate_events should return a list of the above dicts.
+        generate_events should return a list of the above dicts, or a
+        generator of them to stream events on to `send_events` as they're
+        built.
 
         '''
         pass
 
     def send_events(self, events):
-        '''A simple utility method to send events on to Rackspace CloudQueues.
-        Events need to be in the peril format shown in `generate_events`
+        '''A simple utility method to send events on to the sink, Rackspace
+        CloudQueues by default. Events need to be in the peril format shown
+        in `generate_events`
+
+        With `max_in_flight` above 1, events posted together may arrive out
+        of order. Raises rackspace.EnqueueError, with per batch results, if
+        any batch fails; nothing after that window is sent.
+
+        With an outbox, each window is written to it and then the outbox is
+        drained. Enqueue failures are logged instead of raised, since the
+        events are safe on disk and go out with a later drain.
         '''
-        # Authenticate with Rackspace
-        # Get a (possibly) new token every time we use this
-        self.rack.auth()
+        if self.outbox is None:
+            self.sink.prepare()
 
-        # Now we're authenticated, time to send on to a queue
-        # Break events up into chunks of 10, per arbitrary queue limit
-        for event_chunk in utils.chunks(events, 10):
-            self.rack.enqueue(event_chunk, self.config['queue'],
-                              self.config['rackspace']['queue_endpoint'],
-                              self.config['ttl'])
+        # Time to send on to the sink, as many as it takes at a time. Events
+        # are pulled as we go, so a generator is consumed as it produces
+        # rather than all up front.
+        draining = True
 
-    def event_loop(self):
         try:
-            events = self.generate_events()
+            for window in utils.chunks(events, self.window_size()):
+                if self.cancelled.is_set():
+                    raise Cancelled("Sending cancelled")
+
+                if self.outbox is None:
+                    self.enqueue(window)
+                    self.sent += len(window)
+                    continue
+
+                self.outbox.append(window)
+
+                # No point hammering CloudQueues once it has failed us
+                if draining:
+                    draining = self.drain_outbox()
+
+            # Everything sent is durable before checkpoints move on
+            self.sink.flush()
+        finally:
+            # Stop a generator's work if we're bailing out early
+            close = getattr(events, "close", None)
+            if close is not None:
+                close()
+
+    def window_size(self):
+        '''Events handed to `enqueue` at a time.'''
+        return self.sink.max_batch
+
+    def enqueue(self, events):
+        '''Write `events` to the sink.'''
+        results = self.sink.write(events)
+
+        now = time.time()
+        for event in events:
+            lag = self.event_lag(event, now)
+            if lag is not None:
+                enqueue_lag.observe(lag)
+
+        return results
+
+    def event_lag(self, event, now):
+        '''Seconds between the incident behind `event` and `now`, or None if
+        it shouldn't count towards the enqueue lag.
+        '''
+        if "incident_date" not in event:
+            return None
+        return now - event["incident_date"]
+
+    def drain_outbox(self):
+        '''Send the events waiting in the outbox, oldest first.
+
+        Returns whether the outbox was emptied. On failure the error is
+        logged and whatever wasn't posted stays for next time.
+        '''
+        try:
+            self.sink.prepare()
+
+            while True:
+                window = self.outbox.peek(self.window_size())
+                if not window:
+                    return True
+
+                try:
+                    self.enqueue(window)
+                except EnqueueError as e:
+                    # Keep what got through, up to the first failed batch
+                    posted = 0
+                    for result in e.results:
+                        if result.error is not None:
+                            break
+                        posted += len(result.messages)
+
+                    self.outbox.ack(posted)
+                    self.sent += posted
+                    raise
+
+                self.sink.flush()
+                self.outbox.ack(len(window))
+                self.sent += len(window)
+        except Exception:
+            logger.exception("Draining the outbox failed, {} events left "
+                             "for later".format(len(self.outbox)))
+            return False
+
+    def checkpoint(self):
+        '''Called once the events from the last `generate_events` have all
+        been sent. Slurpers that track how far they've read should record it
+        here, so nothing is skipped if sending fails.
+        '''
+        pass
+
+    def throttled(self):
+        '''Whether to skip this cycle entirely. Slurpers pulling from rate
+        limited sources can override this.
+        '''
+        return False
+
+    def cycle_wait(self):
+        '''How long to sleep between cycles. Slurpers pulling from rate limited
+        sources can override this to stretch out the wait.
+        '''
+        return self.config['wait_time']
+
+    def run_cycle(self):
+        '''Generate and send one round of events. Errors are logged rather
+        than raised, so the next cycle gets its chance.
+
+        How the cycle went is left in `cycle_stats`.
+        '''
+        started = time.time()
+        sent = self.sent
+        ok = False
+
+        try:
+            events = None
+
+            # Anything left over from an outage, or from before a restart
+            if self.outbox is not None and len(self.outbox):
+                self.drain_outbox()
+
+            if self.throttled():
+                logger.info("Throttled, skipping this cycle")
+            else:
+                events = self.generate_events()
 
         except Exception as e:
             logger.exception("Event generation exception at " +\
                              datetime.utcnow().strftime("%Y-%m-%d %H:%M"))
         else:
             try:
-                self.send_events(events)
+                if events is not None:
+                    self.send_events(events)
+                    self.checkpoint()
+                ok = True
             except Exception as e:
                 logger.exception("Event sending exception at " +\
                                  datetime.utcnow().strftime("%Y-%m-%d %H:%M"))
         finally:
-            logger.info("Sleeping")
-            time.sleep(self.config['wait_time'])
+            self.cycle_stats = {"events": self.sent - sent,
+                                "duration": time.time() - started,
+                                "ok": ok,
+                                "sink": self.sink.stats()}
+            cycle_seconds.observe(self.cycle_stats["duration"])
+
+    def event_loop(self):
+        try:
+            self.run_cycle()
+        finally:
+            wait_time = self.cycle_wait()
+            logger.info("Sleeping for {}s".format(wait_time))
+            time.sleep(wait_time)
             return
 
     def go(self):
         while(True):
             self.event_loop()
 
+    def replay(self):
+        '''Run cycles back to back until the cassette being replayed runs
+        out. The cassette's own timing paces them.
+        '''
+        while not self.session.exhausted:
+            served = self.session.served
+            self.run_cycle()
+
+            if self.session.served == served:
+                logger.warning("Nothing left in the cassette matches what's "
+                               "being asked for, stopping")
+                break
+
+        logger.info("Replayed {} responses, {} messages enqueued ({} "
+                    "posts recorded)".format(self.session.served,
+                    len(self.session.enqueued),
+                    len(self.session.recorded_enqueues)))
+
 
 class StackSlurp(Slurper):
     '''StackSlurp is a Slurper that pulls from StackExchange.'''
@@ -159,69 +532,595 @@ class StackSlurp(Slurper):
         configuration file.
         '''
         super(StackSlurp,self).__init__(slurpconfig)
+
+        # Where to start for any site we don't have a checkpoint for
         self.since = self.config['starting_since']
 
+        self.query = utils.tag_query(self.config['tags'])
+
+        # Matching any tag finds different questions, so it gets its own
+        # checkpoints, and a planner to remember how busy each site is
+        self.planner = None
+        if self.config.get('tag_mode', 'all') == 'any':
+            self.query = "any:" + self.query
+            self.planner = QueryPlanner()
+
+        self.checkpoints = CheckpointStore(self.config.get('checkpoint_file'))
+
+        dedup = self.config.get('dedup', {})
+        self.seen = SeenIndex(dedup.get('max_size', 10000), dedup.get('file'))
+
+        # Activity is read from its own cursor, kept alongside the others
+        activity = self.config.get('activity', {})
+        self.activity = activity.get('enabled', False)
+        self.activity_query = "activity:" + self.query
+        self.states = QuestionStates(activity.get('max_size', 10000),
+                                     activity.get('file'))
+
+        # Question bodies, fetched in bulk for new questions
+        bodies = self.config.get('bodies', {})
+        self.bodies = None
+        if bodies.get('enabled'):
+            self.bodies = BodyEnricher(self.fetch_bodies,
+                                       bodies.get('max_size', 1000))
+
+        # Askers, looked up in bulk and cached
+        users = self.config.get('users', {})
+        self.users = None
+        if users.get('enabled'):
+            self.users = UserAnnotator(self.fetch_users,
+                                       UserCache(users.get('ttl', 86400),
+                                                 users.get('max_size', 10000),
+                                                 users.get('file')),
+                                       users.get('internal_accounts', ()))
+
+        # Marks to advance to, and questions to remember as sent, once the
+        # current events have been sent
+        self.pending_marks = {}
+        self.pending_seen = []
+        self.pending_states = []
+
+        # StackExchange requests made by the last cycle, used for pacing
+        self.calls_per_cycle = 0
+
     def generate_events(self, since=None):
         '''
         Generate events for Peril. This can return between 0 and "a lot" of
         events.
 
-        This will update the value of `since` within StackSlurp (the last time
-        we pulled a question).
+        Events are generated lazily: questions are fetched in the background
+        and turned into events as they're consumed, so sending can start
+        before the last site has answered.
+
+        Each site is searched from its own checkpoint, unless `since` is
+        given. The checkpoints move forward in `checkpoint`, once the events
+        have been sent.
+
+        With activity polling on, new questions are followed by update
+        events for sent questions that have since been answered.
+        '''
+        self.pending_marks = {}
+        self.pending_seen = []
+        self.pending_states = []
+        self.calls_per_cycle = 0
+
+        events = self.build_events(self.stream_questions(since,
+                                                         site_done=True))
+        if not self.activity:
+            return events
+
+        def with_updates():
+            for event in events:
+                yield event
+            for event in self.build_updates(
+                    self.stream_questions(activity=True)):
+                yield event
+
+        return with_updates()
+
+    def build_events(self, questions):
+        '''Turn (site, question) pairs into events, skipping duplicates.
+        With bodies wanted, they're fetched for the new questions on the way.
         '''
+        questions = self.unseen(questions)
+        if self.bodies is not None:
+            questions = self.bodies.enrich(questions)
+        if self.users is not None:
+            questions = self.users.annotate(questions)
 
-        if since==None:
-            since = self.since
+        count = 0
 
-        # Get all the questions that have been asked with our tags going back
-        # on all the sites
-        questions = []
+        for site, question in questions:
+            if question is utils.SITE_DONE:
+                continue
 
-        for site in self.config['sites']:
-            site_questions = StackExchange.search_questions(since, self.config['tags'],
-                                                            site,
-                                                            self.config['stackexchange_key'])
-            questions.extend(site_questions)
+            event = self.make_event(question)
+            logger.debug("Event for %s", event["url"],
+                         extra={"payload": event, "sampled": True})
 
-        if(len(questions) > 0):
-            # Track the last creation date to get new questions on the next run
-            # `since` is >= in the stackexchange call, so we go 1 second later
-            # so the slurper doesn't keep reporting the same last event over
-            # and over.
-            self.since = questions[0]["creation_date"] + 1
+            count += 1
+            events_built.inc(kind="new")
+            yield event
 
-        events = []
+        logger.info("{} Events".format(count))
 
-        for question in questions:
-            event = {"url": question["link"],
-                     "tags": question["tags"],
-                     "incident_date": question["creation_date"],
-                     "origin_id": question['question_id'],
-                     "title": question['title'],
+    def unseen(self, questions):
+        '''The (site, question) pairs not sent before, noting them down to
+        be remembered at the next checkpoint. SITE_DONE pairs pass through.
+        '''
+        hits = self.seen.hits
+        repeats = 0
+        cycle_keys = set()
 
-                     # Provide full sourcing that can be dug up later
-                     "extra": question,
+        for site, question in questions:
+            if question is utils.SITE_DONE:
+                yield site, question
+                continue
 
-                     # Announce our credentials
-                     "reporter": "stackslurp v{}".format(__version__)}
-            logger.debug("Event: ")
-            logger.debug(event)
+            key = (site, question['question_id'],
+                   question.get('last_activity_date'))
 
-            events.append(event)
+            if self.seen.seen(key):
+                continue
 
-        logger.info("{} Events".format(len(events)))
+            # Pages shift as new questions come in, so the same question can
+            # also turn up twice in one search
+            if key in cycle_keys:
+                repeats += 1
+                continue
 
-        return events
+            cycle_keys.add(key)
+            self.pending_seen.append(key)
+            if self.activity:
+                self.pending_states.append((site, question))
 
-def main(config_file="config.yml"):
-    logging.basicConfig(level=logging.DEBUG)
-    logger.info("Starting up at " + datetime.utcnow().strftime("%Y-%m-%d %H:%M"))
+            yield site, question
 
+        logger.info("{} duplicates skipped".format(self.seen.hits - hits +
+                                                   repeats))
+
+    def build_updates(self, questions):
+        '''Turn (site, question) pairs from activity polling into update
+        events, for questions we've sent whose answers have changed.
+        '''
+        count = 0
+        cycle_keys = set()
+
+        for site, question in questions:
+            key = (site, question['question_id'])
+            if key in cycle_keys:
+                continue
+            cycle_keys.add(key)
+
+            # Questions we never sent aren't Peril's business
+            changed = self.states.changed(site, question)
+            if changed is None:
+                continue
+
+            self.pending_states.append((site, question))
+            if not changed:
+                continue
+
+            event = self.make_update_event(question)
+            logger.debug("Update event for %s (%s)", event["url"],
+                         ", ".join(changed),
+                         extra={"payload": event, "sampled": True})
+
+            count += 1
+            events_built.inc(kind="update")
+            yield event
+
+        logger.info("{} Update events".format(count))
+
+    def make_update_event(self, question):
+        '''An event updating the incident for an answered question, marked
+        as an update in its extra.
+        '''
+        event = self.make_event(question)
+        event['extra'] = dict(event['extra'], update=True)
+
+        # The API doesn't say when an answer was accepted, last activity is
+        # as close as it gets
+        if question.get('accepted_answer_id'):
+            event['completed_at'] = question['last_activity_date']
+
+        return event
+
+    def event_lag(self, event, now):
+        '''Updates are about questions that may be days old, so they don't
+        count towards the enqueue lag.
+        '''
+        if event.get("extra", {}).get("update"):
+            return None
+        return super(StackSlurp, self).event_lag(event, now)
+
+    def make_event(self, question):
+        # Provide full sourcing that can be dug up later, or as much of it as
+        # we've been asked to keep
+        extra = question
+        if self.config.get('extra_fields'):
+            extra = utils.project(question, self.config['extra_fields'])
+
+            # Fetched because they're wanted, whatever the fields say
+            for field, wanted in [('body', self.bodies),
+                                  ('asker', self.users)]:
+                if wanted is not None and field in question:
+                    extra[field] = question[field]
+
+        return {"url": question["link"],
+                "tags": question["tags"],
+                "incident_date": question["creation_date"],
+                "origin_id": question['question_id'],
+                "title": question['title'],
+
+                "extra": extra,
+
+                # Announce our credentials
+                "reporter": "stackslurp v{}".format(__version__)}
+
+    def checkpoint(self):
+        '''Advance each site's checkpoint past the questions just sent.'''
+        self.checkpoints.update(self.pending_marks)
+        self.pending_marks = {}
+
+        self.seen.add(self.pending_seen)
+        self.seen.save()
+        self.pending_seen = []
+
+        if self.activity:
+            self.states.add(self.pending_states)
+            self.states.save()
+            self.pending_states = []
+
+        if self.users is not None:
+            self.users.cache.save()
+
+    def throttled(self):
+        '''Skip cycles while the StackExchange quota is used up.'''
+        return StackExchange.scheduler.exhausted
+
+    def cycle_wait(self):
+        '''Stretch the wait so the StackExchange quota lasts the day. Other
+        workers are spending the same quota, assumed at the same rate.
+        '''
+        return StackExchange.scheduler.pace(self.config['wait_time'],
+                                            self.calls_per_cycle *
+                                            self.config.get('workers', 1))
+
+    def search_filter(self):
+        '''The StackExchange filter id to search with, if any. A filter given
+        as fields is created on first use.
+        '''
+        spec = self.config.get('stackexchange_filter')
+
+        if spec is None or isinstance(spec, basestring):
+            return spec
+
+        # Fields the features turned on rely on
+        needed = []
+        if self.bodies is not None:
+            # Bodies are cached by when they were last edited
+            needed.append("question.last_edit_date")
+        if self.users is not None:
+            # Askers are looked up by the owner's user_id
+            needed.append("question.owner")
+
+        include = list(spec.get('include', ())) + needed
+        exclude = [field for field in spec.get('exclude', ())
+                   if field not in needed]
+
+        return StackExchange.create_filter(include, exclude,
+                                           spec.get('base', 'default'),
+                                           spec.get('unsafe', False),
+                                           self.config['stackexchange_key'],
+                                           session=self.session)
+
+    def fetch_bodies(self, site, ids):
+        '''Questions `ids` on `site`, with their bodies.'''
+        return StackExchange.get_questions(ids, site,
+                self.config['stackexchange_key'], session=self.session,
+                filter=self.config['bodies'].get('filter', 'withbody'))
+
+    def fetch_users(self, site, ids):
+        '''Users `ids` on `site`.'''
+        return StackExchange.get_users(ids, site,
+                self.config['stackexchange_key'], session=self.session)
+
+    def search(self, site, since, **kwargs):
+        '''Search `site` for the configured tags since `since`, matching all
+        of them or any, as configured. Keyword arguments go on to
+        StackExchange.search_questions or search_any.
+        '''
+        kwargs.setdefault("filter", self.search_filter())
+
+        if self.planner is not None:
+            return StackExchange.search_any(since, self.config['tags'], site,
+                    self.config['stackexchange_key'], session=self.session,
+                    planner=self.planner, **kwargs)
+
+        return StackExchange.search_questions(since, self.config['tags'], site,
+                self.config['stackexchange_key'], session=self.session,
+                **kwargs)
+
+    def send_questions(self, site_questions):
+        '''Build, send and checkpoint events for (site, question) pairs
+        fetched outside the usual cycle, such as by a backfill. Only seen
+        questions and question states are recorded, the sites' checkpoints
+        are left alone.
+        '''
+        self.pending_marks = {}
+        self.pending_seen = []
+        self.pending_states = []
+
+        self.send_events(self.build_events(site_questions))
+        self.checkpoint()
+
+    def stream_questions(self, since=None, activity=False, site_done=False):
+        '''Search every configured site for questions since its checkpoint,
+        or since `since` if given, generating (site, question) pairs as they
+        arrive. With `activity`, it's questions active since then, from the
+        separate activity checkpoint. With `site_done`, each site's
+        questions are followed by (site, utils.SITE_DONE), whether its
+        search succeeded or not.
+
+        Up to `max_concurrency` sites are queried at once on background
+        threads. They hand questions over through a buffer of
+        `pipeline_buffer` questions and wait while it's full, so a slow
+        consumer holds back fetching rather than piling questions up in memory.
+
+        Each site's questions come newest first, but sites are interleaved
+        as they arrive. Once a site has been read in full, its new high-water
+        mark goes into `pending_marks`. A failing site is logged and skipped
+        rather than throwing away what the other sites returned, unless every
+        site failed.
+        '''
+        sites = self.config['sites']
+        if not sites:
+            return
+
+        search_filter = self.search_filter()
+
+        # Creation marks skip past the newest question, since `fromdate` is
+        # inclusive. Activity marks stay put: `min` is inclusive too, but
+        # the question states make repeats harmless, and a question active
+        # in the same second as the last one isn't missed.
+        if activity:
+            query, mark_field, mark_offset = (self.activity_query,
+                                              "last_activity_date", 0)
+        else:
+            query, mark_field, mark_offset = (self.query, "creation_date", 1)
+
+        buffered = Queue.Queue(self.config.get('pipeline_buffer', 500))
+        stop = threading.Event()
+        finished = object()
+
+        def put(item):
+            # Give up if the consumer has gone away
+            while not stop.is_set():
+                try:
+                    buffered.put(item, timeout=0.1)
+                    return True
+                except Queue.Full:
+                    pass
+            return False
+
+        def fetch(site):
+            # Don't spend quota on a cycle that's already been abandoned
+            if stop.is_set():
+                return
+
+            newest = None
+            error = None
+
+            # Everything in the try, so the consumer always hears back
+            try:
+                site_since = since
+                if site_since is None:
+                    site_since = self.checkpoints.get(site, query, self.since)
+
+                search = {"filter": search_filter}
+                if activity:
+                    search.update(sort_on="activity", min_value=site_since)
+                    site_since = None
+
+                site_questions = self.search(site, site_since, **search)
+
+                for question in site_questions:
+                    if newest is None or question[mark_field] > newest:
+                        newest = question[mark_field]
+                    if not put((site, question)):
+                        return
+            except Exception as e:
+                logger.exception("Fetching questions from {} failed".format(site))
+                error = e
+
+            put((site, (finished, newest, error)))
+
+        calls = StackExchange.scheduler.calls
+
+        pool = ThreadPool(min(self.config.get('max_concurrency', 1), len(sites)))
+        for site in sites:
+            pool.apply_async(fetch, (site,))
+        pool.close()
+
+        try:
+            remaining = len(sites)
+            failures = 0
+
+            while remaining:
+                site, item = buffered.get()
+
+                if isinstance(item, tuple) and item[0] is finished:
+                    remaining -= 1
+                    _, newest, error = item
+
+                    if error is not None:
+                        failures += 1
+                    elif newest is not None:
+                        self.pending_marks[(site, query)] = (newest +
+                                                             mark_offset)
+
+                    if site_done:
+                        yield site, utils.SITE_DONE
+                    continue
+
+                questions_fetched.inc(site=site)
+                yield site, item
+
+            if failures == len(sites):
+                raise error
+        finally:
+            stop.set()
+            pool.join()
+            self.calls_per_cycle += StackExchange.scheduler.calls - calls
+
+def main(config_file="config.yml", workers=None, record=None, replay=None,
+         speed=None):
     config = read_config(config_file)
 
+    listener = logs.configure(**config['logging'])
+    logger.info("Starting up at " + datetime.utcnow().strftime("%Y-%m-%d %H:%M"))
+
+    cassette = config.setdefault('cassette', {})
+    if record is not None:
+        cassette['record'] = record
+    if replay is not None:
+        cassette['replay'] = replay
+    if speed is not None:
+        cassette['speed'] = speed
+
+    if workers is None:
+        workers = config.get('workers', 1)
+
+    try:
+        run(config, workers)
+    finally:
+        # Write out the last of the logs
+        listener.stop()
+
+def run(config, workers=1):
+    '''Slurp as configured, spread over `workers` processes.'''
+    # Retries are shared per endpoint, by every slurper in the process
+    retry.configure(**config.get('retry', {}))
+
+    if config['cassette'].get('replay'):
+        # A cassette is played through once, in one process
+        StackSlurp(config).replay()
+        return
+
+    if workers > 1:
+        WorkerPool(config, workers, StackSlurp).run()
+        return
+
+    metrics.start(**config.get('metrics', {}))
+
+    # The quota is all this process's
+    config['workers'] = 1
     slurper = StackSlurp(config)
 
-    slurper.go()
+    try:
+        if config.get('engine') == 'async':
+            AsyncSlurper([slurper]).run()
+        else:
+            slurper.go()
+    finally:
+        # Finishes off a cassette being recorded
+        slurper.session.close()
+        slurper.sink.close()
+
+def backfill(config_file, start, end, window=None, parallel=None,
+             state_file=None):
+    '''Backfill questions created from `start` up to `end`, given as anything
+    backfill.parse_time takes.
+    '''
+    config = read_config(config_file)
+
+    listener = logs.configure(**config['logging'])
+
+    settings = config['backfill']
+    if window is not None:
+        settings['window'] = window
+    if parallel is not None:
+        settings['parallel'] = parallel
+    if state_file is not None:
+        settings['state_file'] = state_file
+
+    retry.configure(**config.get('retry', {}))
+
+    try:
+        slurper = StackSlurp(config)
+
+        try:
+            left = Backfill(slurper, parse_time(start), parse_time(end),
+                            **settings).run()
+        finally:
+            slurper.session.close()
+            slurper.sink.close()
+    finally:
+        listener.stop()
+
+    if left:
+        logger.warning("{} windows left, run the backfill again to finish "
+                       "them".format(left))
+    return left
+
+def backfill_cli(argv):
+    '''`slurp backfill`'''
+    parser = argparse.ArgumentParser(prog="slurp backfill", description=
+            "Post questions created over a stretch of the past")
+    parser.add_argument("-c", "--config", default="config.yml",
+                        help="config file (default: %(default)s)")
+    parser.add_argument("--from", dest="start", required=True,
+                        help="start of the stretch, as a date (2014-01-05), "
+                             "ISO 8601 timestamp or seconds since the epoch")
+    parser.add_argument("--to", dest="end",
+                        default=str(int(time.time())),
+                        help="end of the stretch (default: now)")
+    parser.add_argument("--window", type=int,
+                        help="seconds searched at a time (default: 86400)")
+    parser.add_argument("--parallel", type=int,
+                        help="windows searched at once (default: 4)")
+    parser.add_argument("--state", dest="state_file",
+                        help="file recording the windows done, to resume "
+                             "from")
+
+    args = parser.parse_args(argv)
+
+    left = backfill(args.config, args.start, args.end, window=args.window,
+                    parallel=args.parallel, state_file=args.state_file)
+    return 1 if left else 0
+
+def cli(argv=None):
+    '''The `slurp` console script.'''
+    if argv is None:
+        argv = sys.argv[1:]
+
+    if argv[:1] == ["backfill"]:
+        sys.exit(backfill_cli(argv[1:]))
+
+    parser = argparse.ArgumentParser(prog="slurp", description="Pull "
+            "tagged questions from StackExchange and post them to a CloudQueue")
+    parser.add_argument("-c", "--config", default="config.yml",
+                        help="config file (default: %(default)s)")
+    parser.add_argument("-w", "--workers", type=int,
+                        help="number of worker processes to spread sites over "
+                             "(default: 'workers' from the config, or 1)")
+    parser.add_argument("--record", metavar="CASSETTE",
+                        help="record StackExchange responses and enqueued "
+                             "messages to this file")
+    parser.add_argument("--replay", metavar="CASSETTE",
+                        help="replay a recorded cassette instead of calling "
+                             "StackExchange or CloudQueues")
+    parser.add_argument("--speed", type=float,
+                        help="replay speed, 1 for the recorded pace or 0 for "
+                             "as fast as possible (default: 1)")
+    parser.add_argument("--version", action="version",
+                        version="%(prog)s " + __version__)
+
+    args = parser.parse_args(argv)
+
+    main(args.config, workers=args.workers, record=args.record,
+         replay=args.replay, speed=args.speed)
 
 if __name__ == "__main__":
-    main("config.yml")
+    cli()
@@ -0,0 +1,296 @@
+'''
+Counters, gauges and histograms for keeping an eye on a running slurper.
+
+Metrics live in a process wide registry. They can be scraped from a small
+HTTP server in the Prometheus text format, pushed to statsd over UDP as
+they're recorded, or both.
+
+>>> calls = counter("stackslurp_api_calls_total", "StackExchange API calls",
+...                 ["site"])
+>>> calls.inc(site="stackoverflow")
+>>> start(port=9108, statsd="localhost:8125")
+'''
+
+import abc
+import logging
+import socket
+import threading
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from bisect import bisect_left
+
+logger = logging.getLogger(__name__)
+
+# Seconds, for request latencies
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0,
+                   10.0)
+
+
+def _escape(value):
+    return (unicode(value).replace("\\", "\\\\").replace("\n", "\\n")
+            .replace('"', '\\"'))
+
+
+def _format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join('{}="{}"'.format(name, _escape(value))
+                          for name, value in pairs) + "}"
+
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value))
+
+
+class Metric(object):
+    '''A named metric, with a value for each combination of its labels.'''
+    __metaclass__ = abc.ABCMeta
+
+    kind = None
+
+    def __init__(self, name, help, labels=(), registry=None):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.registry = registry
+
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def _key(self, labels):
+        if set(labels) != set(self.labels):
+            raise ValueError("{} takes labels {}, got {}".format(self.name,
+                             list(self.labels), sorted(labels)))
+        return tuple(labels[name] for name in self.labels)
+
+    def _emit(self, key, value):
+        if self.registry is not None:
+            self.registry.emit(self, key, value)
+
+    @abc.abstractmethod
+    def samples(self):
+        '''(suffix, label values, extra labels, value) for each sample.'''
+        pass
+
+    def render(self):
+        lines = ["# HELP {} {}".format(self.name, self.help),
+                 "# TYPE {} {}".format(self.name, self.kind)]
+
+        for suffix, key, extra, value in self.samples():
+            lines.append("{}{}{} {}".format(self.name, suffix,
+                         _format_labels(self.labels, key, extra),
+                         _format_value(value)))
+
+        return "\n".join(lines)
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+        self._emit(key, amount)
+
+    def value(self, **labels):
+        return self._values.get(self._key(labels), 0)
+
+    def samples(self):
+        with self._lock:
+            return [("", key, (), value)
+                    for key, value in sorted(self._values.items())]
+
+
+class Gauge(Counter):
+    kind = "gauge"
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+        self._emit(key, value)
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name, help, labels=(), registry=None,
+                 buckets=DEFAULT_BUCKETS):
+        super(Histogram, self).__init__(name, help, labels, registry)
+        self.buckets = tuple(sorted(buckets)) + (float("inf"),)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+
+        with self._lock:
+            counts, total = self._values.get(key,
+                                             ([0] * len(self.buckets), 0.0))
+            counts[bisect_left(self.buckets, value)] += 1
+            self._values[key] = (counts, total + value)
+
+        self._emit(key, value)
+
+    def count(self, **labels):
+        counts, _ = self._values.get(self._key(labels), ([0], 0.0))
+        return sum(counts)
+
+    def samples(self):
+        samples = []
+
+        with self._lock:
+            for key, (counts, total) in sorted(self._values.items()):
+                cumulative = 0
+                for bound, count in zip(self.buckets, counts):
+                    cumulative += count
+                    samples.append(("_bucket", key,
+                                    [("le", _format_value(bound))],
+                                    cumulative))
+                samples.append(("_sum", key, (), total))
+                samples.append(("_count", key, (), cumulative))
+
+        return samples
+
+
+class Registry(object):
+    '''Holds metrics by name, and passes what they record on to any
+    emitters (see StatsdEmitter).
+    '''
+
+    def __init__(self):
+        self.metrics = {}
+        self.emitters = []
+        self._lock = threading.Lock()
+
+    def _get(self, cls, name, help, labels, **kwargs):
+        with self._lock:
+            metric = self.metrics.get(name)
+            if metric is None:
+                metric = cls(name, help, labels, registry=self, **kwargs)
+                self.metrics[name] = metric
+            elif not isinstance(metric, cls):
+                raise ValueError("{} is already a {}".format(name,
+                                                              metric.kind))
+            return metric
+
+    def counter(self, name, help, labels=()):
+        return self._get(Counter, name, help, labels)
+
+    def gauge(self, name, help, labels=()):
+        return self._get(Gauge, name, help, labels)
+
+    def histogram(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        return self._get(Histogram, name, help, labels, buckets=buckets)
+
+    def emit(self, metric, key, value):
+        for emitter in self.emitters:
+            try:
+                emitter.emit(metric, key, value)
+            except Exception:
+                logger.exception("Emitting {} failed".format(metric.name))
+
+    def render(self):
+        '''Every metric in the Prometheus text format.'''
+        with self._lock:
+            metrics = sorted(self.metrics.values(), key=lambda m: m.name)
+        return "".join(metric.render() + "\n" for metric in metrics)
+
+
+class StatsdEmitter(object):
+    '''Sends each recording to statsd as it happens. Label values go on the
+    end of the name: stackslurp.api_calls_total.stackoverflow
+    '''
+
+    types = {"counter": "c", "gauge": "g", "histogram": "ms"}
+
+    def __init__(self, host="localhost", port=8125, prefix="stackslurp"):
+        self.address = (host, int(port))
+        self.prefix = prefix
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    def emit(self, metric, key, value):
+        name = metric.name
+        if name.startswith("stackslurp_"):
+            name = name[len("stackslurp_"):]
+
+        parts = [self.prefix, name] + [unicode(part).replace(".", "_")
+                                       for part in key]
+        if metric.kind == "histogram":
+            # statsd timers are in milliseconds
+            value = value * 1000
+
+        packet = "{}:{}|{}".format(".".join(parts), value,
+                                   self.types[metric.kind])
+        self.socket.sendto(packet.encode("utf-8"), self.address)
+
+
+class MetricsServer(object):
+    '''Serves a registry at /metrics from a background thread.'''
+
+    def __init__(self, registry, port, host="127.0.0.1"):
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split("?")[0] != "/metrics":
+                    self.send_error(404)
+                    return
+
+                body = registry.render().encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type",
+                                 "text/plain; version=0.0.4; charset=utf-8")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                logger.debug("Metrics request: " + format % args)
+
+        self.httpd = HTTPServer((host, port), Handler)
+        self.port = self.httpd.server_address[1]
+
+        self.thread = threading.Thread(target=self.httpd.serve_forever,
+                                       name="metrics-server")
+        self.thread.daemon = True
+
+    def start(self):
+        self.thread.start()
+        logger.info("Serving metrics on port {}".format(self.port))
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+registry = Registry()
+
+
+def counter(name, help, labels=()):
+    return registry.counter(name, help, labels)
+
+
+def gauge(name, help, labels=()):
+    return registry.gauge(name, help, labels)
+
+
+def histogram(name, help, labels=(), buckets=DEFAULT_BUCKETS):
+    return registry.histogram(name, help, labels, buckets)
+
+
+def start(port=None, host="127.0.0.1", statsd=None, prefix="stackslurp"):
+    '''Expose the process wide registry: over HTTP on `port`, and/or to the
+    statsd at `statsd` ("host:port"). Returns the MetricsServer, if any.
+    '''
+    if statsd:
+        statsd_host, _, statsd_port = statsd.partition(":")
+        registry.emitters.append(StatsdEmitter(statsd_host,
+                                               statsd_port or 8125, prefix))
+        logger.info("Sending metrics to statsd at {}".format(statsd))
+
+    if port is None:
+        return None
+
+    server = MetricsServer(registry, port, host)
+    server.start()
+    return server
@@ -0,0 +1,262 @@
+'''
+A write-ahead outbox for events on their way to CloudQueues.
+
+Events are appended to numbered segment files, one JSON event per line, and
+fsynced once per `append` rather than once per event. A cursor file records
+how many have been sent. Once an event is in the outbox the slurper can move
+its checkpoints on: if CloudQueues is down, the events wait on disk and go
+out when it's back, or when the slurper next starts, instead of being
+fetched all over again.
+
+>>> outbox = Outbox("/var/slurp/outbox")
+>>> outbox.append([{"url": "http://stackoverflow.com/questions/20912948"}])
+>>> outbox.peek(10)
+[{u'url': u'http://stackoverflow.com/questions/20912948'}]
+>>> outbox.ack(1)
+>>> len(outbox)
+0
+'''
+
+import json
+import logging
+import os
+import re
+import threading
+
+from . import utils
+
+logger = logging.getLogger(__name__)
+
+_segment_name = re.compile(r"^(\d+)\.jsonl$")
+
+
+class Outbox(object):
+    '''Events waiting to be sent, kept in `directory`.
+
+    Each segment holds up to `segment_size` events. Segments are only ever
+    appended to by the process that created them, so one left half written
+    by a crash is just read up to its last whole line.
+    '''
+
+    def __init__(self, directory, segment_size=1000):
+        self.directory = directory
+        self.segment_size = segment_size
+
+        self.cursor_path = os.path.join(directory, "cursor.json")
+
+        # segment number -> whole events written to it, oldest first
+        self._segments = {}
+
+        # The first unsent event: its segment, and how far into it
+        self._segment = None
+        self._offset = 0
+
+        # Unsent events already read by `peek`, oldest first, and where
+        # reading stopped: the segment, events into it and the byte offset.
+        # Draining reads on from there rather than starting over each time.
+        self._window = []
+        self._window_end = None
+
+        # The segment being appended to, which is always a new one, and the
+        # highest segment number used so far. Numbers are never reused, so
+        # an old cursor can't be mistaken for a new segment's.
+        self._writing = None
+        self._fh = None
+        self._newest = 0
+
+        self._lock = threading.Lock()
+
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+        for name in os.listdir(directory):
+            match = _segment_name.match(name)
+            if match:
+                number = int(match.group(1))
+                self._segments[number] = len(self._read(number))
+                self._newest = max(self._newest, number)
+
+        if os.path.exists(self.cursor_path):
+            with open(self.cursor_path) as fh:
+                cursor = json.load(fh)
+            self._segment, self._offset = cursor['segment'], cursor['offset']
+            self._newest = max(self._newest, self._segment or 0)
+
+        self._drop_sent()
+
+        if len(self):
+            logger.info("{} unsent events in the outbox at {}".format(
+                        len(self), directory))
+
+    def __len__(self):
+        total = sum(self._segments.values())
+        if self._segment in self._segments:
+            total -= self._offset
+        return total
+
+    def _path(self, number):
+        return os.path.join(self.directory, "{:010d}.jsonl".format(number))
+
+    def _read(self, number, skip=0, limit=None):
+        '''Whole events from segment `number`, ignoring a torn last line.'''
+        events = []
+
+        with open(self._path(number)) as fh:
+            for n, line in enumerate(fh):
+                if not line.endswith("\n"):
+                    break
+                if n < skip:
+                    continue
+                if limit is not None and len(events) >= limit:
+                    break
+                events.append(json.loads(line))
+
+        return events
+
+    def append(self, events):
+        '''Write `events` to the outbox, returning once they're on disk.'''
+        lines = [json.dumps(event) + "\n" for event in events]
+        if not lines:
+            return
+
+        with self._lock:
+            for line in lines:
+                if (self._fh is None or
+                        self._segments[self._writing] >= self.segment_size):
+                    self._roll()
+
+                self._fh.write(line)
+                self._segments[self._writing] += 1
+
+            self._fh.flush()
+            os.fsync(self._fh.fileno())
+
+    def _roll(self):
+        '''Start a new segment for appending.'''
+        if self._fh is not None:
+            self._fh.close()
+
+        self._newest += 1
+        self._writing = self._newest
+        self._segments[self._writing] = 0
+        self._fh = open(self._path(self._writing), "a")
+
+        if self._segment is None or self._segment not in self._segments:
+            self._segment, self._offset = self._writing, 0
+
+    def peek(self, limit):
+        '''Up to `limit` of the oldest unsent events, without removing them.'''
+        with self._lock:
+            while len(self._window) < limit:
+                if self._window_end is None:
+                    self._window_end = (self._segment, self._offset, None)
+
+                number, index, position = self._window_end
+
+                # Read to the end of that segment, or it's been sent and
+                # deleted: on to the next one, if there is one yet, carrying
+                # over how far past the end the cursor was
+                if (number not in self._segments or
+                        index >= self._segments[number]):
+                    later = [n for n in sorted(self._segments)
+                             if number is None or n > number]
+                    if not later:
+                        break
+                    carry = max(index - self._segments.get(number, index), 0)
+                    self._window_end = (later[0], carry,
+                                        None if carry else 0)
+                    continue
+
+                events, position = self._read_on(number, index, position,
+                                                 limit - len(self._window))
+                if not events:
+                    break
+
+                self._window.extend(events)
+                self._window_end = (number, index + len(events), position)
+
+            return self._window[:limit]
+
+    def _read_on(self, number, skip, position, limit):
+        '''Up to `limit` whole events from segment `number`, from byte
+        `position` if known, or else after the first `skip` events. Returns
+        them and the byte offset just past them.
+        '''
+        events = []
+
+        with open(self._path(number)) as fh:
+            if position is None:
+                for _ in range(skip):
+                    fh.readline()
+            else:
+                fh.seek(position)
+
+            position = fh.tell()
+            while len(events) < limit:
+                line = fh.readline()
+                if not line.endswith("\n"):
+                    break
+                events.append(json.loads(line))
+                position = fh.tell()
+
+        return events, position
+
+    def ack(self, count):
+        '''Mark the oldest `count` events as sent.'''
+        if count <= 0:
+            return
+
+        with self._lock:
+            if count <= len(self._window):
+                del self._window[:count]
+            else:
+                self._window = []
+                self._window_end = None
+
+            self._offset += count
+            self._drop_sent()
+
+    def _drop_sent(self):
+        '''Move the cursor past, and delete, segments that have been sent.'''
+        if self._segment not in self._segments:
+            # No cursor yet, or its segment was sent and deleted: start at
+            # the next segment there is
+            later = [n for n in self._segments
+                     if self._segment is None or n > self._segment]
+            if later:
+                self._segment, self._offset = min(later), 0
+
+        # Carry anything left over from segments sent in full on to the
+        # next, however many that takes
+        while (self._segment in self._segments and
+                self._segment != self._writing and
+                self._offset >= self._segments[self._segment]):
+            later = [n for n in self._segments if n > self._segment]
+            if not later:
+                break
+            self._offset -= self._segments[self._segment]
+            self._segment = min(later)
+
+        # Record the cursor before deleting anything behind it, so a crash
+        # in between just leaves segments for the next start to delete
+        if self._segment is not None:
+            utils.atomic_write(self.cursor_path,
+                               json.dumps({"segment": self._segment,
+                                           "offset": self._offset}))
+
+        for number in sorted(self._segments):
+            if number > self._segment:
+                break
+            if number == self._segment and (
+                    number == self._writing or
+                    self._offset < self._segments[number]):
+                break
+
+            os.remove(self._path(number))
+            del self._segments[number]
+
+    def close(self):
+        with self._lock:
+            if self._fh is not None:
+                self._fh.close()
+                self._fh = None
@@ -6,20 +6,70 @@ This module helps with auth and working with queues.
 
 import logging
 import json
+import threading
+import time
 import uuid
+from collections import namedtuple
+from multiprocessing.pool import ThreadPool
 from urlparse import urljoin
 
-import requests
+from . import metrics
+from . import retry
+from . import sessions
+from . import utils
 
 logger = logging.getLogger(__name__)
 
+# CloudQueues takes at most this many messages in one post
+MAX_MESSAGES_PER_POST = 10
+
+# and at most this many bytes, messages and all
+MAX_POST_BYTES = 256 * 1024
+
+# How one batch of messages fared: the messages posted, the resource paths
+# CloudQueues created for them, the exception if the post failed, and the
+# size of the post in bytes (0 for a message that was never posted)
+BatchResult = namedtuple("BatchResult", ["messages", "resources", "error",
+                                         "bytes"])
+BatchResult.__new__.__defaults__ = (0,)
+
+enqueue_latency = metrics.histogram("stackslurp_enqueue_seconds",
+                                    "Time to post one batch to CloudQueues, "
+                                    "retries included", ["queue"])
+enqueue_failures = metrics.counter("stackslurp_enqueue_failures_total",
+                                   "Batches that failed to post", ["queue"])
+messages_too_large = metrics.counter("stackslurp_messages_too_large_total",
+                                     "Messages too big to post at all",
+                                     ["queue"])
+
+
+class EnqueueError(Exception):
+    '''Some batches failed to post. `results` has a BatchResult for every
+    batch, successful or not.
+    '''
+
+    def __init__(self, results):
+        self.results = results
+        failed = [result for result in results if result.error is not None]
+        super(EnqueueError, self).__init__(
+            "{} of {} batches failed to enqueue, first error: {}".format(
+                len(failed), len(results), failed[0].error))
+
+
 class Rackspace(object):
     '''Simple Encapsulation of Auth and posting messages to CloudQueues'''
 
-    def __init__(self, username, api_key):
+    def __init__(self, username, api_key, session=None,
+                 expiry_margin=300, refresh_ahead=900):
         self.username = username
         self.api_key = api_key
 
+        # Connection-pooled session, shared with anything else given the same
+        # one so that connections to identity and queues stay alive
+        if session is None:
+            session = sessions.get_session()
+        self.session = session
+
         self.identity_endpoint = "https://identity.api.rackspacecloud.com/v2.0"
 
         self.token_endpoint = self.identity_endpoint + "/tokens"
@@ -27,15 +77,73 @@ class Rackspace(object):
         # Generate a client ID for Queue usage
         self.client_id = str(uuid.uuid4())
 
-    def auth(self):
+        # Cached token and the time (seconds since the epoch) it expires.
+        # Tokens are dropped `expiry_margin` seconds before they expire and
+        # refreshed in the background once inside `refresh_ahead` seconds.
+        self.token = None
+        self.expires = 0
+        self.expiry_margin = expiry_margin
+        self.refresh_ahead = refresh_ahead
+
+        # Held by whoever is talking to identity, so that only one caller
+        # reauthenticates at a time
+        self._auth_lock = threading.Lock()
+
+        self._posting_pool = None
+        self._posting_pool_size = 0
+        self._pool_lock = threading.Lock()
+
+    def auth(self, force=False):
         '''Authenticate with Rackspace.
 
         This generates the token that is used by calls to Rackspace services.
+        The token is cached until shortly before it expires, so calling this
+        before every use is cheap. Pass `force` to throw the cached token away.
 
         >>> rack = Rackspace("myuser", "XXXXXXXXXXXXXXXX")
         >>> rack.auth()
         >>> rack.token
         '''
+        if not force:
+            remaining = self.expires - time.time()
+
+            if remaining > self.refresh_ahead:
+                return
+
+            if remaining > self.expiry_margin:
+                # Still good for a while, get the next one without waiting
+                self._refresh_in_background()
+                return
+
+        self._reauth(self.token)
+
+    def _reauth(self, stale_token):
+        '''Replace `stale_token`, unless another caller already has.'''
+        with self._auth_lock:
+            if (self.token != stale_token and
+                    self.expires - time.time() > self.expiry_margin):
+                return
+
+            self._fetch_token()
+
+    def _refresh_in_background(self):
+        if not self._auth_lock.acquire(False):
+            # Somebody is already on it
+            return
+
+        def refresh():
+            try:
+                self._fetch_token()
+            except Exception:
+                logger.exception("Background token refresh failed")
+            finally:
+                self._auth_lock.release()
+
+        thread = threading.Thread(target=refresh, name="token-refresh")
+        thread.daemon = True
+        thread.start()
+
+    def _fetch_token(self):
         auth_data = {
             "auth": {
                 "RAX-KSKEY:apiKeyCredentials": {
@@ -47,32 +155,171 @@ class Rackspace(object):
 
         headers = {'Content-type': 'application/json'}
 
-        resp = requests.post(self.token_endpoint, data=json.dumps(auth_data),
-                            headers=headers)
-        resp.raise_for_status()
-        identity_data = resp.json()
-        self.token = identity_data['access']['token']['id']
+        def post():
+            resp = self.session.post(self.token_endpoint,
+                                     data=json.dumps(auth_data),
+                                     headers=headers)
+            resp.raise_for_status()
+            return resp.json()
+
+        token = retry.policy("identity").call(post)['access']['token']
+
+        # Without an expiry there's nothing to go on, so don't cache it
+        expires = time.time()
+        if 'expires' in token:
+            expires = utils.parse_iso8601(token['expires'])
+
+        self.token = token['id']
+        self.expires = expires
 
-    def enqueue(self, messages, queue, endpoint, ttl=300):
+    def enqueue(self, messages, queue, endpoint, ttl=300,
+                batch_size=MAX_MESSAGES_PER_POST, max_in_flight=1,
+                max_bytes=MAX_POST_BYTES):
         '''Sends messages to the named queue on the given endpoint.
 
         Endpoint can be PublicNet or ServiceNet.
 
-        Messages must be JSON-serializable dicts.
+        Messages must be JSON-serializable dicts. Each is encoded once, and
+        they're posted up to `batch_size` at a time in posts of no more than
+        `max_bytes`, with up to `max_in_flight` posts going at once. A
+        message too big to post even on its own is logged and dropped.
+
+        Messages within a batch keep their order, and with `max_in_flight` at
+        1 so do the batches. Batches in flight together can land in any
+        order.
+
+        Returns a BatchResult for each batch, and one with no resources for
+        each message dropped, in the order given. If any batch failed,
+        EnqueueError is raised carrying all of the results so the caller can
+        tell which messages made it.
+
+        If the token is rejected, we reauthenticate and try once more.
         '''
+        if not 1 <= batch_size <= MAX_MESSAGES_PER_POST:
+            raise ValueError("batch_size must be between 1 and {}".format(
+                             MAX_MESSAGES_PER_POST))
+
         post_message_url = urljoin(endpoint,
                                    "/v1/queues/{}/messages".format(queue))
 
-        headers = {'Content-type': 'application/json',
-                   "Client-ID": self.client_id,
-                   "X-Auth-Token": self.token}
+        if self.token is None:
+            self.auth()
+
+        def post(batch):
+            started = time.time()
+            messages = [message for message, _ in batch]
+            # Put together from the messages as already encoded
+            data = "[" + ",".join(encoded for _, encoded in batch) + "]"
+            try:
+                return BatchResult(messages,
+                                   self._post_batch(post_message_url, data),
+                                   None, len(data))
+            except Exception as e:
+                logger.exception("Posting {} messages to {} failed".format(
+                                 len(batch), queue))
+                enqueue_failures.inc(queue=queue)
+                return BatchResult(messages, [], e, len(data))
+            finally:
+                enqueue_latency.observe(time.time() - started, queue=queue)
+
+        def batch_up(encoded):
+            # Each message costs its length and a comma, and one of those
+            # commas is really the closing bracket, leaving a byte for the
+            # opening one
+            return utils.sized_chunks(encoded, batch_size, max_bytes - 1,
+                                      size=lambda item: len(item[1]) + 1)
+
+        envelope = '{{"ttl":{},"body":'.format(int(ttl))
+
+        # Batches to post, and results for messages dropped, in order
+        pieces = []
+        encoded = []
+        for message in messages:
+            item = envelope + utils.json_dumps(message) + "}"
+
+            # Brackets around it, and it still has to fit
+            if len(item) + 2 > max_bytes:
+                logger.error("Dropping a {} byte message, more than {} can "
+                             "take".format(len(item), queue))
+                messages_too_large.inc(queue=queue)
+
+                pieces.extend(batch_up(encoded))
+                pieces.append(BatchResult([message], [], None))
+                encoded = []
+                continue
+
+            encoded.append((message, item))
+
+        pieces.extend(batch_up(encoded))
+
+        batches = [piece for piece in pieces
+                   if not isinstance(piece, BatchResult)]
+
+        if max_in_flight > 1 and len(batches) > 1:
+            posted = self._pool(max_in_flight).map(post, batches)
+        else:
+            posted = [post(batch) for batch in batches]
+
+        posted = iter(posted)
+        results = [piece if isinstance(piece, BatchResult) else next(posted)
+                   for piece in pieces]
 
-        data = [{"ttl": ttl, "body": message} for message in messages]
+        failed = [result for result in results if result.error is not None]
+        if failed:
+            raise EnqueueError(results)
+
+        return results
+
+    def _pool(self, size):
+        '''Threads for posting in parallel, kept between calls.'''
+        with self._pool_lock:
+            if self._posting_pool is None or self._posting_pool_size != size:
+                if self._posting_pool is not None:
+                    self._posting_pool.close()
+                self._posting_pool = ThreadPool(size)
+                self._posting_pool_size = size
+
+            return self._posting_pool
+
+    def close(self):
+        '''Stop the threads kept for posting in parallel, if any.'''
+        with self._pool_lock:
+            if self._posting_pool is not None:
+                self._posting_pool.close()
+                self._posting_pool.join()
+                self._posting_pool = None
+                self._posting_pool_size = 0
+
+    def _post_batch(self, url, data):
+        '''Post one encoded batch, returning the resources created for it.
+        Only this batch is retried if it fails.
+        '''
+        return retry.policy("queues").call(self._post_data, url, data)
+
+    def _post_data(self, url, data):
+        '''Post encoded messages, reauthenticating once if the token is
+        rejected.
+        '''
+        token = self.token
+        resp = self._post_messages(url, data, token)
+
+        if resp.status_code == 401:
+            logger.info("Token rejected by CloudQueues, reauthenticating")
+            self._reauth(token)
+            resp = self._post_messages(url, data, self.token)
 
-        resp = requests.post(post_message_url, data=json.dumps(data),
-                             headers=headers)
         resp.raise_for_status()
 
-        logger.debug("enqueue response")
-        logger.debug(resp.json())
+        resources = resp.json().get('resources', [])
+
+        logger.debug("Enqueued %d messages", len(resources),
+                     extra={"payload": resources, "sampled": True})
+
+        return resources
+
+    def _post_messages(self, url, data, token):
+        headers = {'Content-type': 'application/json',
+                   "Client-ID": self.client_id,
+                   "X-Auth-Token": token}
 
+        return self.session.post(url, data=data, headers=headers)
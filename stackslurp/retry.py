@@ -0,0 +1,202 @@
+'''
+Retries for the HTTP calls to StackExchange, Rackspace identity and
+CloudQueues.
+
+A dropped connection or a 503 shouldn't cost a whole cycle, so each request
+(one page, one batch of messages, one token) is retried on its own with
+exponential backoff and full jitter. Two things keep retries from making an
+outage worse:
+
+* a retry budget per endpoint. Every request earns a fraction of a retry and
+  every retry spends one, so when most requests are failing we stop
+  retrying and just fail.
+* a circuit breaker per endpoint. After `failure_threshold` failures in a
+  row the endpoint is left alone for `reset_timeout` seconds, with calls
+  failing straight away with CircuitOpen. After that one call is let through
+  to see if it's back.
+
+>>> policy("stackexchange").call(fetch_page, 2)
+'''
+
+import logging
+import random
+import threading
+import time
+
+import requests
+
+logger = logging.getLogger(__name__)
+
+DEFAULTS = {
+    # Tries per request, including the first
+    "attempts": 4,
+    # Backoff before retry n is random, up to base_delay * 2 ** (n - 1)
+    "base_delay": 0.5,
+    "max_delay": 30,
+    # Retries an endpoint can have saved up, and earns per request
+    "budget": 10,
+    "budget_ratio": 0.2,
+    # Failures in a row to open the circuit, and seconds to keep it open
+    "failure_threshold": 5,
+    "reset_timeout": 60,
+}
+
+_settings = dict(DEFAULTS)
+_policies = {}
+_lock = threading.Lock()
+
+
+class CircuitOpen(Exception):
+    '''An endpoint has been failing, so the call wasn't made.'''
+
+
+def retryable(error):
+    '''Whether a failed request is worth trying again: connection trouble,
+    timeouts, server errors and rate limiting, but not bad requests.
+    '''
+    if isinstance(error, requests.HTTPError):
+        response = error.response
+        return response is None or (response.status_code >= 500 or
+                                    response.status_code == 429)
+
+    return isinstance(error, (requests.ConnectionError, requests.Timeout))
+
+
+class RetryBudget(object):
+    '''Allows retries only while there have been enough requests to pay for
+    them.
+    '''
+
+    def __init__(self, budget=10, budget_ratio=0.2):
+        self.budget = budget
+        self.budget_ratio = budget_ratio
+        self.balance = float(budget)
+        self._lock = threading.Lock()
+
+    def deposit(self):
+        with self._lock:
+            self.balance = min(self.budget, self.balance + self.budget_ratio)
+
+    def withdraw(self):
+        '''Spend a retry, returning False if there isn't one to spend.'''
+        with self._lock:
+            if self.balance < 1:
+                return False
+            self.balance -= 1
+            return True
+
+
+class CircuitBreaker(object):
+    '''Fails calls fast while an endpoint is down.'''
+
+    def __init__(self, failure_threshold=5, reset_timeout=60):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+
+        self.failures = 0
+        self.opened_at = None
+        self._lock = threading.Lock()
+
+    @property
+    def state(self):
+        if self.opened_at is None:
+            return "closed"
+        if time.time() - self.opened_at < self.reset_timeout:
+            return "open"
+        return "half_open"
+
+    def allow(self):
+        '''Raise CircuitOpen unless a call may go ahead. Once the timeout is
+        up, one caller gets through to try the endpoint again.
+        '''
+        with self._lock:
+            state = self.state
+            if state == "closed":
+                return
+            if state == "half_open":
+                # Everyone else waits on this one's verdict
+                self.opened_at = time.time()
+                return
+
+        raise CircuitOpen("Circuit open, retrying in {:.0f}s".format(
+                          self.opened_at + self.reset_timeout - time.time()))
+
+    def success(self):
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+
+    def failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.opened_at is not None or (self.failures >=
+                                              self.failure_threshold):
+                self.opened_at = time.time()
+
+
+class RetryPolicy(object):
+    '''Retries calls to one endpoint, sharing its budget and breaker.'''
+
+    def __init__(self, name, attempts=4, base_delay=0.5, max_delay=30,
+                 budget=10, budget_ratio=0.2, failure_threshold=5,
+                 reset_timeout=60):
+        self.name = name
+        self.attempts = attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+
+        self.budget = RetryBudget(budget, budget_ratio)
+        self.breaker = CircuitBreaker(failure_threshold, reset_timeout)
+
+    def delay(self, attempt):
+        '''Seconds to wait before retry number `attempt`.'''
+        ceiling = min(self.max_delay, self.base_delay * 2 ** (attempt - 1))
+        return random.uniform(0, ceiling)
+
+    def call(self, fn, *args, **kwargs):
+        '''Call `fn`, retrying it while it fails in a retryable way.'''
+        attempt = 0
+
+        while True:
+            self.breaker.allow()
+            self.budget.deposit()
+            attempt += 1
+
+            try:
+                result = fn(*args, **kwargs)
+            except Exception as e:
+                if not retryable(e):
+                    # The endpoint answered, it just didn't like us
+                    self.breaker.success()
+                    raise
+
+                self.breaker.failure()
+
+                if attempt >= self.attempts or not self.budget.withdraw():
+                    raise
+
+                delay = self.delay(attempt)
+                logger.warning("{} failed ({}), retrying in {:.1f}s".format(
+                               self.name, e, delay))
+                time.sleep(delay)
+                continue
+
+            self.breaker.success()
+            return result
+
+
+def configure(**settings):
+    '''Change the settings for policies, dropping those already made.'''
+    global _settings
+
+    with _lock:
+        _settings = dict(DEFAULTS, **settings)
+        _policies.clear()
+
+
+def policy(name):
+    '''The process wide RetryPolicy for the endpoint `name`.'''
+    with _lock:
+        if name not in _policies:
+            _policies[name] = RetryPolicy(name, **_settings)
+        return _policies[name]
@@ -0,0 +1,76 @@
+'''
+Shared, connection-pooled HTTP sessions.
+
+StackExchange and Rackspace are hit over and over from the same process, so
+rather than paying for a DNS lookup, TCP connect and TLS handshake on every
+call we keep a `requests.Session` around and let urllib3 hold the
+connections open between requests.
+
+>>> session = make_session(pool_maxsize=20,
+...                        hosts={"api.stackexchange.com": 40})
+'''
+
+import logging
+
+import requests
+from requests.adapters import HTTPAdapter
+
+logger = logging.getLogger(__name__)
+
+# Number of distinct hosts to keep connection pools for
+DEFAULT_POOL_CONNECTIONS = 10
+# Number of connections to keep alive per host
+DEFAULT_POOL_MAXSIZE = 10
+
+_shared_session = None
+
+
+def _adapter(pool_connections, pool_maxsize, pool_block):
+    return HTTPAdapter(pool_connections=pool_connections,
+                       pool_maxsize=pool_maxsize,
+                       pool_block=pool_block)
+
+
+def make_session(pool_connections=DEFAULT_POOL_CONNECTIONS,
+                 pool_maxsize=DEFAULT_POOL_MAXSIZE,
+                 pool_block=False,
+                 hosts=None):
+    '''Create a keep-alive session with sized connection pools.
+
+    `pool_maxsize` is the number of connections kept open per host. Individual
+    hosts can be given their own pool size through `hosts`, a mapping of
+    hostname to pool size, which is handy when one API sees far more
+    concurrent traffic than the other.
+
+    When `pool_block` is set, callers wait for a free connection instead of
+    opening (and then throwing away) one beyond the pool size.
+    '''
+    session = requests.Session()
+
+    default = _adapter(pool_connections, pool_maxsize, pool_block)
+    session.mount("https://", default)
+    session.mount("http://", default)
+
+    for host, maxsize in (hosts or {}).items():
+        adapter = _adapter(pool_connections, maxsize, pool_block)
+        session.mount("https://{}".format(host), adapter)
+        session.mount("http://{}".format(host), adapter)
+
+    return session
+
+
+def get_session():
+    '''Return the process wide session, creating it with defaults if need be.
+    '''
+    global _shared_session
+
+    if _shared_session is None:
+        _shared_session = make_session()
+
+    return _shared_session
+
+
+def set_session(session):
+    '''Replace the process wide session, e.g. with one built from config.'''
+    global _shared_session
+    _shared_session = session
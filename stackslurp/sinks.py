@@ -0,0 +1,284 @@
+'''
+Where slurped events end up.
+
+The slurper hands events to its sink a batch at a time. Each sink says how
+big a batch it takes (`max_batch` events, and `max_bytes` per request where
+it has a limit), and keeps count of what it has written and how long that
+took, so a sink's throughput can be told apart from the rest of the cycle.
+
+* CloudQueuesSink posts to a CloudQueue, as the slurper always has.
+* FileSink appends JSON lines to numbered segment files, fsyncing them
+  together (group commit) rather than once per batch.
+* StdoutSink writes JSON lines to stdout, for piping into something else.
+
+>>> sink = FileSink("/var/slurp/events")
+>>> sink.write([{"url": "http://stackoverflow.com/questions/20912948"}])
+>>> sink.flush()
+>>> sink.stats()["events"]
+1
+'''
+
+import abc
+import logging
+import os
+import re
+import sys
+import threading
+import time
+
+from . import metrics
+from . import utils
+from .rackspace import EnqueueError, MAX_MESSAGES_PER_POST, MAX_POST_BYTES
+
+logger = logging.getLogger(__name__)
+
+sink_events = metrics.counter("stackslurp_sink_events_total",
+                              "Events written to the sink", ["sink"])
+sink_write_seconds = metrics.histogram("stackslurp_sink_write_seconds",
+                                       "Time to write one batch to the sink",
+                                       ["sink"])
+
+_segment_name = re.compile(r"^(\d+)\.jsonl$")
+
+
+class Sink(object):
+    '''Takes batches of events. Subclasses implement `_write`.'''
+    __metaclass__ = abc.ABCMeta
+
+    name = None
+
+    # Events per write, and bytes per request if the sink has a limit
+    max_batch = 100
+    max_bytes = None
+
+    def __init__(self):
+        self.events = 0
+        self.batches = 0
+        self.bytes = 0
+        self.seconds = 0.0
+        self._stats_lock = threading.Lock()
+
+    def prepare(self):
+        '''Get ready to write, e.g. by authenticating. Cheap when already
+        ready.
+        '''
+        pass
+
+    def write(self, events):
+        '''Write a batch of at most `max_batch` events, returning whatever
+        the sink hands back for them.
+        '''
+        started = time.time()
+        try:
+            return self._write(events)
+        finally:
+            elapsed = time.time() - started
+
+            # Failed batches are counted too, as time spent on the sink
+            with self._stats_lock:
+                self.events += len(events)
+                self.batches += 1
+                self.seconds += elapsed
+
+            sink_events.inc(len(events), sink=self.name)
+            sink_write_seconds.observe(elapsed, sink=self.name)
+
+    @abc.abstractmethod
+    def _write(self, events):
+        pass
+
+    def flush(self):
+        '''Make sure everything written so far is durable.'''
+        pass
+
+    def close(self):
+        self.flush()
+
+    def stats(self):
+        '''What's been written so far, and how fast.'''
+        with self._stats_lock:
+            return {"sink": self.name,
+                    "events": self.events,
+                    "batches": self.batches,
+                    "bytes": self.bytes,
+                    "seconds": round(self.seconds, 3),
+                    "events_per_sec": (round(self.events / self.seconds, 1)
+                                       if self.seconds else None)}
+
+
+class CloudQueuesSink(Sink):
+    '''Posts events to `queue` through `rack`, a rackspace.Rackspace.
+    Writes raise rackspace.EnqueueError if any post fails.
+    '''
+
+    name = "cloudqueues"
+
+    def __init__(self, rack, queue, endpoint, ttl=300,
+                 batch_size=MAX_MESSAGES_PER_POST, max_in_flight=1,
+                 max_bytes=MAX_POST_BYTES):
+        super(CloudQueuesSink, self).__init__()
+        self.rack = rack
+        self.queue = queue
+        self.endpoint = endpoint
+        self.ttl = ttl
+        self.batch_size = batch_size
+        self.max_in_flight = max_in_flight
+
+        # Enough for every post in flight at once
+        self.max_batch = batch_size * max_in_flight
+        self.max_bytes = max_bytes
+
+    def prepare(self):
+        # The token is cached, so this only hits identity near expiry
+        self.rack.auth()
+
+    def _write(self, events):
+        try:
+            results = self.rack.enqueue(events, self.queue, self.endpoint,
+                                        self.ttl, batch_size=self.batch_size,
+                                        max_in_flight=self.max_in_flight,
+                                        max_bytes=self.max_bytes)
+        except EnqueueError as e:
+            self._count_bytes(e.results)
+            raise
+
+        self._count_bytes(results)
+        return results
+
+    def close(self):
+        super(CloudQueuesSink, self).close()
+        self.rack.close()
+
+    def _count_bytes(self, results):
+        # Posted, whether or not CloudQueues took them
+        with self._stats_lock:
+            self.bytes += sum(result.bytes for result in results or ())
+
+
+class FileSink(Sink):
+    '''Appends events, one JSON object per line, to segment files in
+    `directory`, starting a new one after `segment_bytes`.
+
+    Writes are fsynced together once `commit_bytes` have built up or
+    `commit_interval` seconds have passed, whichever comes first, and on
+    `flush`. Segments from earlier runs are left alone; each run starts a
+    new one.
+    '''
+
+    name = "file"
+
+    def __init__(self, directory, max_batch=1000, segment_bytes=64 * 1024 ** 2,
+                 commit_bytes=1024 ** 2, commit_interval=1.0):
+        super(FileSink, self).__init__()
+        self.directory = directory
+        self.max_batch = max_batch
+        self.segment_bytes = segment_bytes
+        self.commit_bytes = commit_bytes
+        self.commit_interval = commit_interval
+
+        self.commits = 0
+
+        self._lock = threading.Lock()
+        self._fh = None
+        self._written = 0
+        self._uncommitted = 0
+        self._committed_at = time.time()
+
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+        self._segment = max([int(match.group(1)) for match in
+                             map(_segment_name.match, os.listdir(directory))
+                             if match] or [0])
+
+    def path(self, number):
+        return os.path.join(self.directory, "{:010d}.jsonl".format(number))
+
+    def _write(self, events):
+        data = "".join(utils.json_dumps(event) + "\n" for event in events)
+
+        with self._lock:
+            if self._fh is None or self._written >= self.segment_bytes:
+                self._roll()
+
+            self._fh.write(data)
+            self._written += len(data)
+            self._uncommitted += len(data)
+            self.bytes += len(data)
+
+            if (self._uncommitted >= self.commit_bytes or
+                    time.time() - self._committed_at >= self.commit_interval):
+                self._commit()
+
+    def _roll(self):
+        if self._fh is not None:
+            self._commit()
+            self._fh.close()
+
+        self._segment += 1
+        self._fh = open(self.path(self._segment), "ab")
+        self._written = 0
+
+    def _commit(self):
+        if self._uncommitted:
+            self._fh.flush()
+            os.fsync(self._fh.fileno())
+            self.commits += 1
+
+        self._uncommitted = 0
+        self._committed_at = time.time()
+
+    def flush(self):
+        with self._lock:
+            if self._fh is not None:
+                self._commit()
+
+    def close(self):
+        with self._lock:
+            if self._fh is not None:
+                self._commit()
+                self._fh.close()
+                self._fh = None
+
+
+class StdoutSink(Sink):
+    '''Writes events to `stream`, stdout by default, one JSON object per
+    line.
+    '''
+
+    name = "stdout"
+
+    def __init__(self, stream=None, max_batch=100):
+        super(StdoutSink, self).__init__()
+        self.stream = stream if stream is not None else sys.stdout
+        self.max_batch = max_batch
+        self._lock = threading.Lock()
+
+    def _write(self, events):
+        data = "".join(utils.json_dumps(event) + "\n" for event in events)
+
+        # One write per batch, so batches don't interleave
+        with self._lock:
+            self.stream.write(data)
+            self.stream.flush()
+            self.bytes += len(data)
+
+
+def make_sink(settings):
+    '''A FileSink or StdoutSink from the `sink` section of the config.
+    CloudQueuesSink needs a Rackspace, so is made by the slurper.
+    '''
+    kind = settings.get('type')
+
+    if kind == 'file':
+        return FileSink(settings['directory'],
+                        max_batch=settings.get('max_batch') or 1000,
+                        segment_bytes=settings.get('segment_bytes',
+                                                   64 * 1024 ** 2),
+                        commit_bytes=settings.get('commit_bytes', 1024 ** 2),
+                        commit_interval=settings.get('commit_interval', 1.0))
+
+    if kind == 'stdout':
+        return StdoutSink(max_batch=settings.get('max_batch') or 100)
+
+    raise ValueError("Unknown sink type: {}".format(kind))
@@ -3,23 +3,310 @@ Utilities for pulling question data back from StackExchange sites
 '''
 
 import logging
+import math
+import threading
+import time
 
-import requests
+from . import metrics
+from . import retry
+from . import sessions
+from . import utils
 
 logger = logging.getLogger(__name__)
 
+# StackExchange hands out a fresh daily quota at midnight UTC
+SECONDS_PER_DAY = 86400
+
+api_calls = metrics.counter("stackslurp_api_calls_total",
+                            "StackExchange API calls", ["method", "site"])
+quota_remaining = metrics.gauge("stackslurp_quota_remaining",
+                                "StackExchange requests left today")
+response_bytes = metrics.counter("stackslurp_response_bytes_total",
+                                 "Bytes of StackExchange responses, "
+                                 "decompressed", ["site"])
+
+
+class QuotaScheduler(object):
+    '''Keeps our calls within what the StackExchange API will put up with.
+
+    Every response wrapper reports `quota_remaining` and `quota_max` for our
+    key, and sometimes a `backoff`: the number of seconds to leave that
+    method on that site alone. Ignoring a backoff gets the key banned for a
+    while, so `wait` is called before every request and `update` after.
+
+    The quota state also lets a slurper `pace` itself so that whatever is
+    left of today's quota lasts until it resets.
+    '''
+
+    def __init__(self):
+        self.quota_remaining = None
+        self.quota_max = None
+
+        # When the quota last reported resets, after which it's unknown again
+        self.resets_at = None
+
+        # Requests made through this scheduler, ever
+        self.calls = 0
+
+        # (method, site) -> time the backoff is over
+        self._backoff_until = {}
+
+        self._lock = threading.Lock()
+
+    def wait(self, method, site):
+        '''Block until any backoff on `method` for `site` has passed.'''
+        with self._lock:
+            until = self._backoff_until.get((method, site), 0)
+
+        delay = until - time.time()
+        if delay > 0:
+            logger.info("Backing off {} on {} for {:.0f}s".format(method, site,
+                                                                 delay))
+            time.sleep(delay)
+
+    def update(self, method, site, wrapper):
+        '''Record the quota and backoff from a response wrapper.'''
+        api_calls.inc(method=method, site=site)
+        if 'quota_remaining' in wrapper:
+            quota_remaining.set(wrapper['quota_remaining'])
+
+        with self._lock:
+            self.calls += 1
+
+            if 'quota_remaining' in wrapper:
+                self.quota_remaining = wrapper['quota_remaining']
+                now = time.time()
+                self.resets_at = now + self.seconds_until_reset(now)
+            if 'quota_max' in wrapper:
+                self.quota_max = wrapper['quota_max']
+
+            if 'backoff' in wrapper:
+                self._backoff_until[(method, site)] = (time.time() +
+                                                       wrapper['backoff'])
+
+    def remaining(self, now=None):
+        '''What's left of today's quota, or None if that's not known. Once
+        the quota has reset, it's not known until the next response.
+        '''
+        if now is None:
+            now = time.time()
+
+        with self._lock:
+            if self.resets_at is not None and now >= self.resets_at:
+                self.quota_remaining = None
+                self.resets_at = None
+
+            return self.quota_remaining
+
+    @property
+    def exhausted(self):
+        '''True once today's quota is used up, until it resets.'''
+        remaining = self.remaining()
+        return remaining is not None and remaining <= 0
+
+    def seconds_until_reset(self, now=None):
+        if now is None:
+            now = time.time()
+        return SECONDS_PER_DAY - (int(now) % SECONDS_PER_DAY)
+
+    def pace(self, wait_time, calls_per_cycle, now=None):
+        '''Seconds to wait before the next cycle, never less than `wait_time`.
+
+        Spreads the remaining quota evenly over the rest of the day, assuming
+        each cycle costs `calls_per_cycle` requests. With not even one more
+        cycle's worth left, waits for the quota to reset.
+        '''
+        remaining = self.remaining(now)
+        if remaining is None or calls_per_cycle <= 0:
+            return wait_time
+
+        until_reset = self.seconds_until_reset(now)
+
+        cycles_left = remaining // calls_per_cycle
+        if cycles_left < 1:
+            return max(wait_time, until_reset)
+
+        return max(wait_time, float(until_reset) / cycles_left)
+
+
+class QueryPlan(object):
+    '''The calls to make for an OR of tags, and what they should cost.
+
+    `calls` are (method, params) pairs: "search" calls go to /search and
+    "questions" calls to /questions. `cost` is the estimated number of
+    requests, counting any made to come up with the plan.
+    '''
+
+    def __init__(self, strategy, calls, cost):
+        self.strategy = strategy
+        self.calls = calls
+        self.cost = cost
+
+    def __repr__(self):
+        return "<QueryPlan {} of {} calls, ~{} requests>".format(self.strategy,
+                len(self.calls), self.cost)
+
+
+class QueryPlanner(object):
+    '''Turns "any of these tags" into as few API calls as it can.
+
+    Tags given to the API together are ANDed, so there are two ways to OR
+    them:
+
+    * "per_tag": one /search per tag. Each also passes the tags before it as
+      `nottagged`, so no question comes back twice and no page is wasted on
+      repeats.
+    * "firehose": one untagged /questions call for everything asked on the
+      site, filtered down here. That costs a page per 100 questions, which
+      beats per_tag on quiet sites or with long tag lists.
+
+    How busy a site is comes from a one call count, remembered as a rate for
+    `rate_ttl` seconds so it isn't paid for every cycle.
+    '''
+
+    # Fewer tags than this always go per_tag, without counting
+    firehose_min_tags = 3
+
+    def __init__(self, rate_ttl=3600):
+        self.rate_ttl = rate_ttl
+
+        # site -> (questions per second, when it was measured)
+        self.rates = {}
+
+    def plan(self, tags, site, since, count=None, now=None):
+        '''Plan the calls for questions on `site` since `since` with any of
+        `tags`. `count` is a function returning how many questions the site
+        has had since `since`; without it the plan is always per_tag.
+        '''
+        tags = [tag for n, tag in enumerate(tags) if tag not in tags[:n]]
+
+        calls = []
+        for n, tag in enumerate(tags):
+            params = {"tagged": tag}
+            if n:
+                params["nottagged"] = ";".join(tags[:n])
+            calls.append(("search", params))
+
+        per_tag = QueryPlan("per_tag", calls, len(calls))
+
+        if len(tags) < self.firehose_min_tags or count is None:
+            return per_tag
+
+        expected, lookups = self.expected_total(site, since, count, now)
+
+        firehose = QueryPlan("firehose", [("questions", {})],
+                             max(1, int(math.ceil(expected / 100.0))) + lookups)
+        per_tag.cost += lookups
+
+        if firehose.cost < per_tag.cost:
+            return firehose
+        return per_tag
+
+    def expected_total(self, site, since, count, now=None):
+        '''Roughly how many questions `site` has had since `since`, and how
+        many calls it took to find out.
+        '''
+        if now is None:
+            now = time.time()
+
+        window = max(now - since, 1)
+
+        rate, measured = self.rates.get(site, (None, 0))
+        if rate is not None and now - measured <= self.rate_ttl:
+            return rate * window, 0
+
+        total = count()
+        self.rates[site] = (total / float(window), now)
+        return total, 1
+
+
 class StackExchange(object):
 
     search_api = "https://api.stackexchange.com/2.1/search"
+    questions_api = "https://api.stackexchange.com/2.1/questions"
+    users_api = "https://api.stackexchange.com/2.1/users"
+    filters_api = "https://api.stackexchange.com/2.1/filters/create"
+
+    # Shared by every search so backoffs and quota hold across sites
+    scheduler = QuotaScheduler()
+
+    # Largest page the API will hand back
+    max_pagesize = 100
+
+    # Fields slurping can't do without, kept in every filter we create
+    required_fields = [".has_more", ".quota_remaining", ".quota_max",
+                       ".backoff", "question.question_id", "question.link",
+                       "question.title", "question.tags",
+                       "question.creation_date", "question.last_activity_date",
+                       "question.answer_count", "question.accepted_answer_id"]
+
+    # Filter ids we've created, by what they were created with
+    _filters = {}
+
+    @classmethod
+    def create_filter(cls, include=(), exclude=(), base="default",
+                      unsafe=False, stackexchange_key=None, session=None):
+        '''Get the id of a response filter that trims responses down to the
+        fields we need. `include` and `exclude` are lists of fields such as
+        "question.owner" or ".quota_max", applied on top of the `base` filter.
+
+        Filters never change once made, so each one is only created once per
+        process. To skip creating it at all, put the id that gets logged in
+        the config instead.
+
+        >>> StackExchange.create_filter(base="none",
+        ...                             include=["question.score"])
+        u'!...'
+        '''
+        include = sorted(set(include) | set(cls.required_fields))
+        exclude = sorted(set(exclude) - set(cls.required_fields))
+
+        spec = (tuple(include), tuple(exclude), base, unsafe)
+        if spec in cls._filters:
+            return cls._filters[spec]
+
+        params = {
+            "include": ";".join(include),
+            "exclude": ";".join(exclude),
+            "base": base,
+            "unsafe": unsafe
+        }
+
+        if(stackexchange_key):
+            params["key"] = stackexchange_key
+
+        if session is None:
+            session = sessions.get_session()
+
+        wrapper = retry.policy("stackexchange").call(cls._get, session,
+                                                     cls.filters_api, params)
+
+        filter_id = wrapper['items'][0]['filter']
+        logger.info("Created StackExchange filter {}".format(filter_id))
+
+        cls._filters[spec] = filter_id
+        return filter_id
 
     @classmethod
     def search_questions(cls, since, tags, site,
                          stackexchange_key=None,
                          order="desc",
-                         sort_on="creation"):
-        # Get all questions with `tags` on `site` since the time provided.
-        # >>> search_questions(since=1384752718, tags=['c'],
-        # ... site='stackoverflow')
+                         sort_on="creation",
+                         session=None,
+                         pagesize=max_pagesize,
+                         filter=None,
+                         min_value=None,
+                         todate=None):
+        # Generate all questions with `tags` on `site` since the time provided,
+        # following pages until the API says there are no more. A `filter`
+        # id (see create_filter) trims down what comes back.
+        #
+        # `since` goes by creation date whatever we sort on, and can be None
+        # for no limit; `todate` is the latest creation date. `min_value` is
+        # the lowest value of the field sorted on, so sort_on="activity" with
+        # min_value finds questions active since then.
+        # >>> list(search_questions(since=1384752718, tags=['c'],
+        # ... site='stackoverflow'))
 
         # When provided a list, form the proper tag string
         if not isinstance(tags, basestring):
@@ -28,25 +315,218 @@ class StackExchange(object):
         logging.info(tags)
 
         params = {
-            "fromdate": since,
             "order": order,
             "sort": sort_on,
             "tagged": tags,
             "site": site,
-            "withbody": False
+            "withbody": False,
+            "pagesize": pagesize
         }
 
-        headers = {
-            "Accept-Encoding": "gzip"
-        }
+        if since is not None:
+            params["fromdate"] = since
+
+        if todate is not None:
+            params["todate"] = todate
+
+        if min_value is not None:
+            params["min"] = min_value
 
         if(stackexchange_key):
             params["key"] = stackexchange_key
 
+        if filter is not None:
+            params["filter"] = filter
+
         logging.info(params)
 
-        resp = requests.get(cls.search_api, params=params, headers=headers)
+        for question in cls._pages(cls.search_api, "search", site, params,
+                                   session):
+            yield question
+
+    @classmethod
+    def search_any(cls, since, tags, site,
+                   stackexchange_key=None,
+                   order="desc",
+                   sort_on="creation",
+                   session=None,
+                   pagesize=max_pagesize,
+                   filter=None,
+                   planner=None,
+                   min_value=None,
+                   todate=None):
+        '''Generate questions on `site` since `since` tagged with *any* of
+        `tags`, where search_questions wants all of them. `since`, `todate`
+        and `min_value` work as they do there.
+
+        The API has no OR for tags, so a QueryPlanner (a fresh one unless
+        `planner` is given) picks the calls to make. Questions are yielded as
+        each call pages through them, with any repeats dropped.
+
+        >>> list(StackExchange.search_any(1384752718, ["c", "go", "rust"],
+        ...                               "stackoverflow"))
+        '''
+        if isinstance(tags, basestring):
+            tags = tags.split(";")
+
+        if planner is None:
+            planner = QueryPlanner()
+
+        def count():
+            return cls.count_questions(since, site, stackexchange_key,
+                                       session=session)
+
+        # The planner's rates are for windows ending now. Without one there's
+        # no telling how much the firehose would bring back.
+        if since is None or todate is not None:
+            count = None
+
+        plan = planner.plan(tags, site, since, count)
+        logger.info("Searching {} for any of {} tags: {}".format(site,
+                    len(tags), plan))
+
+        base = {
+            "order": order,
+            "sort": sort_on,
+            "site": site,
+            "pagesize": pagesize
+        }
+
+        if since is not None:
+            base["fromdate"] = since
+
+        if todate is not None:
+            base["todate"] = todate
+
+        if min_value is not None:
+            base["min"] = min_value
+
+        if(stackexchange_key):
+            base["key"] = stackexchange_key
+
+        if filter is not None:
+            base["filter"] = filter
+
+        wanted = set(tags)
+        seen = set()
+
+        for method, call_params in plan.calls:
+            params = dict(base, **call_params)
+            url = cls.search_api if method == "search" else cls.questions_api
+
+            for question in cls._pages(url, method, site, params, session):
+                if question['question_id'] in seen:
+                    continue
+
+                # Untagged calls bring back everything on the site
+                if method == "questions" and not wanted.intersection(
+                        question['tags']):
+                    continue
+
+                seen.add(question['question_id'])
+                yield question
+
+    @classmethod
+    def count_questions(cls, since, site, stackexchange_key=None,
+                        session=None):
+        '''How many questions have been asked on `site` since `since`.
+        Costs one call however many there are.
+        '''
+        params = {"fromdate": since, "site": site, "filter": "total"}
+
+        if(stackexchange_key):
+            params["key"] = stackexchange_key
+
+        if session is None:
+            session = sessions.get_session()
+
+        cls.scheduler.wait("questions", site)
+
+        wrapper = retry.policy("stackexchange").call(cls._get, session,
+                                                     cls.questions_api, params)
+        cls.scheduler.update("questions", site, wrapper)
+
+        return wrapper['total']
+
+    @classmethod
+    def get_questions(cls, ids, site, stackexchange_key=None, session=None,
+                      filter="withbody"):
+        '''Generate the questions with the given ids on `site`, fetching
+        them `max_pagesize` to a call. The `filter` defaults to the built in
+        one that adds each question's body.
+
+        >>> list(StackExchange.get_questions([20912948, 20910273],
+        ...                                  "stackoverflow"))
+        '''
+        return cls._by_ids(cls.questions_api, "questions", ids, site,
+                           stackexchange_key, session, filter)
+
+    @classmethod
+    def get_users(cls, ids, site, stackexchange_key=None, session=None,
+                  filter=None):
+        '''Generate the users with the given ids on `site`, fetching them
+        `max_pagesize` to a call.
+
+        >>> list(StackExchange.get_users([700228], "stackoverflow"))
+        '''
+        return cls._by_ids(cls.users_api, "users", ids, site,
+                           stackexchange_key, session, filter)
+
+    @classmethod
+    def _by_ids(cls, api, method, ids, site, stackexchange_key=None,
+                session=None, filter=None):
+        '''Generate the items with `ids` from a vectorized call such as
+        /questions/{ids}, `max_pagesize` ids to a call.
+        '''
+        params = {"site": site, "pagesize": cls.max_pagesize}
+
+        if(stackexchange_key):
+            params["key"] = stackexchange_key
+
+        if filter is not None:
+            params["filter"] = filter
+
+        for chunk in utils.chunks(ids, cls.max_pagesize):
+            url = "{}/{}".format(api, ";".join(str(id) for id in chunk))
+
+            for item in cls._pages(url, method, site, params, session):
+                yield item
+
+    @classmethod
+    def _pages(cls, url, method, site, params, session=None):
+        '''Generate the items from every page of a call, minding the
+        scheduler's backoffs and keeping it up to date on the quota. A page
+        that fails is retried on its own.
+        '''
+        if session is None:
+            session = sessions.get_session()
+
+        params = dict(params)
+        page = 1
+
+        while True:
+            params["page"] = page
+
+            cls.scheduler.wait(method, site)
+
+            wrapper = retry.policy("stackexchange").call(cls._get, session,
+                                                         url, params)
+            cls.scheduler.update(method, site, wrapper)
+
+            for item in wrapper['items']:
+                yield item
+
+            if not wrapper.get('has_more'):
+                break
+
+            page += 1
+
+    @staticmethod
+    def _get(session, url, params):
+        '''Make one request, returning the response wrapper.'''
+        resp = session.get(url, params=params,
+                           headers={"Accept-Encoding": "gzip"})
         resp.raise_for_status()
 
-        questions = resp.json()['items']
-        return questions
+        response_bytes.inc(len(resp.content), site=params.get("site", ""))
+        return resp.json()
@@ -0,0 +1,180 @@
+'''
+Looks up the users asking questions, to say more about them than the owner
+snippet searches come back with.
+
+User records are cached for `ttl` seconds. New questions are held back per
+site until 100 of them, or until that site's search is done, and any of
+their owners missing from the cache or out of date are fetched in one call
+to /users/{ids}. Most askers on a busy tag ask again within the day, so most
+events need no call at all.
+
+Each question gets an `asker`: the owner's id, name, reputation and user
+type as of the last lookup, and whether their network account is one of
+`internal_accounts`.
+
+>>> annotator = UserAnnotator(lambda site, ids: StackExchange.get_users(
+...     ids, site), UserCache(path="users.json"), internal_accounts=[700228])
+>>> for site, question in annotator.annotate(site_questions):
+...     print question["asker"]["reputation"]
+'''
+
+import json
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from . import utils
+
+logger = logging.getLogger(__name__)
+
+# What's kept of each user record
+USER_FIELDS = ("user_id", "account_id", "display_name", "reputation",
+               "user_type")
+
+
+def user_record(user):
+    '''The USER_FIELDS of a user from the API.'''
+    return dict((field, user[field]) for field in USER_FIELDS
+                if field in user)
+
+
+class UserCache(object):
+    '''User records by (site, user_id), each good for `ttl` seconds after
+    it was fetched. Holds up to `max_size`, dropping the least recently used
+    first.
+
+    With a `path`, records are saved there by `save` and those still good
+    are read back on startup.
+    '''
+
+    def __init__(self, ttl=86400, max_size=10000, path=None):
+        self.ttl = ttl
+        self.max_size = max_size
+        self.path = path
+
+        self.hits = 0
+        self.misses = 0
+
+        # (site, user_id) -> (fetched at, record)
+        self._users = OrderedDict()
+        self._lock = threading.Lock()
+
+        if path is not None and os.path.exists(path):
+            now = time.time()
+            with open(path) as fh:
+                with self._lock:
+                    for site, user_id, fetched, record in json.load(fh):
+                        if now - fetched < ttl:
+                            self._users[(site, user_id)] = (fetched, record)
+            logger.info("Loaded {} users from {}".format(len(self), path))
+
+    def __len__(self):
+        return len(self._users)
+
+    def get(self, site, user_id, now=None):
+        '''The record for a user, or None if it's missing or out of date.'''
+        if now is None:
+            now = time.time()
+
+        with self._lock:
+            entry = self._users.pop((site, user_id), None)
+            if entry is None or now - entry[0] >= self.ttl:
+                self.misses += 1
+                return None
+
+            self.hits += 1
+            self._users[(site, user_id)] = entry
+            return entry[1]
+
+    def add(self, site, users, now=None):
+        '''Record freshly fetched user records for `site`.'''
+        if now is None:
+            now = time.time()
+
+        with self._lock:
+            for user in users:
+                key = (site, user['user_id'])
+                self._users.pop(key, None)
+                self._users[key] = (now, user_record(user))
+
+            while len(self._users) > self.max_size:
+                self._users.popitem(last=False)
+
+    def save(self):
+        if self.path is None:
+            return
+
+        with self._lock:
+            users = [[site, user_id, fetched, record] for (site, user_id),
+                     (fetched, record) in self._users.items()]
+
+        utils.atomic_write(self.path, json.dumps(users))
+
+
+class UserAnnotator(object):
+    '''Adds an `asker` to (site, question) pairs, using `fetch(site, ids)`
+    to look up users `batch_size` at a time.
+    '''
+
+    def __init__(self, fetch, cache, internal_accounts=(), batch_size=100):
+        self.fetch = fetch
+        self.cache = cache
+        self.internal_accounts = frozenset(internal_accounts)
+        self.batch_size = batch_size
+
+        # Calls to `fetch`, and users they brought back
+        self.calls = 0
+        self.fetched = 0
+
+    def annotate(self, site_questions):
+        '''Generate the (site, question) pairs with `asker` added where the
+        owner could be looked up. Questions keep their order within each
+        site.
+        '''
+        for site, batch in utils.site_batches(site_questions, self.batch_size):
+            if batch is utils.SITE_DONE:
+                yield site, batch
+                continue
+
+            for item in self._fill(site, batch):
+                yield item
+
+    def _fill(self, site, questions):
+        users = {}
+        missing = set()
+
+        for question in questions:
+            # No user_id if the owner has since been deleted
+            user_id = question.get('owner', {}).get('user_id')
+            if user_id is None or user_id in users or user_id in missing:
+                continue
+
+            record = self.cache.get(site, user_id)
+            if record is None:
+                missing.add(user_id)
+            else:
+                users[user_id] = record
+
+        if missing:
+            try:
+                self.calls += 1
+                fetched = list(self.fetch(site, sorted(missing)))
+                self.cache.add(site, fetched)
+                self.fetched += len(fetched)
+
+                for user in fetched:
+                    users[user['user_id']] = user_record(user)
+            except Exception:
+                # The questions can go without
+                logger.exception("Looking up {} users on {} failed".format(
+                                 len(missing), site))
+
+        for question in questions:
+            record = users.get(question.get('owner', {}).get('user_id'))
+            if record is not None:
+                question = dict(question, asker=dict(record,
+                                internal=record.get('account_id') in
+                                self.internal_accounts))
+            yield site, question
@@ -1,8 +1,29 @@
 '''Helper functions'''
 
+import calendar
+import json
+import os
+import re
+import tempfile
+from collections import OrderedDict
+from itertools import islice
+
+# ujson, when it's installed, encodes several times faster than json
+try:
+    import ujson
+except ImportError:
+    ujson = None
+
+# In a stream of (site, question) pairs, (site, SITE_DONE) says that site has
+# no more questions to come
+SITE_DONE = object()
+
 def chunks(lst, n):
     """Yield successive n-sized chunks from lst, in order.
 
+    `lst` can be any iterable. It's consumed a chunk at a time, so chunking a
+    generator doesn't pull everything into memory first.
+
     >>> chunks(range(5), 2) # doctest: +ELLIPSIS, +NORMALIZE_WHITESPACE
     <generator object chunks at 0x...>
 
@@ -20,7 +41,179 @@ def chunks(lst, n):
     >>> block_chunks = chunks(blocks, 2)
     >>> block_chunks.next()
     ['brick', 'cobblestone']
+
+    >>> list(chunks(iter("stone"), 2))
+    [['s', 't'], ['o', 'n'], ['e']]
+    """
+
+    items = iter(lst)
+
+    while True:
+        chunk = list(islice(items, n))
+        if not chunk:
+            return
+        yield chunk
+
+
+def sized_chunks(lst, n, max_size, size=len):
+    """Yield successive chunks of at most n items from lst, in order, whose
+    sizes (as given by `size`) add up to no more than max_size. An item
+    bigger than max_size on its own gets a chunk to itself.
+
+    >>> list(sized_chunks(["brick", "cobblestone", "clay", "dirt"], 3, 12))
+    [['brick'], ['cobblestone'], ['clay', 'dirt']]
+    """
+    chunk = []
+    total = 0
+
+    for item in lst:
+        item_size = size(item)
+
+        if chunk and (len(chunk) >= n or total + item_size > max_size):
+            yield chunk
+            chunk = []
+            total = 0
+
+        chunk.append(item)
+        total += item_size
+
+    if chunk:
+        yield chunk
+
+
+def site_batches(site_questions, n):
+    """Group (site, question) pairs into (site, [question, ...]) batches of
+    up to n questions, keeping order within each site. A site's batch is
+    yielded once full, once the site is done, and any part full ones at the
+    end. (site, SITE_DONE) pairs are passed on after the site's last batch.
+
+    >>> list(site_batches([("so", 1), ("sf", 2), ("so", 3)], 2))
+    [('so', [1, 3]), ('sf', [2])]
+    """
+    waiting = OrderedDict()
+
+    for site, question in site_questions:
+        if question is SITE_DONE:
+            if site in waiting:
+                yield site, waiting.pop(site)
+            yield site, question
+            continue
+
+        batch = waiting.setdefault(site, [])
+        batch.append(question)
+
+        if len(batch) >= n:
+            del waiting[site]
+            yield site, batch
+
+    for site, batch in waiting.items():
+        yield site, batch
+
+
+def json_dumps(obj):
+    """`obj` encoded as ASCII JSON, with ujson if it's installed.
+
+    >>> json_dumps({"tags": ["python"]})
+    '{"tags":["python"]}'
+    """
+    if ujson is not None:
+        return ujson.dumps(obj, escape_forward_slashes=False)
+    return json.dumps(obj, separators=(",", ":"))
+
+
+def tag_query(tags):
+    """The StackExchange form of a tag list, also used to tell one set of tags
+    from another in checkpoints and shards.
+
+    >>> tag_query(["python", "ruby"])
+    'python;ruby'
+    >>> tag_query("python")
+    'python'
+    """
+    if not isinstance(tags, basestring):
+        tags = ";".join(tags)
+    return tags
+
+
+def project(document, fields):
+    """Copy of the dict `document` holding only `fields`. Fields can reach
+    into nested dicts with dots. Fields that aren't there are left out.
+
+    >>> question = {"title": "Moo", "score": 3,
+    ...             "owner": {"user_id": 700228, "profile_image": "..."}}
+    >>> project(question, ["title", "owner.user_id", "owner.age"])
+    {'owner': {'user_id': 700228}, 'title': 'Moo'}
+    """
+    projected = {}
+
+    for field in fields:
+        path = field.split(".")
+
+        value = document
+        for key in path:
+            if not isinstance(value, dict) or key not in value:
+                break
+            value = value[key]
+        else:
+            target = projected
+            for key in path[:-1]:
+                target = target.setdefault(key, {})
+            target[path[-1]] = value
+
+    return projected
+
+
+_iso8601 = re.compile(r"(\d{4})-(\d{2})-(\d{2})T(\d{2}):(\d{2}):(\d{2})"
+                      r"(?:\.\d+)?(Z|[+-]\d{2}:?\d{2})?$")
+
+
+def parse_iso8601(timestamp):
+    """Seconds since the epoch for an ISO 8601 timestamp, as handed back by
+    Rackspace Identity. Timestamps without an offset are taken as UTC.
+
+    >>> parse_iso8601("2014-01-10T22:00:00Z")
+    1389391200
+    >>> parse_iso8601("2014-01-10T16:00:00.000-06:00")
+    1389391200
+    """
+    match = _iso8601.match(timestamp)
+    if match is None:
+        raise ValueError("Not an ISO 8601 timestamp: {}".format(timestamp))
+
+    fields = [int(field) for field in match.groups()[:6]]
+    seconds = calendar.timegm(fields)
+
+    offset = match.group(7)
+    if offset and offset != "Z":
+        sign = -1 if offset[0] == "-" else 1
+        seconds -= sign * (int(offset[1:3]) * 3600 + int(offset[-2:]) * 60)
+
+    return seconds
+
+
+def atomic_write(path, data):
+    """Replace the file at `path` with `data` such that a crash leaves either
+    the old contents or the new, never a mix of the two.
+
+    The data goes to a temporary file in the same directory, is synced to
+    disk, then renamed over the original.
     """
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, tmp_path = tempfile.mkstemp(dir=directory,
+                                    prefix="." + os.path.basename(path))
+    try:
+        with os.fdopen(fd, "wb") as fh:
+            fh.write(data)
+            fh.flush()
+            os.fsync(fh.fileno())
+        os.rename(tmp_path, path)
+    except Exception:
+        os.unlink(tmp_path)
+        raise
 
-    for i in xrange(0, len(lst), n):
-        yield lst[i:i + n]
+    # Make the rename itself durable
+    dir_fd = os.open(directory, os.O_RDONLY)
+    try:
+        os.fsync(dir_fd)
+    finally:
+        os.close(dir_fd)
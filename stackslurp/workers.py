@@ -0,0 +1,226 @@
+'''
+Spreads one config's sites over several worker processes.
+
+Each (site, tag query) pair is a shard, and every shard is handed to the same
+worker every time, so its checkpoint and seen questions stay with it. Worker
+logs and per-cycle stats come back to the parent over a queue, so there's one
+log to read and one place to see how the whole slurp is doing.
+
+>>> pool = WorkerPool(config, 4, StackSlurp)
+>>> pool.run()
+'''
+
+import copy
+import logging
+import multiprocessing
+import Queue
+import signal
+import time
+import zlib
+
+from . import logs
+from . import metrics
+from . import retry
+from . import utils
+
+logger = logging.getLogger(__name__)
+
+
+def assign_shards(sites, query, workers):
+    '''Deal out the (site, query) shards over `workers` workers.
+
+    Returns a list with the sites for each worker. The assignment depends only
+    on the shard and the number of workers, so restarts keep each shard on
+    the same worker.
+
+    >>> assign_shards(["stackoverflow", "serverfault", "askubuntu"], "python", 2)
+    [['stackoverflow', 'serverfault'], ['askubuntu']]
+    '''
+    assigned = [[] for _ in range(workers)]
+
+    for site in sites:
+        shard = "{}|{}".format(site, query)
+        assigned[(zlib.crc32(shard) & 0xffffffff) % workers].append(site)
+
+    return assigned
+
+
+def worker_config(config, worker, sites, workers=1):
+    '''The config for one worker of `workers`, covering only its own sites.
+    '''
+    config = copy.deepcopy(config)
+    config['sites'] = sites
+
+    # The StackExchange quota is per key, so shared with the other workers
+    config['workers'] = workers
+
+    # Seen questions, question states, outboxes, recordings, event files and
+    # users are kept per worker. Checkpoints can share one file.
+    for section, key in (('dedup', 'file'), ('activity', 'file'),
+                         ('outbox', 'directory'), ('cassette', 'record'),
+                         ('sink', 'directory'), ('users', 'file')):
+        settings = config.get(section, {})
+        if settings.get(key):
+            settings[key] = "{}.{}".format(settings[key], worker)
+
+    # Each worker serves its own metrics, worker n on the configured port + n
+    exposed = config.get('metrics', {})
+    if exposed.get('port'):
+        exposed['port'] += worker
+
+    return config
+
+
+def work(config, worker, slurper_class, messages):
+    '''Run a slurper in a worker process, reporting back over `messages`.'''
+    # Ctrl-C goes to the whole process group; let the parent decide
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+
+    # Sampled here, so records the parent would drop aren't sent to it
+    logging_config = config.get('logging', {})
+    handler = logs.QueueHandler(messages)
+    handler.addFilter(logs.SampleFilter(logging_config.get('sample_rate', 1.0)))
+    root.addHandler(handler)
+    root.setLevel(getattr(logging, str(logging_config.get('level', 'DEBUG'))
+                          .upper()))
+
+    metrics.start(**config.get('metrics', {}))
+    retry.configure(**config.get('retry', {}))
+
+    slurper = slurper_class(config)
+
+    while True:
+        slurper.run_cycle()
+        messages.put(("stats", worker, slurper.cycle_stats))
+        time.sleep(slurper.cycle_wait())
+
+
+class WorkerPool(object):
+    '''Runs `slurper_class` over `workers` processes, each with its share of
+    the configured sites.
+    '''
+
+    def __init__(self, config, workers, slurper_class, restart_delay=1,
+                 max_restart_delay=300):
+        self.config = config
+        self.slurper_class = slurper_class
+        self.restart_delay = restart_delay
+        self.max_restart_delay = max_restart_delay
+
+        query = utils.tag_query(config['tags'])
+        self.shards = assign_shards(config['sites'], query, workers)
+
+        self.messages = multiprocessing.Queue()
+        self.processes = {}
+
+        # worker -> running totals of cycles, failed cycles, events, seconds
+        self.stats = {}
+
+        # worker -> exits since its last finished cycle, and when a dead
+        # worker is due to be restarted
+        self.crashes = {}
+        self.restart_at = {}
+
+    def start(self):
+        for worker, sites in enumerate(self.shards):
+            if not sites:
+                logger.info("Worker {} has no shards, skipping".format(worker))
+                continue
+            self._spawn(worker)
+
+    def _spawn(self, worker):
+        config = worker_config(self.config, worker, self.shards[worker],
+                               len([sites for sites in self.shards if sites]))
+
+        process = multiprocessing.Process(target=work,
+                                          name="slurp-worker-{}".format(worker),
+                                          args=(config, worker,
+                                                self.slurper_class,
+                                                self.messages))
+        process.daemon = True
+        process.start()
+
+        logger.info("Worker {} (pid {}) slurping {}".format(worker,
+                    process.pid, ", ".join(self.shards[worker])))
+        self.processes[worker] = process
+
+    def handle(self, message):
+        '''Deal with a log record or stats message from a worker.'''
+        if isinstance(message, logging.LogRecord):
+            logs.handle_record(message)
+            return
+
+        kind, worker, cycle = message
+
+        # Made it through a cycle, so it's not crashing on startup
+        self.crashes[worker] = 0
+
+        totals = self.stats.setdefault(worker, {"cycles": 0, "failed": 0,
+                                                "events": 0, "duration": 0.0})
+        totals["cycles"] += 1
+        totals["failed"] += 0 if cycle.get("ok") else 1
+        totals["events"] += cycle.get("events", 0)
+        totals["duration"] += cycle.get("duration", 0.0)
+
+        logger.info("Worker {}: {} events in {:.1f}s; all workers: {} events, "
+                    "{} of {} cycles failed".format(worker,
+                    cycle.get("events", 0), cycle.get("duration", 0.0),
+                    sum(t["events"] for t in self.stats.values()),
+                    sum(t["failed"] for t in self.stats.values()),
+                    sum(t["cycles"] for t in self.stats.values())))
+
+    def check_workers(self, now=None):
+        '''Bring back any worker that has died. A worker that keeps dying
+        before finishing a cycle is restarted after `restart_delay` seconds,
+        doubling each time up to `max_restart_delay`.
+        '''
+        if now is None:
+            now = time.time()
+
+        for worker, process in self.processes.items():
+            if process.is_alive():
+                continue
+
+            if worker not in self.restart_at:
+                crashes = self.crashes.get(worker, 0)
+                delay = min(self.restart_delay * 2 ** crashes,
+                            self.max_restart_delay)
+                self.crashes[worker] = crashes + 1
+                self.restart_at[worker] = now + delay
+
+                logger.error("Worker {} exited with {}, restarting in "
+                             "{}s".format(worker, process.exitcode, delay))
+
+            if now >= self.restart_at[worker]:
+                del self.restart_at[worker]
+                self._spawn(worker)
+
+    def stop(self):
+        for process in self.processes.values():
+            process.terminate()
+        for process in self.processes.values():
+            process.join()
+
+    def run(self):
+        '''Start the workers and relay their messages until interrupted.'''
+        def handle_term(signum, frame):
+            raise SystemExit(0)
+
+        signal.signal(signal.SIGTERM, handle_term)
+
+        self.start()
+
+        try:
+            while True:
+                try:
+                    self.handle(self.messages.get(timeout=1))
+                except Queue.Empty:
+                    pass
+
+                self.check_workers()
+        finally:
+            self.stop()
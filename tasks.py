@@ -7,3 +7,9 @@ from invoke import run, task
 @task
 def test():
     run('py.test', pty=True)
+
+
+@task
+def bench():
+    run('PYTHONPATH=. python tests/bench_stackslurp.py --output bench.json',
+        pty=True)
@@ -0,0 +1,278 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''
+Benchmarks for the fetch, transform and enqueue path.
+
+Built on FakeExchange from test_stackslurp, scaled up to thousands of synthetic
+questions over many sites. Sending goes through the real Rackspace.enqueue,
+batching and JSON encoding included, with only the HTTP session faked out.
+
+Each stage runs in a fresh process, so its peak memory is its own and it
+starts with nothing cached or deduplicated. `latency_ms` is per event for
+generate_events, and per call to enqueue for the others.
+
+Results are written as JSON so runs from different releases can be compared.
+Given an earlier run with --compare, stages that have slowed down by more
+than --tolerance fail the run.
+
+    $ make bench
+    $ python tests/bench_stackslurp.py --sites 20 --questions 500 \
+    >     -o bench.json --compare bench-0.4.0.json
+'''
+
+import argparse
+import json
+import multiprocessing
+import platform
+import resource
+import StringIO
+import sys
+import time
+
+import yaml
+
+import stackslurp
+import stackslurp.main
+
+from test_stackslurp import FakeExchange
+
+
+class SyntheticExchange(FakeExchange):
+    '''FakeExchange's questions, copied out to `questions` per site.'''
+
+    questions = 500
+
+    @classmethod
+    def search_questions(cls, since, tags, site, stackexchange_key=None,
+                         order="desc", sort_on="creation", **kwargs):
+        templates = FakeExchange.search_questions(since, tags, site)
+        offset = abs(hash(site)) % 10000000 * 1000000
+
+        for n in range(cls.questions):
+            question = dict(templates[n % len(templates)])
+            question_id = offset + n
+            question.update(question_id=question_id,
+                            creation_date=1388784322 - n,
+                            link="http://{}.com/questions/{}".format(
+                                 site, question_id))
+            yield question
+
+
+class Response(object):
+    status_code = 201
+
+    def __init__(self, data):
+        self.count = len(json.loads(data))
+
+    def json(self):
+        return {"partial": False,
+                "resources": ["/v1/queues/bench/messages/x"] * self.count}
+
+    def raise_for_status(self):
+        pass
+
+
+class NullSession(object):
+    '''Takes every post, as CloudQueues would on a good day.'''
+
+    def post(self, url, data, headers):
+        return Response(data)
+
+
+class BenchSpace(stackslurp.rackspace.Rackspace):
+    '''Rackspace with a session that goes nowhere, timing each enqueue.'''
+
+    def __init__(self, username, api_key, session=None):
+        super(BenchSpace, self).__init__(username, api_key,
+                                         session=NullSession())
+        self.token = "seemslegit"
+        self.expires = time.time() + 86400
+        self.timings = []
+
+    def enqueue(self, messages, *args, **kwargs):
+        started = time.time()
+        try:
+            return super(BenchSpace, self).enqueue(messages, *args, **kwargs)
+        finally:
+            self.timings.append(time.time() - started)
+
+
+def make_config(sites, batch_size, max_in_flight):
+    config = {
+        "stackexchange_key": "bench",
+        "tags": ["python"],
+        "sites": ["site{}".format(n) for n in range(sites)],
+        "rackspace": {"username": "bench", "api_key": "bench",
+                      "queue_endpoint": "https://localhost/v1/"},
+        "queue": "bench",
+        "batch_size": batch_size,
+        "max_in_flight": max_in_flight,
+        "max_concurrency": min(sites, 8),
+    }
+    return stackslurp.main.read_config(StringIO.StringIO(
+        yaml.safe_dump(config)))
+
+
+def make_slurper(config, questions):
+    SyntheticExchange.questions = questions
+    stackslurp.main.StackExchange = SyntheticExchange
+    stackslurp.main.Rackspace = BenchSpace
+    return stackslurp.main.StackSlurp(config)
+
+
+def percentiles(timings):
+    '''p50/p95/p99/max of `timings`, in milliseconds.'''
+    if not timings:
+        return {}
+
+    timings = sorted(timings)
+
+    def at(fraction):
+        return timings[min(len(timings) - 1, int(len(timings) * fraction))]
+
+    return dict((name, round(at(fraction) * 1000, 3)) for name, fraction in
+                [("p50", 0.5), ("p95", 0.95), ("p99", 0.99), ("max", 1.0)])
+
+
+def bench_generate(slurper):
+    '''Fetch and build every event, timing the gap before each one.'''
+    timings = []
+
+    last = time.time()
+    for event in slurper.generate_events():
+        now = time.time()
+        timings.append(now - last)
+        last = now
+
+    return len(timings), timings
+
+
+def bench_send(slurper):
+    '''Send events built up front, timing each enqueue.'''
+    events = list(slurper.generate_events())
+
+    slurper.send_events(events)
+    return len(events), slurper.rack.timings
+
+
+def bench_cycle(slurper):
+    '''One whole cycle: fetch, build, send and checkpoint, streamed.'''
+    slurper.run_cycle()
+    return slurper.cycle_stats["events"], slurper.rack.timings
+
+
+STAGES = [("generate_events", bench_generate),
+          ("send_events", bench_send),
+          ("cycle", bench_cycle)]
+
+
+def run_stage(stage, config, questions, results):
+    baseline = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    slurper = make_slurper(config, questions)
+
+    started = time.time()
+    events, timings = dict(STAGES)[stage](slurper)
+    seconds = time.time() - started
+
+    # Sending is timed without the events being built first
+    if stage == "send_events":
+        seconds = sum(timings)
+
+    results.put({
+        "events": events,
+        "seconds": round(seconds, 4),
+        "events_per_sec": round(events / seconds, 1) if seconds else None,
+        "latency_ms": percentiles(timings),
+        # Kilobytes on Linux
+        "peak_rss_growth": (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss -
+                            baseline),
+    })
+
+
+def run(sites=20, questions=500, batch_size=10, max_in_flight=1, repeat=3):
+    '''Run every stage `repeat` times, keeping the fastest run of each.'''
+    config = make_config(sites, batch_size, max_in_flight)
+
+    report = {
+        "stackslurp": stackslurp.__version__,
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "time": int(time.time()),
+        "parameters": {"sites": sites, "questions": questions,
+                       "batch_size": batch_size,
+                       "max_in_flight": max_in_flight, "repeat": repeat},
+        "stages": {},
+    }
+
+    for stage, _ in STAGES:
+        runs = []
+        for _ in range(repeat):
+            results = multiprocessing.Queue()
+            process = multiprocessing.Process(target=run_stage,
+                                              args=(stage, config, questions,
+                                                    results))
+            process.start()
+            runs.append(results.get())
+            process.join()
+
+        report["stages"][stage] = min(runs, key=lambda r: r["seconds"])
+
+    return report
+
+
+def regressions(report, baseline, tolerance):
+    '''Stages whose events per second fell more than `tolerance` (a
+    fraction) below `baseline`'s.
+    '''
+    slower = []
+
+    for stage, result in sorted(report["stages"].items()):
+        before = baseline["stages"].get(stage, {}).get("events_per_sec")
+        after = result["events_per_sec"]
+
+        if before and after is not None and after < before * (1 - tolerance):
+            slower.append("{}: {} events/s, down from {}".format(stage, after,
+                                                                 before))
+
+    return slower
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().split("\n")[0])
+    parser.add_argument("--sites", type=int, default=20)
+    parser.add_argument("--questions", type=int, default=500,
+                        help="questions per site")
+    parser.add_argument("--batch-size", type=int, default=10)
+    parser.add_argument("--max-in-flight", type=int, default=1)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("-o", "--output", help="write results here as well")
+    parser.add_argument("--compare", help="results of an earlier run")
+    parser.add_argument("--tolerance", type=float, default=0.1,
+                        help="slowdown allowed before --compare fails "
+                             "(default: %(default)s)")
+
+    args = parser.parse_args(argv)
+
+    report = run(args.sites, args.questions, args.batch_size,
+                 args.max_in_flight, args.repeat)
+
+    text = json.dumps(report, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, "w") as fh:
+            fh.write(text + "\n")
+
+    print text
+
+    if args.compare:
+        with open(args.compare) as fh:
+            slower = regressions(report, json.load(fh), args.tolerance)
+
+        for line in slower:
+            print >> sys.stderr, "Regression in " + line
+
+        return 1 if slower else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -3,14 +3,26 @@
 
 import gzip
 import json
+import logging
+import pickle
+import Queue
 import random
 import re
+import shutil
+import socket
 import StringIO
+import sys
+import tempfile
+import threading
+import time
 import unittest
+import urllib
+import urlparse
 import uuid
 
 import httpretty
 import pytest
+import requests
 import yaml
 
 import stackslurp
@@ -20,7 +32,7 @@ import stackslurp.main
 @httpretty.activate
 class FakeSpace(stackslurp.rackspace.Rackspace):
     '''Mock for Rackspace'''
-    def __init__(self, username, api_key):
+    def __init__(self, username, api_key, session=None):
         self.username = username
         self.api_key = api_key
         self.identity_endpoint = "http://seemslegit.io/v2.0"
@@ -33,15 +45,18 @@ class FakeSpace(stackslurp.rackspace.Rackspace):
     def auth(self):
         self.token = "seemslegit"
 
-    def enqueue(self, messages, queue, endpoint, ttl=300):
+    def enqueue(self, messages, queue, endpoint, ttl=300, **kwargs):
         self.fakequeue.extend(messages)
 
+    def close(self):
+        self.closed = True
+
 
 @httpretty.activate
 class FakeExchange(stackslurp.stackexchange.StackExchange):
     @classmethod
     def search_questions(cls, since, tags, site, stackexchange_key=None,
-                         order="desc", sort_on="creation"):
+                         order="desc", sort_on="creation", **kwargs):
         # Return a simple list of questions
         questions = [
             {u'answer_count': 0,
@@ -123,6 +138,52 @@ class TestUtils(object):
         assert num_chunks.next() == [6, 7, 8]
         assert num_chunks.next() == [9]
 
+    def test_sized_chunks(self):
+        sized_chunks = stackslurp.utils.sized_chunks
+
+        assert list(sized_chunks(["aa", "bbb", "c", "dddddd", "e"], 2, 5)) == \
+            [["aa", "bbb"], ["c"], ["dddddd"], ["e"]]
+        assert list(sized_chunks(range(5), 2, 100, size=lambda n: 1)) == \
+            [[0, 1], [2, 3], [4]]
+
+        assert json.loads(stackslurp.utils.json_dumps(
+            {"link": "http://so.com/q/1", "title": u"caf\xe9"})) == \
+            {"link": "http://so.com/q/1", "title": u"caf\xe9"}
+
+
+    def test_project(self):
+        project = stackslurp.utils.project
+
+        question = {"title": "Moo", "score": 3,
+                    "owner": {"user_id": 700228, "profile_image": "..."}}
+
+        assert project(question, ["title", "owner.user_id", "owner.age"]) == \
+            {"title": "Moo", "owner": {"user_id": 700228}}
+        assert project(question, ["score.value"]) == {}
+
+
+class TestSessions(object):
+    def test_make_session(self):
+        session = stackslurp.sessions.make_session(
+            pool_maxsize=5, hosts={"api.stackexchange.com": 20})
+
+        default = session.get_adapter("https://identity.api.rackspacecloud.com")
+        assert default._pool_maxsize == 5
+
+        se = session.get_adapter("https://api.stackexchange.com/2.1/search")
+        assert se._pool_maxsize == 20
+
+    def test_shared_session(self):
+        session = stackslurp.sessions.get_session()
+        assert stackslurp.sessions.get_session() is session
+
+        rack = stackslurp.rackspace.Rackspace("user", "key")
+        assert rack.session is session
+
+        mine = stackslurp.sessions.make_session()
+        rack = stackslurp.rackspace.Rackspace("user", "key", session=mine)
+        assert rack.session is mine
+
 
 class TestMain(object):
     def test_entry_points(self):
@@ -213,9 +274,460 @@ class TestStackSlurp(object):
 
         slurper = stackslurp.main.StackSlurp(stackslurpconfig)
 
-        slurper.generate_events()
-        # One up from FakeExchange's last
-        assert slurper.since == 1388784322 + 1
+        list(slurper.generate_events())
+
+        # Nothing moves until the events are sent
+        assert slurper.checkpoints.get("stackoverflow", "python;ruby") is None
+
+        slurper.checkpoint()
+
+        # One up from FakeExchange's last, for every site
+        for site in stackslurpconfig['sites']:
+            assert slurper.checkpoints.get(site, "python;ruby") == 1388784322 + 1
+
+    def test_checkpoints_survive_restart(self, stackslurpconfig, tmpdir):
+        stackslurp.main.Rackspace = FakeSpace
+        stackslurp.main.StackExchange = FakeExchange
+
+        config = dict(stackslurpconfig,
+                      checkpoint_file=str(tmpdir.join("checkpoints.json")))
+
+        slurper = stackslurp.main.StackSlurp(config)
+        slurper.send_events(slurper.generate_events())
+        slurper.checkpoint()
+
+        restarted = stackslurp.main.StackSlurp(config)
+        assert restarted.checkpoints.get("serverfault", "python;ruby") == 1388784322 + 1
+
+        # Marks never go backwards
+        restarted.checkpoints.update({("serverfault", "python;ruby"): 5})
+        assert restarted.checkpoints.get("serverfault", "python;ruby") == 1388784322 + 1
+
+
+    def test_extra_fields(self, stackslurpconfig):
+        stackslurp.main.Rackspace = FakeSpace
+        stackslurp.main.StackExchange = FakeExchange
+
+        config = dict(stackslurpconfig,
+                      extra_fields=["score", "owner.user_id", "owner.nope"])
+
+        slurper = stackslurp.main.StackSlurp(config)
+        events = list(slurper.generate_events())
+
+        assert events[0]["extra"] == {"score": 0,
+                                      "owner": {"user_id": 2840136}}
+
+    def test_throttled(self, stackslurpconfig, monkeypatch):
+        stackslurp.main.Rackspace = FakeSpace
+        stackslurp.main.StackExchange = FakeExchange
+
+        scheduler = stackslurp.stackexchange.QuotaScheduler()
+        monkeypatch.setattr(FakeExchange, "scheduler", scheduler)
+
+        sleeps = []
+        monkeypatch.setattr(stackslurp.main.time, "sleep", sleeps.append)
+
+        slurper = stackslurp.main.StackSlurp(stackslurpconfig)
+        slurper.calls_per_cycle = 2
+
+        scheduler.update("search", "stackoverflow", {"quota_remaining": 0})
+        assert slurper.throttled()
+
+        slurper.event_loop()
+
+        # Nothing fetched or sent, and we hold off until the quota resets
+        assert slurper.rack.fakequeue == []
+        assert sleeps[0] >= stackslurpconfig['wait_time']
+
+        # Come midnight UTC the quota is back, and so are the cycles
+        later = scheduler.resets_at + 1
+        monkeypatch.setattr(stackslurp.stackexchange.time, "time",
+                            lambda: later)
+        assert not slurper.throttled()
+
+        slurper.event_loop()
+        assert len(slurper.rack.fakequeue) == 4
+
+    def test_skips_duplicates(self, stackslurpconfig, tmpdir):
+        stackslurp.main.Rackspace = FakeSpace
+        stackslurp.main.StackExchange = FakeExchange
+
+        config = dict(stackslurpconfig,
+                      dedup={"max_size": 100,
+                             "file": str(tmpdir.join("seen.json"))})
+
+        slurper = stackslurp.main.StackSlurp(config)
+        first = list(slurper.generate_events())
+        assert len(first) == 4
+
+        # Not sent yet, so they all come round again
+        assert len(list(slurper.generate_events())) == 4
+
+        slurper.send_events(first)
+        slurper.checkpoint()
+
+        assert list(slurper.generate_events()) == []
+        assert slurper.seen.hits == 4
+
+        # Remembered across restarts
+        restarted = stackslurp.main.StackSlurp(config)
+        assert list(restarted.generate_events()) == []
+
+    def test_bodies(self, stackslurpconfig, monkeypatch):
+        stackslurp.main.Rackspace = FakeSpace
+
+        fetches = []
+        filters = []
+
+        class BodyExchange(FakeExchange):
+            activity = 0
+
+            @classmethod
+            def create_filter(cls, include=(), exclude=(), *args, **kwargs):
+                filters.append((sorted(include), sorted(exclude)))
+                return "!bodies"
+
+            @classmethod
+            def search_questions(cls, since, tags, site, *args, **kwargs):
+                return [dict(question, last_activity_date=cls.activity)
+                        for question in
+                        FakeExchange.search_questions(since, tags, site)]
+
+            @classmethod
+            def get_questions(cls, ids, site, *args, **kwargs):
+                fetches.append((site, list(ids)))
+                return [{"question_id": id, "body": "<p>{}</p>".format(id)}
+                        for id in ids]
+
+        monkeypatch.setattr(stackslurp.main, "StackExchange", BodyExchange)
+
+        config = dict(stackslurpconfig, sites=["stackoverflow", "serverfault"],
+                      extra_fields=["question_id"],
+                      bodies={"enabled": True, "max_size": 10},
+                      stackexchange_filter={
+                          "include": ["question.score"],
+                          "exclude": ["question.last_edit_date"]})
+        slurper = stackslurp.main.StackSlurp(config)
+
+        events = list(slurper.generate_events())
+        slurper.checkpoint()
+
+        # Edit dates are kept, to tell when a cached body is out of date
+        assert filters[0] == (["question.last_edit_date", "question.score"],
+                              [])
+
+        # One call per site for all its new questions
+        assert sorted(fetches) == [("serverfault", [20912948, 20910273]),
+                                   ("stackoverflow", [20912948, 20910273])]
+        assert [event["extra"]["body"] for event in events] == \
+            ["<p>20912948</p>", "<p>20910273</p>"] * 2
+
+        # Seen again with new activity, but the bodies are cached
+        BodyExchange.activity = 1
+        events = list(slurper.generate_events())
+
+        assert len(events) == 4 and len(fetches) == 2
+        assert events[0]["extra"]["body"] == "<p>20912948</p>"
+        assert slurper.bodies.cache.hits == 4
+
+    def test_bodies_as_sites_finish(self, stackslurpconfig, monkeypatch):
+        stackslurp.main.Rackspace = FakeSpace
+
+        fetched = threading.Event()
+
+        class SlowExchange(FakeExchange):
+            @classmethod
+            def search_questions(cls, since, tags, site, *args, **kwargs):
+                for question in FakeExchange.search_questions(since, tags,
+                                                              site):
+                    yield question
+
+                # serverfault keeps going until stackoverflow's bodies are in
+                if site == "serverfault":
+                    assert fetched.wait(5)
+
+            @classmethod
+            def get_questions(cls, ids, site, *args, **kwargs):
+                fetched.set()
+                return [{"question_id": id, "body": "<p>{}</p>".format(id)}
+                        for id in ids]
+
+        monkeypatch.setattr(stackslurp.main, "StackExchange", SlowExchange)
+
+        config = dict(stackslurpconfig, sites=["stackoverflow", "serverfault"],
+                      max_concurrency=2, bodies={"enabled": True})
+        slurper = stackslurp.main.StackSlurp(config)
+
+        events = list(slurper.generate_events())
+
+        # Neither site's questions waited for the other site to finish
+        assert len(events) == 4
+        assert all(event["extra"]["body"] for event in events)
+        assert len(slurper.pending_marks) == 2
+
+    def test_users(self, stackslurpconfig, tmpdir, monkeypatch):
+        stackslurp.main.Rackspace = FakeSpace
+
+        lookups = []
+        filters = []
+
+        class UserExchange(FakeExchange):
+            @classmethod
+            def create_filter(cls, include=(), exclude=(), *args, **kwargs):
+                filters.append((sorted(include), sorted(exclude)))
+                return "!users"
+
+            @classmethod
+            def get_users(cls, ids, site, *args, **kwargs):
+                lookups.append((site, list(ids)))
+                return [{"user_id": id, "account_id": id + 1,
+                         "display_name": "user {}".format(id),
+                         "reputation": 1000, "profile_image": "..."}
+                        for id in ids]
+
+        monkeypatch.setattr(stackslurp.main, "StackExchange", UserExchange)
+
+        config = dict(stackslurpconfig, sites=["stackoverflow", "serverfault"],
+                      extra_fields=["question_id"],
+                      users={"enabled": True,
+                             "file": str(tmpdir.join("users.json")),
+                             "internal_accounts": [700229]},
+                      stackexchange_filter={"base": "none",
+                                            "exclude": ["question.owner"]})
+        slurper = stackslurp.main.StackSlurp(config)
+
+        events = list(slurper.generate_events())
+        slurper.checkpoint()
+
+        # Owners are kept, to know who to look up
+        assert filters[0] == (["question.owner"], [])
+
+        # One lookup per site for all its askers
+        assert sorted(lookups) == [("serverfault", [700228, 2840136]),
+                                   ("stackoverflow", [700228, 2840136])]
+        assert events[0]["extra"]["asker"] == {
+            "user_id": 2840136, "account_id": 2840137,
+            "display_name": "user 2840136", "reputation": 1000,
+            "internal": False}
+        assert events[1]["extra"]["asker"]["internal"]
+
+        # Looked up users are kept across restarts, until they're stale
+        slurper = stackslurp.main.StackSlurp(config)
+        assert len(slurper.users.cache) == 4
+        assert slurper.users.cache.get("serverfault", 700228)["reputation"] \
+            == 1000
+        assert slurper.users.cache.get("serverfault", 700228,
+                                       now=time.time() + 86400) is None
+
+    def test_activity_updates(self, stackslurpconfig, tmpdir, monkeypatch):
+        stackslurp.main.Rackspace = FakeSpace
+
+        polls = []
+
+        class ActiveExchange(FakeExchange):
+            active = []
+
+            @classmethod
+            def search_questions(cls, since, tags, site, stackexchange_key=None,
+                                 order="desc", sort_on="creation", **kwargs):
+                if sort_on != "activity":
+                    return FakeExchange.search_questions(since, tags, site)
+                polls.append(kwargs['min_value'])
+                return [dict(question) for question in cls.active]
+
+        monkeypatch.setattr(stackslurp.main, "StackExchange", ActiveExchange)
+
+        config = dict(stackslurpconfig, sites=["stackoverflow"],
+                      checkpoint_file=str(tmpdir.join("checkpoints.json")),
+                      dedup={"file": str(tmpdir.join("seen.json"))},
+                      activity={"enabled": True,
+                                "file": str(tmpdir.join("states.json"))})
+
+        slurper = stackslurp.main.StackSlurp(config)
+        created = list(slurper.generate_events())
+        slurper.send_events(created)
+        slurper.checkpoint()
+
+        assert len(created) == 2
+        assert polls == [config['starting_since']]
+
+        unanswered, answered = FakeExchange.search_questions(None, None, None)
+        ActiveExchange.active = [
+            # A new comment, nothing Peril needs to hear about
+            dict(unanswered, last_activity_date=1388790000),
+            dict(answered, answer_count=2, accepted_answer_id=20910999,
+                 last_activity_date=1388790100),
+            # Never sent, so not ours to update
+            dict(answered, question_id=1, answer_count=5),
+        ]
+
+        updates = list(slurper.generate_events())
+        slurper.send_events(updates)
+        slurper.checkpoint()
+
+        assert [event["origin_id"] for event in updates] == [20910273]
+        assert updates[0]["completed_at"] == 1388790100
+        assert "completed_at" not in created[1]
+
+        # The same activity again is nothing new, even after a restart
+        restarted = stackslurp.main.StackSlurp(config)
+        assert list(restarted.generate_events()) == []
+        assert polls[-1] == 1388790100
+
+    def test_seen_index(self):
+        index = stackslurp.dedup.SeenIndex(max_size=2)
+        index.add([("so", 1, 10), ("so", 2, 20)])
+
+        assert index.seen(("so", 1, 10))
+        # Same question, newer activity
+        assert not index.seen(("so", 1, 11))
+
+        # ("so", 2, 20) is now the least recently used
+        index.add([("so", 3, 30)])
+        assert len(index) == 2
+        assert not index.seen(("so", 2, 20))
+        assert index.seen(("so", 1, 10))
+
+        assert index.hits == 2
+        assert index.misses == 2
+
+    def test_generate_events_streams(self, stackslurpconfig):
+        produced = []
+
+        class EndlessExchange(FakeExchange):
+            @classmethod
+            def search_questions(cls, since, tags, site, *args, **kwargs):
+                template = FakeExchange.search_questions(since, tags, site)[0]
+                for n in xrange(1000):
+                    produced.append(n)
+                    yield dict(template, question_id=n,
+                               creation_date=template['creation_date'] - n)
+
+        config = dict(stackslurpconfig, pipeline_buffer=5,
+                      sites=["stackoverflow"])
+
+        stackslurp.main.Rackspace = FakeSpace
+        stackslurp.main.StackExchange = EndlessExchange
+
+        try:
+            slurper = stackslurp.main.StackSlurp(config)
+            events = slurper.generate_events()
+
+            assert next(events)["origin_id"] == 0
+            threading.Event().wait(0.2)
+
+            # The fetcher is held back by the buffer
+            assert len(produced) < 10
+
+            def failing_enqueue(*args, **kwargs):
+                raise Exception("CloudQueues is down")
+
+            slurper.rack.enqueue = failing_enqueue
+
+            # Bailing out part way stops the fetcher
+            with pytest.raises(Exception):
+                slurper.send_events(events)
+            assert len(produced) < 20
+            assert slurper.pending_marks == {}
+        finally:
+            stackslurp.main.StackExchange = FakeExchange
+
+    def test_generate_events_concurrently(self, stackslurpconfig):
+
+        class FlakyExchange(FakeExchange):
+            @classmethod
+            def search_questions(cls, since, tags, site, *args, **kwargs):
+                if site == "serverfault":
+                    raise Exception("serverfault is down")
+                return [dict(question, site=site,
+                             creation_date=question['creation_date'] + n)
+                        for n, question in enumerate(
+                            FakeExchange.search_questions(since, tags, site))]
+
+        config = dict(stackslurpconfig, max_concurrency=4,
+                      sites=["stackoverflow", "serverfault", "superuser"])
+
+        stackslurp.main.Rackspace = FakeSpace
+        stackslurp.main.StackExchange = FlakyExchange
+
+        try:
+            slurper = stackslurp.main.StackSlurp(config)
+            events = list(slurper.generate_events())
+        finally:
+            stackslurp.main.StackExchange = FakeExchange
+
+        # Both healthy sites made it, each newest first
+        assert len(events) == 4
+        for site in ["stackoverflow", "superuser"]:
+            dates = [event["incident_date"] for event in events
+                     if event["extra"]["site"] == site]
+            assert dates == sorted(dates, reverse=True)
+
+        slurper.checkpoint()
+
+        # serverfault still needs everything since the start
+        assert slurper.checkpoints.get("serverfault", "python;ruby") is None
+        assert slurper.checkpoints.get("superuser", "python;ruby") == 1388784322 + 1
+
+    def test_generate_events_abandoned(self, stackslurpconfig):
+        searched = []
+        release = threading.Event()
+
+        class SlowExchange(FakeExchange):
+            @classmethod
+            def search_questions(cls, since, tags, site, *args, **kwargs):
+                searched.append(site)
+                if site != "site0":
+                    release.wait(5)
+                return FakeExchange.search_questions(since, tags, site)
+
+        config = dict(stackslurpconfig, max_concurrency=2,
+                      sites=["site{}".format(n) for n in range(40)])
+
+        stackslurp.main.Rackspace = FakeSpace
+        stackslurp.main.StackExchange = SlowExchange
+
+        try:
+            slurper = stackslurp.main.StackSlurp(config)
+            events = slurper.generate_events()
+            next(events)
+
+            threading.Timer(0.2, release.set).start()
+            events.close()
+        finally:
+            stackslurp.main.StackExchange = FakeExchange
+
+        # Sites still queued aren't searched once the consumer's gone
+        assert len(searched) < 5
+
+    def test_generate_events_setup_fails(self, stackslurpconfig):
+        stackslurp.main.Rackspace = FakeSpace
+        stackslurp.main.StackExchange = FakeExchange
+
+        config = dict(stackslurpconfig, sites=["stackoverflow", "serverfault"])
+        slurper = stackslurp.main.StackSlurp(config)
+
+        checkpoint = slurper.checkpoints.get
+
+        def failing_get(site, *args):
+            if site == "serverfault":
+                raise IOError("checkpoints unreadable")
+            return checkpoint(site, *args)
+
+        slurper.checkpoints.get = failing_get
+
+        events = []
+        consumer = threading.Thread(target=lambda: events.extend(
+                                    slurper.generate_events()))
+        consumer.daemon = True
+        consumer.start()
+        consumer.join(5)
+
+        # The failed site still finishes, rather than leaving us waiting
+        assert not consumer.is_alive()
+        assert len(events) == 2
+        assert ("serverfault", "python;ruby") not in slurper.pending_marks
+        assert ("stackoverflow", "python;ruby") in slurper.pending_marks
 
 
 # TODO Turn this into py.test style
@@ -341,6 +853,889 @@ class SlurperTestCase(unittest.TestCase):
 
         assert "sending" in logger3.last_message
 
+    @httpretty.activate
+    def test_outbox(self):
+        self.config['outbox']['directory'] = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.config['outbox']['directory'])
+
+        class DownSpace(FakeSpace):
+            down = True
+
+            def enqueue(self, messages, queue, endpoint, ttl=300, **kwargs):
+                if self.down:
+                    raise stackslurp.rackspace.EnqueueError([
+                        stackslurp.rackspace.BatchResult(messages, [],
+                                                         IOError("down"))])
+                super(DownSpace, self).enqueue(messages, queue, endpoint)
+
+        s = self.DummySlurper(self.config)
+        s.rack = DownSpace("user", "rackspace_api")
+        checkpoints = []
+        s.checkpoint = lambda: checkpoints.append(True)
+
+        s.run_cycle()
+
+        # Nothing made it out, but it's safe on disk so the cycle moves on
+        assert s.rack.fakequeue == []
+        assert checkpoints == [True]
+        assert s.cycle_stats["ok"]
+        assert len(s.outbox) == 1
+
+        # A restart picks up where it left off, oldest first
+        restarted = self.DummySlurper(self.config)
+        restarted.rack = DownSpace("user", "rackspace_api")
+        restarted.rack.down = False
+        restarted.ctr = 1
+
+        restarted.run_cycle()
+
+        assert [e["url"] for e in restarted.rack.fakequeue] == \
+            ["http://blog.fict.io/1", "http://blog.fict.io/2"]
+        assert len(restarted.outbox) == 0
+        assert restarted.cycle_stats["events"] == 2
+
+    def test_drain_past_dropped_message(self):
+        self.config['outbox']['directory'] = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.config['outbox']['directory'])
+        self.config['batch_size'] = 3
+        self.config['batch_bytes'] = 400
+
+        posted = []
+
+        def post_batch(url, data):
+            numbers = [message['body']['n'] for message in json.loads(data)]
+            if 2 in numbers:
+                raise IOError("CloudQueues is down")
+            posted.append(numbers)
+            return ["/v1/queues/testing/messages/0"] * len(numbers)
+
+        s = self.DummySlurper(self.config)
+        s.rack = stackslurp.rackspace.Rackspace("user", "rackspace_api")
+        s.rack.token, s.rack.expires = "seemslegit", time.time() + 3600
+        s.rack._post_batch = post_batch
+
+        # The first is too big to ever go, and the third needs a post of
+        # its own, which fails
+        s.outbox.append([{'n': n, 'text': "x" * size} for n, size in
+                         enumerate([500, 10, 350, 10])])
+
+        assert not s.drain_outbox()
+
+        # The first is gone for good and the second made it, so the rest
+        # are left to try again
+        assert posted == [[1]]
+        assert s.sent == 2
+        assert [event['n'] for event in s.outbox.peek(10)] == [2, 3]
+
+
+class TestRetry(object):
+    def test_retries(self, monkeypatch):
+        sleeps = []
+        monkeypatch.setattr(stackslurp.retry.time, "sleep", sleeps.append)
+
+        policy = stackslurp.retry.RetryPolicy("flaky", attempts=3,
+                                              base_delay=1, max_delay=1.5)
+        calls = []
+
+        def flaky(fails, error):
+            calls.append(error)
+            if len(calls) <= fails:
+                raise error
+            return "ok"
+
+        assert policy.call(flaky, 2, requests.ConnectionError()) == "ok"
+        assert len(calls) == 3
+        assert 0 <= sleeps[0] <= 1 and 0 <= sleeps[1] <= 1.5
+
+        # Out of attempts
+        del calls[:]
+        with pytest.raises(requests.Timeout):
+            policy.call(flaky, 3, requests.Timeout())
+        assert len(calls) == 3
+
+        # Client errors aren't worth repeating
+        del calls[:]
+        response = requests.Response()
+        response.status_code = 404
+        with pytest.raises(requests.HTTPError):
+            policy.call(flaky, 1, requests.HTTPError(response=response))
+        assert len(calls) == 1
+
+    def test_budget_and_breaker(self, monkeypatch):
+        monkeypatch.setattr(stackslurp.retry.time, "sleep", lambda s: None)
+
+        def down():
+            raise requests.ConnectionError()
+
+        # Two retries saved up, none earned back
+        policy = stackslurp.retry.RetryPolicy("down", attempts=10, budget=2,
+                                              budget_ratio=0,
+                                              failure_threshold=100)
+        calls = []
+        with pytest.raises(requests.ConnectionError):
+            policy.call(lambda: calls.append(1) or down())
+        assert len(calls) == 3
+
+        policy = stackslurp.retry.RetryPolicy("down", attempts=1,
+                                              failure_threshold=2,
+                                              reset_timeout=60)
+        for _ in range(2):
+            with pytest.raises(requests.ConnectionError):
+                policy.call(down)
+
+        # Open: fails without trying
+        with pytest.raises(stackslurp.retry.CircuitOpen):
+            policy.call(lambda: "never called")
+
+        # Once the timeout is up one call is let through, and closes it
+        policy.breaker.opened_at -= 61
+        assert policy.breaker.state == "half_open"
+        assert policy.call(lambda: "back") == "back"
+        assert policy.breaker.state == "closed"
+
+    @httpretty.activate
+    def test_page_retried_alone(self):
+        stackslurp.retry.configure(base_delay=0)
+
+        pages = []
+
+        def paging_callback(request, uri, headers):
+            page = int(request.querystring['page'][0])
+            pages.append(page)
+
+            if pages.count(2) == 1 and page == 2:
+                return (503, headers, "Service Unavailable")
+
+            body = {"items": [{"question_id": page}], "has_more": page < 3}
+            return (200, headers, json.dumps(body))
+
+        httpretty.register_uri(httpretty.GET,
+                               "https://api.stackexchange.com/2.1/search",
+                               body=paging_callback)
+
+        questions = stackslurp.stackexchange.StackExchange.search_questions(
+            since=1388594252, tags="python", site="pets")
+
+        try:
+            assert [q["question_id"] for q in questions] == [1, 2, 3]
+        finally:
+            stackslurp.retry.configure()
+
+        assert pages == [1, 2, 2, 3]
+
+    def test_configured_once(self, stackslurpconfig, monkeypatch):
+        stackslurp.main.Rackspace = FakeSpace
+        monkeypatch.setattr(stackslurp.main.StackSlurp, "go", lambda self: None)
+
+        config = dict(stackslurpconfig, retry={"failure_threshold": 2},
+                      cassette={})
+        try:
+            stackslurp.main.run(config)
+            policy = stackslurp.retry.policy("queues")
+            assert policy.breaker.failure_threshold == 2
+
+            # Another slurper in the process leaves the breakers be
+            stackslurp.main.StackSlurp(stackslurpconfig)
+            assert stackslurp.retry.policy("queues") is policy
+        finally:
+            stackslurp.retry.configure()
+
+    def test_run_closes_sink(self, stackslurpconfig, monkeypatch):
+        stackslurp.main.Rackspace = FakeSpace
+        slurpers = []
+
+        def go(self):
+            slurpers.append(self)
+            raise KeyboardInterrupt
+
+        monkeypatch.setattr(stackslurp.main.StackSlurp, "go", go)
+
+        try:
+            with pytest.raises(KeyboardInterrupt):
+                stackslurp.main.run(dict(stackslurpconfig, cassette={}))
+        finally:
+            stackslurp.retry.configure()
+
+        # Down to the posting threads
+        assert slurpers[0].rack.closed
+
+
+class TestMetrics(object):
+    def test_render(self):
+        registry = stackslurp.metrics.Registry()
+
+        calls = registry.counter("calls_total", "Calls made", ["site"])
+        calls.inc(site="pets")
+        calls.inc(2, site="pets")
+        assert registry.counter("calls_total", "Calls made", ["site"]) is calls
+
+        latency = registry.histogram("latency_seconds", "Latency",
+                                     buckets=(0.1, 1))
+        latency.observe(0.05)
+        latency.observe(0.5)
+        latency.observe(5)
+
+        with pytest.raises(ValueError):
+            calls.inc(queue="nope")
+
+        assert registry.render().splitlines() == [
+            '# HELP calls_total Calls made',
+            '# TYPE calls_total counter',
+            'calls_total{site="pets"} 3.0',
+            '# HELP latency_seconds Latency',
+            '# TYPE latency_seconds histogram',
+            'latency_seconds_bucket{le="0.1"} 1.0',
+            'latency_seconds_bucket{le="1.0"} 2.0',
+            'latency_seconds_bucket{le="+Inf"} 3.0',
+            'latency_seconds_sum 5.55',
+            'latency_seconds_count 3.0',
+        ]
+
+    def test_exposed(self):
+        registry = stackslurp.metrics.Registry()
+        quota = registry.gauge("stackslurp_quota_remaining", "Quota")
+
+        listener = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        listener.bind(("127.0.0.1", 0))
+        listener.settimeout(5)
+        registry.emitters.append(stackslurp.metrics.StatsdEmitter(
+            "127.0.0.1", listener.getsockname()[1]))
+
+        quota.set(9000)
+        assert listener.recv(1024) == "stackslurp.quota_remaining:9000|g"
+
+        server = stackslurp.metrics.MetricsServer(registry, 0)
+        server.start()
+        try:
+            url = "http://127.0.0.1:{}".format(server.port)
+            resp = requests.get(url + "/metrics")
+            assert resp.status_code == 200
+            assert "stackslurp_quota_remaining 9000.0" in resp.text
+            assert requests.get(url + "/nope").status_code == 404
+        finally:
+            server.stop()
+
+    def test_slurper_metrics(self, stackslurpconfig):
+        stackslurp.main.Rackspace = FakeSpace
+        stackslurp.main.StackExchange = FakeExchange
+
+        fetched = stackslurp.main.questions_fetched
+        built = stackslurp.main.events_built
+        lag = stackslurp.main.enqueue_lag
+
+        before = (fetched.value(site="serverfault"), built.value(kind="new"),
+                  lag.count())
+
+        slurper = stackslurp.main.StackSlurp(stackslurpconfig)
+        slurper.send_events(slurper.generate_events())
+
+        assert fetched.value(site="serverfault") == before[0] + 2
+        assert built.value(kind="new") == before[1] + 4
+        assert lag.count() == before[2] + 4
+
+    def test_update_lag(self, stackslurpconfig):
+        stackslurp.main.Rackspace = FakeSpace
+
+        slurper = stackslurp.main.StackSlurp(stackslurpconfig)
+        question = FakeExchange.search_questions(None, None, None)[1]
+        now = question['creation_date'] + 60
+
+        update = slurper.make_update_event(question)
+        new = slurper.make_event(question)
+
+        # Told apart by the events alone, even after a trip through the outbox
+        assert slurper.event_lag(update, now) is None
+        assert slurper.event_lag(json.loads(json.dumps(update)), now) is None
+        assert slurper.event_lag(new, now) == 60
+        assert "update" not in question
+
+
+class TestCassette(object):
+    def test_record_and_replay(self, stackslurpconfig, tmpdir, monkeypatch):
+        monkeypatch.setattr(stackslurp.main, "StackExchange",
+                            stackslurp.stackexchange.StackExchange)
+        monkeypatch.setattr(stackslurp.main, "Rackspace",
+                            stackslurp.rackspace.Rackspace)
+
+        path = str(tmpdir.join("traffic.jsonl.gz"))
+        questions = FakeExchange.search_questions(None, None, None)
+
+        httpretty.enable()
+        try:
+            httpretty.register_uri(httpretty.GET,
+                                   "https://api.stackexchange.com/2.1/search",
+                                   body=json.dumps({"items": questions,
+                                                    "has_more": False}))
+            httpretty.register_uri(httpretty.POST,
+                "https://identity.api.rackspacecloud.com/v2.0/tokens",
+                body=json.dumps({"access": {"token": {"id": "secret"}}}))
+            httpretty.register_uri(httpretty.POST,
+                "https://dfw.queues.api.rackspacecloud.com/v1/queues/testing/"
+                "messages", status=201,
+                body=json.dumps({"partial": False, "resources": []}))
+
+            # The live slurper's state, which replaying mustn't touch
+            live = dict(stackslurpconfig, sites=["stackoverflow"],
+                        checkpoint_file=str(tmpdir.join("checkpoints.json")),
+                        dedup={"file": str(tmpdir.join("seen.json"))})
+
+            config = dict(live, cassette={"record": path})
+            recorder = stackslurp.main.StackSlurp(config)
+            recorder.run_cycle()
+            recorder.session.close()
+        finally:
+            httpretty.disable()
+            httpretty.reset()
+
+        assert recorder.cycle_stats["events"] == 2
+
+        recording = gzip.open(path).read()
+        assert "THE_SE_KEY" not in recording
+        assert "secret" not in recording
+
+        state = [tmpdir.join(name).read() for name in ("checkpoints.json",
+                                                       "seen.json")]
+
+        # No network from here on. The questions were all sent while
+        # recording, but replaying starts from nothing.
+        config = dict(live, cassette={"replay": path, "speed": 0})
+        replayer = stackslurp.main.StackSlurp(config)
+        replayer.replay()
+
+        assert [tmpdir.join(name).read() for name in ("checkpoints.json",
+                                                      "seen.json")] == state
+
+        assert replayer.session.exhausted
+        assert [message["body"]["origin_id"] for message
+                in replayer.session.enqueued] == \
+            [question["question_id"] for question in questions]
+        assert len(replayer.session.recorded_enqueues) == 1
+
+        with pytest.raises(stackslurp.cassette.CassetteMiss):
+            replayer.session.get("https://api.stackexchange.com/2.1/search",
+                                 params={"site": "stackoverflow"})
+
+    def test_replay_timing(self, tmpdir, monkeypatch):
+        path = str(tmpdir.join("traffic.jsonl.gz"))
+        with gzip.open(path, "wb") as fh:
+            fh.write(json.dumps({"version": 1, "started": 0}) + "\n")
+            for t in (0.0, 3.0):
+                fh.write(json.dumps({"t": t, "method": "GET",
+                                     "url": "https://api/search",
+                                     "params": {"page": "1"}, "status": 200,
+                                     "body": "{}"}) + "\n")
+
+        sleeps = []
+        monkeypatch.setattr(stackslurp.cassette.time, "sleep", sleeps.append)
+
+        replay = stackslurp.cassette.ReplaySession(path, speed=2)
+        replay.get("https://api/search", params={"page": 1, "fromdate": 5})
+        replay.get("https://api/search", params={"page": 1, "fromdate": 9})
+
+        # Half the recorded gap, at double speed
+        assert len(sleeps) == 1 and 1.4 < sleeps[0] <= 1.5
+        assert replay.exhausted
+
+
+class TestOutbox(object):
+    def test_segments(self, tmpdir):
+        directory = str(tmpdir.join("outbox"))
+        outbox = stackslurp.outbox.Outbox(directory, segment_size=2)
+
+        outbox.append([{"n": n} for n in range(5)])
+        assert len(outbox) == 5
+        assert len(tmpdir.join("outbox").listdir("*.jsonl")) == 3
+
+        assert outbox.peek(3) == [{"n": 0}, {"n": 1}, {"n": 2}]
+        outbox.ack(3)
+        assert outbox.peek(10) == [{"n": 3}, {"n": 4}]
+
+        # Sent segments are cleared away
+        assert len(tmpdir.join("outbox").listdir("*.jsonl")) == 2
+
+        # A crash mid-write leaves a torn line, which is never read back
+        outbox.close()
+        with open(outbox._path(outbox._writing), "a") as fh:
+            fh.write('{"n": 5')
+
+        reopened = stackslurp.outbox.Outbox(directory, segment_size=2)
+        assert reopened.peek(10) == [{"n": 3}, {"n": 4}]
+
+        reopened.append([{"n": 6}])
+        reopened.ack(2)
+        assert reopened.peek(10) == [{"n": 6}]
+
+        reopened.ack(1)
+        assert len(reopened) == 0
+        assert len(stackslurp.outbox.Outbox(directory)) == 0
+
+    def test_ack_across_segments(self, tmpdir):
+        directory = str(tmpdir.join("outbox"))
+
+        # Restarted a few times while CloudQueues is down
+        for start in range(0, 10, 2):
+            outbox = stackslurp.outbox.Outbox(directory, segment_size=3)
+            outbox.append([{"n": n} for n in range(start, start + 2)])
+            outbox.close()
+
+        outbox = stackslurp.outbox.Outbox(directory, segment_size=3)
+        outbox.append([{"n": n} for n in range(10, 14)])
+
+        assert len(outbox.peek(7)) == 7
+        outbox.ack(7)
+        assert [event["n"] for event in outbox.peek(3)] == [7, 8, 9]
+        assert len(tmpdir.join("outbox").listdir("*.jsonl")) == 4
+        outbox.close()
+
+        reopened = stackslurp.outbox.Outbox(directory, segment_size=3)
+        assert len(reopened) == 7
+        assert [event["n"] for event in reopened.peek(3)] == [7, 8, 9]
+        reopened.ack(4)
+        assert [event["n"] for event in reopened.peek(10)] == [11, 12, 13]
+        reopened.close()
+
+        again = stackslurp.outbox.Outbox(directory, segment_size=3)
+        assert [event["n"] for event in again.peek(10)] == [11, 12, 13]
+        again.ack(3)
+        assert len(again) == 0
+        assert tmpdir.join("outbox").listdir("*.jsonl") == []
+
+    def test_drain_reads_once(self, tmpdir, monkeypatch):
+        outbox = stackslurp.outbox.Outbox(str(tmpdir), segment_size=100)
+        assert outbox.peek(10) == []
+
+        outbox.append([{"n": n} for n in range(250)])
+
+        parsed = []
+        loads = stackslurp.outbox.json.loads
+        monkeypatch.setattr(stackslurp.outbox.json, "loads",
+                            lambda line: parsed.append(line) or loads(line))
+
+        drained = []
+        while True:
+            window = outbox.peek(30)
+            if not window:
+                break
+
+            # Part of a window sent, as after a failed batch
+            drained.extend(window[:20])
+            outbox.ack(20)
+
+            if len(drained) == 100:
+                # More arrive while draining
+                outbox.append([{"n": n} for n in range(250, 260)])
+
+        assert [event["n"] for event in drained] == range(260)
+        assert len(parsed) == 260
+
+
+class TestBackfill(object):
+    def test_windows(self):
+        assert stackslurp.backfill.parse_time("2014-01-05") == 1388880000
+        assert stackslurp.backfill.parse_time(1388880000) == 1388880000
+        assert stackslurp.backfill.parse_time("2014-01-05T00:00:10Z") == \
+            1388880010
+
+        assert stackslurp.backfill.split_windows(150, 420, 100) == \
+            [(150, 200), (200, 300), (300, 400), (400, 420)]
+        assert stackslurp.backfill.split_windows(100, 100, 100) == []
+
+    def test_run_and_resume(self, stackslurpconfig, tmpdir, monkeypatch):
+        searched = []
+
+        class WindowExchange(FakeExchange):
+            @classmethod
+            def search_questions(cls, since, tags, site, *args, **kwargs):
+                searched.append((site, since, kwargs["todate"]))
+                template = FakeExchange.search_questions(since, tags, site)[0]
+                return [dict(template, question_id=since, creation_date=since)]
+
+        monkeypatch.setattr(stackslurp.main, "StackExchange", WindowExchange)
+        scheduler = stackslurp.stackexchange.StackExchange.scheduler
+        monkeypatch.setattr(scheduler, "quota_remaining", None)
+
+        state_file = str(tmpdir.join("backfill.json"))
+        config = dict(stackslurpconfig, sites=["stackoverflow"])
+
+        slurper = stackslurp.main.StackSlurp(config)
+        backfill = stackslurp.backfill.Backfill(slurper, 1000, 1400,
+                                                window=100, parallel=2,
+                                                state_file=state_file)
+
+        # Out of quota after the first couple of windows
+        original = backfill.fetch
+
+        def fetch(window):
+            result = original(window)
+            if len(searched) == 2:
+                scheduler.quota_remaining = 50
+            return result
+
+        backfill.fetch = fetch
+
+        assert backfill.run() == 2
+        assert sorted(searched) == [("stackoverflow", 1000, 1099),
+                                    ("stackoverflow", 1100, 1199)]
+        assert sorted(event["origin_id"] for event
+                      in slurper.rack.fakequeue) == [1000, 1100]
+
+        # After the reset, only what's left is searched
+        scheduler.quota_remaining = 10000
+        del searched[:]
+
+        slurper = stackslurp.main.StackSlurp(config)
+        backfill = stackslurp.backfill.Backfill(slurper, 1000, 1400,
+                                                window=100, parallel=2,
+                                                state_file=state_file)
+        assert backfill.run() == 0
+        assert sorted(searched) == [("stackoverflow", 1200, 1299),
+                                    ("stackoverflow", 1300, 1399)]
+
+        assert stackslurp.backfill.Backfill(slurper, 1000, 1400, window=100,
+                                            state_file=state_file
+                                            ).windows() == []
+
+
+class TestSinks(object):
+    def test_file_sink(self, tmpdir):
+        directory = str(tmpdir.join("events"))
+        sink = stackslurp.sinks.FileSink(directory, max_batch=5,
+                                         segment_bytes=50,
+                                         commit_bytes=10 ** 6,
+                                         commit_interval=3600)
+
+        for n in range(0, 12, 4):
+            sink.write([{"n": m} for m in range(n, n + 4)])
+
+        # Group committed: rolling to a new segment commits the old one, and
+        # the rest waits for a flush
+        assert sink.commits == 1
+        sink.flush()
+        assert sink.commits == 2
+
+        stats = sink.stats()
+        assert stats["events"] == 12 and stats["batches"] == 3
+        assert stats["bytes"] == sum(len(path.read()) for path in
+                                     tmpdir.join("events").listdir())
+
+        sink.close()
+        reopened = stackslurp.sinks.FileSink(directory)
+        reopened.write([{"n": 12}])
+        reopened.close()
+
+        paths = sorted(tmpdir.join("events").listdir())
+        assert [path.basename for path in paths] == \
+            ["0000000001.jsonl", "0000000002.jsonl", "0000000003.jsonl"]
+        assert [json.loads(line)["n"] for path in paths
+                for line in path.readlines()] == range(13)
+
+    def test_cloudqueues_sink_bytes(self):
+        posts = []
+
+        def post_batch(url, data):
+            posts.append(data)
+            if len(posts) == 3:
+                raise IOError("CloudQueues is down")
+            return ["/v1/queues/testing/messages/0"]
+
+        rack = stackslurp.rackspace.Rackspace("user", "rackspace_api")
+        rack.token, rack.expires = "seemslegit", time.time() + 3600
+        rack._post_batch = post_batch
+
+        sink = stackslurp.sinks.CloudQueuesSink(rack, "testing",
+            "https://dfw.queues.api.rackspacecloud.com", batch_size=2)
+
+        sink.write([{"n": n} for n in range(4)])
+        with pytest.raises(stackslurp.rackspace.EnqueueError):
+            sink.write([{"n": 4}])
+
+        # Every post counts, the failed one included
+        assert len(posts) == 3
+        assert sink.stats()["bytes"] == sum(len(data) for data in posts)
+
+    def test_slurp_to_stdout(self, stackslurpconfig):
+        stackslurp.main.StackExchange = FakeExchange
+
+        config = dict(stackslurpconfig, sites=["stackoverflow"],
+                      sink={"type": "stdout", "max_batch": 1})
+        slurper = stackslurp.main.StackSlurp(config)
+
+        stream = StringIO.StringIO()
+        slurper.sink.stream = stream
+
+        assert slurper.rack is None
+        assert slurper.window_size() == 1
+
+        slurper.run_cycle()
+
+        assert [json.loads(line)["origin_id"] for line in
+                stream.getvalue().splitlines()] == [20912948, 20910273]
+        assert slurper.cycle_stats["sink"]["events"] == 2
+        assert slurper.cycle_stats["sink"]["batches"] == 2
+
+
+class TestAsyncSlurper(object):
+
+    class CountingSlurper(object):
+        def __init__(self, wait_time):
+            self.wait_time = wait_time
+            self.cycles = 0
+            self.cancelled = threading.Event()
+
+        def run_cycle(self):
+            self.cycles += 1
+
+        def cycle_wait(self):
+            return self.wait_time
+
+    def test_runs_slurpers_side_by_side(self):
+        fast = self.CountingSlurper(0.01)
+        slow = self.CountingSlurper(60)
+
+        engine = stackslurp.engine.AsyncSlurper([fast, slow])
+        engine.start()
+
+        # time.sleep may have been swapped out by other tests
+        deadline = time.time() + 5
+        while fast.cycles < 5 and time.time() < deadline:
+            threading.Event().wait(0.01)
+
+        # Stopping cuts the slow one's sleep short
+        started = time.time()
+        assert engine.stop(timeout=5)
+        assert time.time() - started < 5
+
+        assert fast.cycles >= 5
+        assert slow.cycles == 1
+        assert not engine.running
+        assert not fast.cancelled.is_set()
+
+    def test_stop_cancels_sending(self):
+        config = {
+            "rackspace": {
+                "username": "user",
+                "api_key": "rackspace_api",
+                "queue_endpoint": "https://dfw.queues.api.rackspacecloud.com/v1/"
+            },
+            "queue": "testing",
+            "wait_time": 300
+        }
+        config = stackslurp.main.read_config(
+            StringIO.StringIO(yaml.safe_dump(config)))
+
+        s = SlurperTestCase.DummySlurper(config)
+        s.rack = FakeSpace("user", "rackspace_api")
+
+        engine = stackslurp.engine.AsyncSlurper([s])
+        engine.stop(graceful=False, timeout=0)
+
+        with pytest.raises(stackslurp.main.Cancelled):
+            s.send_events(s.generate_events())
+        assert s.rack.fakequeue == []
+
+
+class QuickSlurper(object):
+    '''Stands in for StackSlurp in worker processes'''
+    def __init__(self, config):
+        self.config = config
+        self.cycle_stats = {}
+
+    def run_cycle(self):
+        logging.getLogger("quickslurper").warning(
+            "slurping " + ",".join(self.config['sites']))
+        self.cycle_stats = {"events": len(self.config['sites']),
+                            "duration": 0.5, "ok": True}
+
+    def cycle_wait(self):
+        return 60
+
+
+class TestLogs(object):
+    def test_json_lines_sampled(self, tmpdir):
+        path = str(tmpdir.join("slurp.log"))
+        log = logging.getLogger("stackslurp.test_logs")
+
+        listener = stackslurp.logs.configure(level="DEBUG", format="json",
+                                             file=path, sample_rate=0)
+        try:
+            for n in range(100):
+                log.debug("Event %s", n, extra={"payload": {"n": n},
+                                                "sampled": True})
+            log.info("Cycle done", extra={"payload": {"events": 100}})
+        finally:
+            listener.stop()
+
+        # Written out by the time stop returns, and the handler is gone
+        assert listener.attached[1] not in logging.getLogger().handlers
+
+        lines = [json.loads(line) for line in open(path)]
+        assert len(lines) == 1
+        assert lines[0]["message"] == "Cycle done"
+        assert lines[0]["level"] == "INFO"
+        assert lines[0]["payload"] == {"events": 100}
+
+    def test_full_queue_drops(self):
+        records = Queue.Queue(1)
+        handler = stackslurp.logs.ThreadQueueHandler(records)
+        dropped = stackslurp.logs.records_dropped.value()
+
+        for n in range(3):
+            handler.handle(logging.LogRecord("x", logging.INFO, __file__, 1,
+                                             "record %s", (n,), None))
+
+        assert records.get_nowait().getMessage() == "record 0"
+        assert stackslurp.logs.records_dropped.value() == dropped + 2
+
+    def test_queued_traceback_once(self):
+        records = Queue.Queue()
+        handler = stackslurp.logs.QueueHandler(records)
+        handler.setFormatter(logging.Formatter("%(message)s"))
+
+        try:
+            raise ValueError("worker failed")
+        except ValueError:
+            handler.handle(logging.LogRecord("x", logging.ERROR, __file__, 1,
+                                             "cycle failed", None,
+                                             sys.exc_info()))
+
+        record = pickle.loads(pickle.dumps(records.get_nowait()))
+        formatted = logging.Formatter("%(message)s").format(record)
+        assert formatted.startswith("cycle failed\n")
+        assert formatted.count("ValueError: worker failed") == 1
+
+
+class TestWorkers(object):
+    def test_assign_shards(self):
+        sites = ["site{}".format(n) for n in range(20)]
+
+        assigned = stackslurp.workers.assign_shards(sites, "python", 3)
+
+        assert len(assigned) == 3
+        assert sorted(sum(assigned, [])) == sorted(sites)
+        assert all(assigned)
+        assert stackslurp.workers.assign_shards(sites, "python", 3) == assigned
+
+    def test_worker_config(self, stackslurpconfig, monkeypatch):
+        config = dict(stackslurpconfig, dedup={"file": "seen.json"})
+
+        worker = stackslurp.workers.worker_config(config, 2, ["serverfault"],
+                                                  3)
+
+        assert worker['sites'] == ["serverfault"]
+        assert worker['dedup']['file'] == "seen.json.2"
+        # The original is left alone
+        assert config['dedup']['file'] == "seen.json"
+
+        # Paced as one of three spending the quota: 6 hours to go and 300
+        # calls left is 10 cycles of 10 calls each for each worker
+        stackslurp.main.Rackspace = FakeSpace
+        stackslurp.main.StackExchange = FakeExchange
+        scheduler = stackslurp.stackexchange.QuotaScheduler()
+        monkeypatch.setattr(FakeExchange, "scheduler", scheduler)
+        monkeypatch.setattr(stackslurp.stackexchange.time, "time",
+                            lambda: 1388793600 - 6 * 3600)
+        scheduler.update("search", "serverfault", {"quota_remaining": 300})
+
+        slurper = stackslurp.main.StackSlurp(worker)
+        slurper.calls_per_cycle = 10
+        assert slurper.cycle_wait() == 6 * 3600 / 10.0
+
+    def test_restart_backoff(self, stackslurpconfig, monkeypatch):
+        class Process(object):
+            exitcode = 1
+
+            def is_alive(self):
+                return False
+
+        pool = stackslurp.workers.WorkerPool(stackslurpconfig, 1,
+                                             QuickSlurper, restart_delay=1,
+                                             max_restart_delay=4)
+        spawned = []
+        monkeypatch.setattr(pool, "_spawn", lambda worker: (
+            spawned.append(worker), pool.processes.update({0: Process()})))
+        pool.processes[0] = Process()
+
+        # It keeps dying, so each restart waits twice as long, up to the cap
+        restarts = []
+        for now in range(20):
+            pool.check_workers(now)
+            if len(spawned) > len(restarts):
+                restarts.append(now)
+        assert restarts == [1, 4, 9, 14, 19]
+
+        # A finished cycle shows it's healthy again
+        pool.handle(("stats", 0, {"ok": True, "events": 0, "duration": 0.0}))
+        pool.check_workers(20)
+        pool.check_workers(21)
+        assert len(spawned) == 6
+
+    def test_pool(self, stackslurpconfig):
+        config = dict(stackslurpconfig,
+                      sites=["site{}".format(n) for n in range(6)])
+
+        pool = stackslurp.workers.WorkerPool(config, 2, QuickSlurper)
+        pool.start()
+
+        records = []
+        try:
+            while len(pool.stats) < 2:
+                message = pool.messages.get(timeout=10)
+                if isinstance(message, logging.LogRecord):
+                    records.append(message)
+                else:
+                    pool.handle(message)
+        finally:
+            pool.stop()
+
+        # Other tests swap out time.sleep, so workers may cycle more than once
+        for worker, totals in pool.stats.items():
+            assert totals["events"] == totals["cycles"] * len(pool.shards[worker])
+            assert totals["failed"] == 0
+
+        assert set(record.getMessage() for record in records) <= \
+            set("slurping " + ",".join(sites) for sites in pool.shards)
+        assert records
+
+    def test_shared_checkpoints(self, tmpdir):
+        path = str(tmpdir.join("checkpoints.json"))
+
+        first = stackslurp.checkpoint.CheckpointStore(path)
+        second = stackslurp.checkpoint.CheckpointStore(path)
+
+        first.update({("stackoverflow", "python"): 10})
+        second.update({("serverfault", "python"): 20})
+
+        merged = stackslurp.checkpoint.CheckpointStore(path)
+        assert merged.get("stackoverflow", "python") == 10
+        assert merged.get("serverfault", "python") == 20
+
+    def test_cli(self, monkeypatch):
+        calls = []
+        monkeypatch.setattr(stackslurp.main, "main",
+                            lambda *args, **kwargs: calls.append((args, kwargs)))
+
+        stackslurp.main.cli(["-c", "other.yml", "--workers", "4"])
+        assert calls == [(("other.yml",), {"workers": 4, "record": None,
+                                           "replay": None, "speed": None})]
+
+        stackslurp.main.cli(["--replay", "traffic.jsonl.gz", "--speed", "0"])
+        assert calls[1] == (("config.yml",), {"workers": None, "record": None,
+                                              "replay": "traffic.jsonl.gz",
+                                              "speed": 0.0})
+
+        backfills = []
+        monkeypatch.setattr(stackslurp.main, "backfill",
+                            lambda *args, **kwargs: backfills.append(
+                                (args, kwargs)) or 0)
+
+        with pytest.raises(SystemExit) as exit:
+            stackslurp.main.cli(["backfill", "--from", "2014-01-01",
+                                 "--to", "2014-02-01", "--parallel", "8"])
+        assert exit.value.code == 0
+        assert backfills == [(("config.yml", "2014-01-01", "2014-02-01"),
+                              {"window": None, "parallel": 8,
+                               "state_file": None})]
+
 
 class RackspaceTestCase(unittest.TestCase):
 
@@ -406,6 +1801,58 @@ class RackspaceTestCase(unittest.TestCase):
         assert creds['apiKey'] == api_key
         assert rack.token == self.token
 
+    @httpretty.activate
+    def test_auth_caches_token(self):
+        fetches = []
+
+        def identity_callback(request, uri, headers):
+            fetches.append(request)
+            response = {"access": {"token": {
+                "id": "token{}".format(len(fetches)),
+                "expires": "2099-01-01T00:00:00.000-06:00"}}}
+            return (200, headers, json.dumps(response))
+
+        httpretty.register_uri(httpretty.POST,
+                               "https://identity.api.rackspacecloud.com/v2.0/tokens",
+                               body=identity_callback,
+                               content_type="application/json")
+
+        rack = stackslurp.rackspace.Rackspace("eve", "8675309")
+        rack.auth()
+        rack.auth()
+
+        assert len(fetches) == 1
+        assert rack.token == "token1"
+        assert rack.expires == 4070930400
+
+        rack.auth(force=True)
+        assert len(fetches) == 2
+        assert rack.token == "token2"
+
+    @httpretty.activate
+    def test_enqueue_reauths_once(self):
+        httpretty.register_uri(httpretty.POST,
+                               "https://identity.api.rackspacecloud.com/v2.0/tokens",
+                               body=self.identity_response,
+                               content_type="application/json")
+
+        endpoint = "https://dfw.queues.api.rackspacecloud.com"
+        statuses = [401, 201]
+
+        def queue_callback(request, uri, headers):
+            return (statuses.pop(0), headers, '{"partial": false}')
+
+        httpretty.register_uri(httpretty.POST,
+                               endpoint + "/v1/queues/retry/messages",
+                               body=queue_callback,
+                               content_type="application/json")
+
+        self.rack.token = "expired"
+        self.rack.enqueue([{'stuff': 23}], "retry", endpoint)
+
+        assert statuses == []
+        assert self.rack.token == self.token
+
     @httpretty.activate
     def test_enqueue(self):
 
@@ -464,6 +1911,103 @@ class RackspaceTestCase(unittest.TestCase):
 
         self.rack.enqueue([{'stuff': 23}, {'moo': 53}], queue_name, endpoint)
 
+    def test_enqueue_in_parallel(self):
+        # httpretty isn't thread safe, so stand in for the session instead
+        endpoint = "https://dfw.queues.api.rackspacecloud.com"
+        posted = []
+
+        class Response(object):
+            def __init__(self, status_code, body):
+                self.status_code = status_code
+                self.body = body
+
+            def json(self):
+                return self.body
+
+            def raise_for_status(self):
+                if self.status_code >= 400:
+                    raise requests.HTTPError(str(self.status_code))
+
+        class Session(object):
+            def post(self, url, data, headers):
+                assert url == endpoint + "/v1/queues/parallel/messages"
+                messages = json.loads(data)
+                posted.append([message['body']['n'] for message in messages])
+
+                if messages[0]['body']['n'] == 10:
+                    return Response(503, None)
+
+                return Response(201, {
+                    u'partial': False,
+                    u'resources': [u'/v1/queues/parallel/messages/{}'.format(
+                                   message['body']['n'])
+                                   for message in messages]})
+
+        self.rack.session = Session()
+
+        messages = [{'n': n} for n in range(25)]
+
+        # One try per batch, retries are tested on their own
+        stackslurp.retry.configure(attempts=1)
+        try:
+            with pytest.raises(stackslurp.rackspace.EnqueueError) as excinfo:
+                self.rack.enqueue(messages, "parallel", endpoint, batch_size=5,
+                                  max_in_flight=3)
+        finally:
+            stackslurp.retry.configure()
+            self.rack.close()
+
+        # Every batch was tried, in batches of 5
+        assert sorted(posted) == [range(n, n + 5) for n in range(0, 25, 5)]
+
+        results = excinfo.value.results
+        assert [result.messages for result in results] == \
+            [messages[n:n + 5] for n in range(0, 25, 5)]
+        assert [result.error is None for result in results] == \
+            [True, True, False, True, True]
+        assert results[0].resources[0] == u'/v1/queues/parallel/messages/0'
+
+        with pytest.raises(ValueError):
+            self.rack.enqueue(messages, "parallel", endpoint, batch_size=11)
+
+    def test_enqueue_by_size(self):
+        endpoint = "https://dfw.queues.api.rackspacecloud.com"
+        posted = []
+
+        class Response(object):
+            status_code = 201
+
+            def __init__(self, count):
+                self.count = count
+
+            def json(self):
+                return {u'partial': False, u'resources': [u'x'] * self.count}
+
+            def raise_for_status(self):
+                pass
+
+        class Session(object):
+            def post(self, url, data, headers):
+                assert len(data) <= 400
+                messages = json.loads(data)
+                posted.append([message['body']['n'] for message in messages])
+                return Response(len(messages))
+
+        self.rack.session = Session()
+
+        messages = [{'n': n, 'text': "x" * size} for n, size in
+                    enumerate([10, 10, 200, 150, 500, 10])]
+
+        results = self.rack.enqueue(messages, "sized", endpoint, ttl=60,
+                                    batch_size=10, max_bytes=400)
+
+        # Packed up to the byte limit, and the one that could never fit
+        # is left out, but still accounted for in its place
+        assert posted == [[0, 1, 2], [3], [5]]
+        assert [result.messages for result in results] == \
+            [messages[:3], [messages[3]], [messages[4]], [messages[5]]]
+        assert results[2].resources == [] and results[2].error is None
+
     @httpretty.activate
     def test_enqueue_failure(self):
 
@@ -562,9 +2106,9 @@ class TestStackExchange(object):
         httpretty.register_uri(httpretty.GET,
                                "https://api.stackexchange.com/2.1/search",
                                body=param_check_callback({'key': 'superkey'}))
-        search_questions(since=since, tags=["python"], site="pets",
-                         stackexchange_key="superkey", order="desc",
-                         sort_on="creation")
+        list(search_questions(since=since, tags=["python"], site="pets",
+                              stackexchange_key="superkey", order="desc",
+                              sort_on="creation"))
 
         # It should handle not having a stackexchange key gracefully
         def lack_key_check(params):
@@ -573,8 +2117,8 @@ class TestStackExchange(object):
         httpretty.register_uri(httpretty.GET,
                                "https://api.stackexchange.com/2.1/search",
                                body=create_callback_check(lack_key_check))
-        search_questions(since=since, tags=["python"], site="pets",
-                         order="desc", sort_on="creation")
+        list(search_questions(since=since, tags=["python"], site="pets",
+                              order="desc", sort_on="creation"))
 
         # To get around how parse_qs works (urlparse, under the hood of
         # httpretty), we'll leave the semi colon quoted.
@@ -588,38 +2132,38 @@ class TestStackExchange(object):
                                "https://api.stackexchange.com/2.1/search",
                                body=param_check_callback({'tagged':
                                                           'python;dog'}))
-        search_questions(since=since, tags=["python", "dog"], site="pets")
+        list(search_questions(since=since, tags=["python", "dog"], site="pets"))
 
         # It should handle a single tag
         httpretty.register_uri(httpretty.GET,
                                "https://api.stackexchange.com/2.1/search",
                                body=param_check_callback({'tagged': 'python'}))
-        search_questions(since=since, tags=["python"], site="pets")
+        list(search_questions(since=since, tags=["python"], site="pets"))
 
         httpretty.register_uri(httpretty.GET,
                                "https://api.stackexchange.com/2.1/search",
                                body=param_check_callback({'tagged': 'python'}))
-        search_questions(since=since, tags="python", site="pets")
+        list(search_questions(since=since, tags="python", site="pets"))
 
         # It should handle a string of tags, separated by commas
         httpretty.register_uri(httpretty.GET,
                                "https://api.stackexchange.com/2.1/search",
                                body=param_check_callback({'tagged': 'python'}))
-        search_questions(since=since, tags="python", site="pets")
+        list(search_questions(since=since, tags="python", site="pets"))
 
         # TODO: It should handle when the response is gzip encoded
         httpretty.register_uri(httpretty.GET,
                                "https://api.stackexchange.com/2.1/search",
                                body=param_check_callback({'tagged': 'python'},
                                                          gzip_enabled=True))
-        search_questions(since=since, tags="python", site="pets")
+        list(search_questions(since=since, tags="python", site="pets"))
 
         # TODO: It should handle when the response is not gzip encoded
         httpretty.register_uri(httpretty.GET,
                                "https://api.stackexchange.com/2.1/search",
                                body=param_check_callback({'tagged': 'python'},
                                                          gzip_enabled=False))
-        search_questions(since=since, tags="python", site="pets")
+        list(search_questions(since=since, tags="python", site="pets"))
 
         # Back to normal for the rest
         httpretty.core.unquote_utf8 = orig_unquote
@@ -629,11 +2173,238 @@ class TestStackExchange(object):
         # TODO: It should do *something* when the quota has been reached
         # (within resp.json()['quota_remaining'])
 
-        # TODO: When there are multiple pages of results, it should aggregate
-        # This won't go well if there are lots, as it will have to block at
-        # this point
-
         # TODO: Handle error responses
 
+    @httpretty.activate
+    def test_create_filter(self):
+        StackExchange = stackslurp.stackexchange.StackExchange
+
+        created = []
+
+        def filter_callback(request, uri, headers):
+            # httpretty splits on semicolons, so go by the raw query
+            query = urlparse.urlparse(urllib.unquote(request.path)).query
+            created.append(dict(param.split("=", 1)
+                                for param in query.split("&")))
+            body = {"items": [{"filter": "!trimmed{}".format(len(created))}]}
+            return (200, headers, json.dumps(body))
+
+        httpretty.register_uri(httpretty.GET,
+                               "https://api.stackexchange.com/2.1/filters/create",
+                               body=filter_callback)
+
+        filter_id = StackExchange.create_filter(base="none",
+                                                include=["question.score"],
+                                                exclude=["question.title"])
+        assert filter_id == "!trimmed1"
+
+        # Only made once
+        assert StackExchange.create_filter(base="none",
+                                           include=["question.score"],
+                                           exclude=["question.title"]) == filter_id
+        assert len(created) == 1
+
+        include = created[0]['include'].split(";")
+        assert "question.score" in include
+        # Can't page or watch the quota without these
+        assert ".has_more" in include
+        assert ".backoff" in include
+        assert "question.title" in include
+        assert "question.title" not in created[0]['exclude']
+
+        httpretty.register_uri(httpretty.GET,
+                               "https://api.stackexchange.com/2.1/search",
+                               body=param_check_callback({'filter': filter_id}))
+        list(StackExchange.search_questions(since=1388594252, tags="python",
+                                            site="pets", filter=filter_id))
+
+    def test_quota_scheduler(self):
+        scheduler = stackslurp.stackexchange.QuotaScheduler()
+
+        # Nothing known yet, so no reason to wait longer than asked
+        assert scheduler.pace(300, 10) == 300
+        assert not scheduler.exhausted
+
+        scheduler.update("search", "pets", {"quota_remaining": 100,
+                                            "quota_max": 10000})
+        assert scheduler.calls == 1
+
+        # 6 hours to go, 10 cycles left at 10 calls each
+        midnight = 1388793600
+        assert scheduler.pace(300, 10, now=midnight - 6 * 3600) == 2160
+
+        # Plenty of quota left, the configured wait wins
+        assert scheduler.pace(300, 10, now=midnight - 60) == 300
+
+        scheduler.update("search", "pets", {"quota_remaining": 0})
+        assert scheduler.exhausted
+        assert scheduler.pace(300, 10, now=midnight - 3600) == 3600
+
+    def test_quota_scheduler_backoff(self, monkeypatch):
+        scheduler = stackslurp.stackexchange.QuotaScheduler()
+
+        sleeps = []
+        monkeypatch.setattr(stackslurp.stackexchange.time, "sleep",
+                            sleeps.append)
+
+        scheduler.update("search", "pets", {"backoff": 10})
+
+        # Other sites are unaffected
+        scheduler.wait("search", "stackoverflow")
+        assert sleeps == []
+
+        scheduler.wait("search", "pets")
+        assert len(sleeps) == 1
+        assert 9 < sleeps[0] <= 10
+
+    @httpretty.activate
+    def test_search_questions_pages(self):
+        search_questions = stackslurp.stackexchange.StackExchange.search_questions
+
+        pages = []
+
+        def paging_callback(request, uri, headers):
+            params = request.querystring
+            assert params['pagesize'][0] == '100'
+
+            page = int(params['page'][0])
+            pages.append(page)
+
+            body = {"items": [{"question_id": page * 10 + n} for n in range(2)],
+                    "has_more": page < 3}
+            return (200, headers, json.dumps(body))
+
+        httpretty.register_uri(httpretty.GET,
+                               "https://api.stackexchange.com/2.1/search",
+                               body=paging_callback)
+
+        questions = search_questions(since=1388594252, tags="python",
+                                     site="pets")
+
+        # Nothing is fetched until someone asks for questions
+        assert pages == []
+
+        assert next(questions) == {"question_id": 10}
+        assert pages == [1]
+
+        assert [q["question_id"] for q in questions] == [11, 20, 21, 30, 31]
+        assert pages == [1, 2, 3]
+
+    def test_query_planner(self):
+        planner = stackslurp.stackexchange.QueryPlanner(rate_ttl=3600)
+
+        # Too few tags to be worth counting
+        plan = planner.plan(["python", "ruby"], "pets", 1000, count=None)
+        assert plan.strategy == "per_tag"
+        assert plan.calls == [("search", {"tagged": "python"}),
+                              ("search", {"tagged": "ruby",
+                                          "nottagged": "python"})]
+
+        counts = []
+
+        def count(total):
+            def count():
+                counts.append(total)
+                return total
+            return count
+
+        tags = ["c", "go", "rust", "c"]
+
+        # A quiet site is cheaper to read in full
+        plan = planner.plan(tags, "pets", 1000, count(150), now=2000)
+        assert plan.strategy == "firehose"
+        assert plan.calls == [("questions", {})]
+        assert plan.cost == 3
+
+        # The rate is remembered, so no more counting for a while
+        plan = planner.plan(tags, "pets", 2000, count(0), now=2500)
+        assert plan.strategy == "firehose"
+        assert plan.cost == 1
+        assert counts == [150]
+
+        # A busy one is cheaper per tag, each call skipping earlier tags
+        plan = planner.plan(tags, "stackoverflow", 1000, count(5000),
+                            now=2000)
+        assert plan.strategy == "per_tag"
+        assert [params.get("nottagged") for _, params in plan.calls] == \
+            [None, "c", "c;go"]
+
+    @httpretty.activate
+    def test_search_any(self):
+        StackExchange = stackslurp.stackexchange.StackExchange
+
+        questions = [{"question_id": 1, "tags": ["c"]},
+                     {"question_id": 2, "tags": ["cobol"]},
+                     {"question_id": 3, "tags": ["go", "rust"]}]
+        requests_made = []
+
+        def questions_callback(request, uri, headers):
+            params = request.querystring
+            requests_made.append(params.get('filter', [None])[0])
+            if params.get('filter') == ['total']:
+                body = {"total": 3}
+            else:
+                assert 'tagged' not in params
+                body = {"items": questions, "has_more": False}
+            return (200, headers, json.dumps(body))
+
+        httpretty.register_uri(httpretty.GET,
+                               "https://api.stackexchange.com/2.1/questions",
+                               body=questions_callback)
+
+        found = list(StackExchange.search_any(1388594252, ["c", "go", "rust"],
+                                              "pets"))
+
+        # Counted, then read everything and kept the ones with any tag
+        assert requests_made == ["total", None]
+        assert [q["question_id"] for q in found] == [1, 3]
+
+        searched = []
+
+        def search_callback(request, uri, headers):
+            # httpretty splits on semicolons, so go by the raw query
+            query = urlparse.urlparse(urllib.unquote(request.path)).query
+            params = dict(param.split("=", 1) for param in query.split("&"))
+            searched.append((params['tagged'], params.get('nottagged')))
+            body = {"items": [q for q in questions
+                              if params['tagged'] in q["tags"]],
+                    "has_more": False}
+            return (200, headers, json.dumps(body))
+
+        httpretty.register_uri(httpretty.GET,
+                               "https://api.stackexchange.com/2.1/search",
+                               body=search_callback)
+
+        found = list(StackExchange.search_any(1388594252, "go;rust", "pets"))
+
+        assert searched == [("go", None), ("rust", "go")]
+        # Question 3 has both tags but only comes out once
+        assert [q["question_id"] for q in found] == [3]
+
+    @httpretty.activate
+    def test_get_questions(self):
+        StackExchange = stackslurp.stackexchange.StackExchange
+
+        calls = []
+
+        def questions_callback(request, uri, headers):
+            path = urlparse.urlsplit(urllib.unquote(request.path)).path
+            ids = [int(id) for id in path.rsplit("/", 1)[1].split(";")]
+            calls.append((len(ids), request.querystring['filter'][0]))
+            body = {"items": [{"question_id": id, "body": "<p>{}</p>".format(id)}
+                              for id in ids], "has_more": False}
+            return (200, headers, json.dumps(body))
+
+        httpretty.register_uri(httpretty.GET,
+            re.compile(r"https://api.stackexchange.com/2.1/questions/[\d;]+"),
+            body=questions_callback)
+
+        questions = list(StackExchange.get_questions(range(1, 151), "pets"))
+
+        # A hundred to a call, with bodies
+        assert calls == [(100, "withbody"), (50, "withbody")]
+        assert [q["question_id"] for q in questions] == range(1, 151)
+        assert questions[0]["body"] == "<p>1</p>"
+
 if __name__ == "__main__":
     unittest.main()